@@ -1,16 +1,46 @@
 __author__ = 'daniel michels'
 
+import time
+
+# Taken before the imports, they are the first phase of the startup
+STARTED = time.time()
+
 import json
+import os
 import sys
 import random
+import argparse
 
 
 from enum import Enum
-from threading import Timer
-from gmusicapi import Mobileclient, Webclient
-from mplayer import Player
+
+from mplayer import Player, PlayerPool
+from gmusicplayer.mpv import MpvPlayer
+from gmusicplayer.supervisor import PlayerSupervisor
+from gmusicplayer.playback import PlaybackClock
+from gmusicplayer.audiocache import AudioCache
+from gmusicplayer.streamproxy import StreamProxy
+from gmusicplayer.buffering import BufferingController
+from gmusicplayer.artproxy import ArtProxy
+from gmusicplayer.assets import StaticAssets
+from gmusicplayer.payloads import PayloadMode, encode, enable_compression
+from gmusicplayer.hub import BroadcastHub
+from gmusicplayer.batching import EventBatcher, batch_topic
+from gmusicplayer.httpstatus import HttpStatus
+from gmusicplayer.metrics import MetricsRegistry
+from gmusicplayer.tracing import TrackChangeTracer
+from gmusicplayer.lagmonitor import LagMonitor
+from gmusicplayer.profiling import AdminTools
+from gmusicplayer.startup import Startup, StartupError, SessionStore, import_gmusicapi, warm_up
+from gmusicplayer.scheduler import CallScheduler, Priority
+from gmusicplayer.hedging import HedgedResolver, DeadlineExceeded
+from gmusicplayer.playlists import PlaylistManager
+from gmusicplayer.cluster import ClusterCore, CoreClient, listen_shared, worker_command
+from twisted.internet import defer
 from twisted.internet import reactor
-from twisted.web import static, server
+from twisted.internet.task import LoopingCall
+from twisted.web import server
+from twisted.web.resource import Resource
 
 from autobahn.websocket import listenWS
 from autobahn.wamp import WampServerFactory, WampServerProtocol, exportRpc
@@ -19,8 +49,60 @@ from autobahn.wamp import WampServerFactory, WampServerProtocol, exportRpc
 PLAYLIST_EVENT_TRACK_ADDED = 'musicplayer/playlist/events/track_added_to_playlist'
 PLAYLIST_EVENT_TRACK_REMOVED = 'musicplayer/playlist/events/track_removed_from_playlist'
 PLAYLIST_EVENT_PLAYTYPE_CHANGED = 'musicplayer/playlist/events/playtype_changed'
+PLAYLIST_EVENT_SWITCHED = 'musicplayer/playlist/events/switched'
 
 TRACK_EVENT_PLAYBACK = 'musicplayer/events/playback'
+TRACK_EVENT_POSITION = 'musicplayer/events/position'
+
+# Sent to a client which fell behind instead of the events it missed
+SESSION_EVENT_RESYNC = 'musicplayer/events/resync'
+
+# Several events of a topic within the batching window are sent as list on its batch topic
+PLAYLIST_EVENT_TRACKS_ADDED = batch_topic(PLAYLIST_EVENT_TRACK_ADDED)
+PLAYLIST_EVENT_TRACKS_REMOVED = batch_topic(PLAYLIST_EVENT_TRACK_REMOVED)
+
+# Topics whose events legacy clients expect as JSON string
+JSON_STRING_TOPICS = (PLAYLIST_EVENT_TRACK_ADDED, PLAYLIST_EVENT_TRACKS_ADDED, TRACK_EVENT_PLAYBACK,
+                      TRACK_EVENT_POSITION)
+
+# Topics of which a client only needs the latest event
+COALESCED_TOPICS = (PLAYLIST_EVENT_PLAYTYPE_CHANGED, PLAYLIST_EVENT_SWITCHED, TRACK_EVENT_PLAYBACK,
+                    TRACK_EVENT_POSITION)
+
+# Player classes of the supported playback engines
+ENGINES = {
+    'mplayer': Player,      # mplayer in slave mode
+    'mpv': MpvPlayer        # mpv over its JSON IPC
+}
+
+HTTP_PORT = 8080
+WS_PORT = 9000
+
+# Port the core serves the streams on in multi-process mode, on localhost only
+STREAM_PORT = 8081
+
+# Calls to Google Music, player commands and state transitions which are timed
+REMOTE_CALLS = ('login', 'get_registered_devices', 'get_all_user_playlist_contents', 'create_playlist',
+                'add_songs_to_playlist', 'remove_entries_from_playlist', 'search_all_access', 'get_stream_url')
+PLAYER_COMMANDS = ('loadfile', 'seek', 'pause', 'stop', 'quit')
+TRANSITIONS = ('load_playlist', 'play', 'play_track', 'play_next_track', 'play_previous_track', 'stop', 'pause',
+               'set_playtype', 'add_track_to_playlist', 'remove_track_from_playlist', 'switch_playlist')
+
+# RPCs which are answered while the player is warming up, the others fail with WARMING_UP_URI
+WARMING_UP_CALLS = ('set_payload_mode', 'get_status', 'get_playlist', 'get_startup', 'get_traces',
+                    'admin_start_profile', 'admin_stop_profile', 'admin_memory_snapshot', 'admin_memory_diff',
+                    'admin_memory_reset')
+WARMING_UP_URI = 'musicplayer/startup#warming_up'
+
+# Port of the stand-in for the stream host of Google Music, see --fake-backend
+FAKE_STREAM_PORT = 8082
+
+# Seconds before the end of a track at which the next one starts downloading
+PREFETCH_LEAD = 30
+
+# Attempts to play the next track at the end of a track, and seconds between them
+ADVANCE_ATTEMPTS = 3
+ADVANCE_RETRY_DELAY = 5
 
 
 class PlayType(Enum):
@@ -33,16 +115,85 @@ class PlayType(Enum):
 
 class MusicPlayer(object):
 
-    def __init__(self):
+    # Google Music clients, gmusicapi's unless replaced, e.g. by fakes for load tests
+    webclient_class = None
+    mobileclient_class = None
+
+    def __init__(self, engine='mplayer', audio_cache=None, stream_proxy=None, metrics=None, scheduler=None,
+                 resolver=None, playlists=None):
+        """
+        Keyword arguments:
+        engine -- name of the playback engine to use, see ENGINES
+        audio_cache -- AudioCache for tracks which are played again or None
+        stream_proxy -- StreamProxy to stream tracks through or None
+        metrics -- MetricsRegistry to record the timings in or None
+        scheduler -- CallScheduler running the calls to Google Music, a default one if None
+        resolver -- HedgedResolver resolving the stream urls, a default one if None
+        playlists -- PlaylistManager keeping the loaded playlists, a default one if None
+
+        """
+        if self.webclient_class is None or self.mobileclient_class is None:
+            clients = import_gmusicapi()
+            if clients is None:
+                raise StartupError('gmusicapi is not installed')
+            MusicPlayer.webclient_class, MusicPlayer.mobileclient_class = clients
+
         self.playlist = []                  # Array of all tracks
         self.playlist_id = 0                # Id of playlist
+        self.engine = engine                # Name of the playback engine
         self.current_track_index = 0        # Index of current song
-        self.player = Player()              # MPlayer instance
-        self.webclient = Webclient()        # Client for WebInterface
-        self.mobileclient = Mobileclient()  # Client for MobileInterface
+        # Warm standby player processes, with the cache sized for the proxy before anything is measured
+        player_args = ()
+        if stream_proxy is not None and stream_proxy.buffering is not None:
+            player_args = stream_proxy.buffering.player_args(engine)
+        self.player_pool = PlayerPool(args=player_args, player_class=ENGINES[engine])
+        self.player = None                  # MPlayer instance, taken from the pool for the first track
+        self.supervisor = PlayerSupervisor(self, self.player_pool)  # Respawns a crashed MPlayer
+        self.playback = PlaybackClock(self._publish, TRACK_EVENT_POSITION)  # Playback state
+        self.webclient = self.webclient_class()         # Client for WebInterface
+        self.mobileclient = self.mobileclient_class()   # Client for MobileInterface
         self.timer = None                   # Timer to start next track
+        self.prefetch_timer = None          # Timer to prefetch next track
+        self.next_track_id = None           # Id of the prefetched next track
         self.deviceid = 0                   # DeviceId to use
         self.playtype = PlayType.LINEAR     # LINEAR or SHUFFLE
+        self.audio_cache = audio_cache      # Local copies of played tracks
+        self.stream_proxy = stream_proxy    # Buffers the streams for mplayer
+        self.metrics = metrics              # Records the timings or None
+        self.player_commands = None         # Timer of the commands sent to the player
+        self.tracer = TrackChangeTracer()   # Time to first audio of the track changes
+        self.scheduler = scheduler or CallScheduler()   # Runs the calls to Google Music by priority
+        self.play_requests = 0              # Number of the latest track change, a track resolved after it isn't played
+        self.resolver = resolver or HedgedResolver(self.scheduler)  # Resolves stream urls with a deadline
+        self.playlists = playlists or PlaylistManager()     # Loaded playlists, the active one is self.playlist
+        self.playlist_refresh = None        # Refreshes the other playlists in the background
+
+        if metrics is not None:
+            remote_calls = metrics.timer('gmusicplayer_remote_call', 'Calls to Google Music', ('client', 'method'))
+            metrics.instrument(self.webclient, remote_calls, REMOTE_CALLS, ('webclient',))
+            metrics.instrument(self.mobileclient, remote_calls, REMOTE_CALLS, ('mobileclient',))
+            metrics.instrument(self, metrics.timer('gmusicplayer_transition', 'State transitions of the player',
+                                                   ('transition',)), TRANSITIONS)
+            self.player_commands = metrics.timer('gmusicplayer_player_command', 'Commands sent to the player',
+                                                 ('command',))
+
+        self.playback.set_playtype(self.playtype.value)
+
+    def attach_player(self, player):
+        """ Use a new MPlayer instance.
+
+        Keyword arguments:
+        player -- the Player instance to use
+
+        """
+        self.player = player
+        if self.metrics is not None:
+            self.metrics.instrument(player, self.player_commands, PLAYER_COMMANDS)
+        self.supervisor.watch(player)
+        self.playback.observe(player)
+        self.tracer.observe(player)
+        if self.stream_proxy is not None and self.stream_proxy.buffering is not None:
+            self.stream_proxy.buffering.observe(player)
 
     def login(self, username, password):
         """ Login to Google Music.
@@ -60,29 +211,144 @@ class MusicPlayer(object):
         if not self.webclient.login(username, password) or not self.mobileclient.login(username, password):
             return False
 
+        self.deviceid = self.lookup_device_id()
+
+        return True
+
+    def lookup_device_id(self):
+        """ Look up the device id to stream with, the Webclient has to be logged in.
+
+        Returns:
+        The id of the first registered device
+
+        """
+
         # Use first found devices as ID
         devices = self.webclient.get_registered_devices();
 
         # Convert HEX to INT
-        self.deviceid = int(devices[0]['id'], 16)
+        return int(devices[0]['id'], 16)
 
-        return True
+    def load_playlist(self, playlist_name, playlists=None):
+        """ Load the tracks of a playlist, which is created if it doesn't exist.
+
+        Keyword arguments:
+        playlist_name -- name of the playlist
+        playlists -- the playlists of the account if fetched already or None
+
+        """
+        if playlists is None:
+            playlists = self.mobileclient.get_all_user_playlist_contents()
 
-    def load_playlist(self, playlist_name):
         # Load playlist
-        for playlist in self.mobileclient.get_all_user_playlist_contents():
+        playlist_id = None
+        for playlist in playlists:
             if playlist['name'] == playlist_name:
-                for track_obj in playlist['tracks']:
-                    track_obj['track']['id'] = track_obj['id']
-                    self.playlist.append(track_obj['track'])
-
-                # Set playlist_id
-                self.playlist_id = playlist['id']
+                playlist_id = playlist['id']
+                self.playlists.load(playlist_id, playlists)
                 break;
 
         # If playlist has not been found, create it
-        if self.playlist_id == 0:
-            self.playlist_id = self.mobileclient.create_playlist(playlist_name)
+        if playlist_id is None:
+            playlist_id = self.mobileclient.create_playlist(playlist_name)
+            self.playlists.add(playlist_id, playlist_name)
+
+        self._activate(playlist_id)
+
+        # The other playlists are kept as far as they fit, so switching to them is instant
+        self.playlists.update(playlists)
+
+    def list_playlists(self):
+        """ The playlists of the account.
+
+        Returns:
+        List of dicts with id, name and number of tracks of the playlists,
+        and whether they are loaded and active
+
+        """
+        return self.playlists.playlists()
+
+    def switch_playlist(self, playlist_id):
+        """ Play the tracks of another playlist from now on, the current track plays on.
+
+        The playlist continues at the track and with the play type it was
+        left with. A playlist which isn't loaded anymore is fetched first.
+
+        Keyword arguments:
+        playlist_id -- Id of the playlist
+
+        Returns:
+        Deferred firing with True once the playlist is active, False if the
+        account has no such playlist
+
+        """
+        if playlist_id == self.playlist_id:
+            return defer.succeed(True)
+
+        if playlist_id in self.playlists:
+            self.playlists.hit(True)
+            self._switched(playlist_id)
+            return defer.succeed(True)
+
+        self.playlists.hit(False)
+        d = self.scheduler.call(Priority.INTERACTIVE, self.mobileclient.get_all_user_playlist_contents)
+        d.addCallback(self._playlist_fetched, playlist_id)
+        return d
+
+    def _playlist_fetched(self, playlists, playlist_id):
+        if self.playlists.load(playlist_id, playlists) is None:
+            return False
+        self._switched(playlist_id)
+
+        # Fetched anyway, so the others are refreshed as well
+        self.playlists.update(playlists)
+        return True
+
+    def _switched(self, playlist_id):
+        playlist = self._activate(playlist_id)
+
+        # Clients replace their playlist
+        self._publish(PLAYLIST_EVENT_SWITCHED, {'id': playlist.id, 'name': playlist.name,
+                                                'playtype': self.playtype.value, 'tracks': playlist.tracks})
+
+    def _activate(self, playlist_id):
+        # Keep where the player was in the playlist it leaves
+        active = self.playlists.active
+        if active is not None:
+            active.cursor = self.current_track_index
+            active.playtype = self.playtype.value
+
+        playlist = self.playlists.activate(playlist_id)
+        self.playlist = playlist.tracks
+        self.playlist_id = playlist.id
+        self.current_track_index = playlist.cursor
+        self.next_track_id = None
+
+        playtype = playlist.playtype or PlayType.LINEAR.value
+        if playtype != self.playtype.value:
+            self.set_playtype(playtype)
+        return playlist
+
+    def refresh_playlists(self, interval):
+        """ Fetch the playlists every interval seconds in the background, see PlaylistManager.update().
+
+        Keyword arguments:
+        interval -- seconds between two refreshes
+
+        """
+        self.playlist_refresh = LoopingCall(self._refresh_playlists)
+        self.playlist_refresh.start(interval, now=False)
+
+    def _refresh_playlists(self):
+        d = self.scheduler.call(Priority.BACKGROUND, self.mobileclient.get_all_user_playlist_contents)
+        d.addCallback(self.playlists.update)
+        d.addErrback(self._refresh_failed)
+        return d
+
+    @staticmethod
+    def _refresh_failed(failure):
+        # The loaded playlists are kept as they are until the next refresh
+        print("refreshing the playlists failed: %s" % failure.getErrorMessage())
 
     def add_track_to_playlist(self, track):
         """ Append a track to the end of playlist
@@ -90,13 +356,41 @@ class MusicPlayer(object):
         Keyword arguments:
         track -- a dictionary containing the track informations
 
+        Returns:
+        Deferred firing when the track has been added
+
         """
-        track_id = self.mobileclient.add_songs_to_playlist(self.playlist_id, track['nid'])[0]
-        track['id'] = track_id
-        self.playlist.append(track)
+        d = self.scheduler.call(Priority.MUTATION, self.mobileclient.add_songs_to_playlist, self.playlist_id,
+                                track['nid'])
+        d.addCallback(self._track_added, track, self.playlist_id)
+        return d
+
+    def _track_added(self, entry_ids, track, playlist_id):
+        track['id'] = entry_ids[0]
+
+        # The playlist might have been switched or even dropped in the meantime
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return
+        playlist.tracks.append(track)
 
         # Notify all clients about the new track
-        factory.forwarder.dispatch(PLAYLIST_EVENT_TRACK_ADDED, json.dumps(track))
+        if playlist_id == self.playlist_id:
+            self._publish(PLAYLIST_EVENT_TRACK_ADDED, track)
+
+    def search(self, query):
+        """ Search All Access for tracks.
+
+        Keyword arguments:
+        query -- the search query
+
+        Returns:
+        Deferred firing with the song hits
+
+        """
+        d = self.scheduler.call(Priority.INTERACTIVE, self.mobileclient.search_all_access, query, 20)
+        d.addCallback(lambda result: result['song_hits'])
+        return d
 
     def remove_track_from_playlist(self, track_id):
         """ Removes a track from the playlist
@@ -104,20 +398,40 @@ class MusicPlayer(object):
         Keyword arguments:
         track_id -- The id of the track to remove
 
+        Returns:
+        Deferred firing when the track has been removed
+
         """
-        self.mobileclient.remove_entries_from_playlist(track_id)
+        playlist_id = self.playlist_id
+        d = self.scheduler.call(Priority.MUTATION, self.mobileclient.remove_entries_from_playlist, track_id)
+        d.addCallback(lambda _: self._track_removed(track_id, playlist_id))
+        return d
 
-        index_to_remove = self._find_index_of_track_id(track_id)
+    def _track_removed(self, track_id, playlist_id):
+        # The playlist might have been switched or even dropped in the meantime
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return
 
-        del self.playlist[index_to_remove]
+        index_to_remove = self._find_index_of_track_id(track_id, playlist.tracks)
 
-        factory.forwarder.dispatch(PLAYLIST_EVENT_TRACK_REMOVED, track_id)
+        del playlist.tracks[index_to_remove]
 
-    def play_track(self, track_id):
+        if playlist_id == self.playlist_id:
+            self._publish(PLAYLIST_EVENT_TRACK_REMOVED, track_id)
+
+    def play_track(self, track_id, start_position=0):
         """ Play a track
 
         Keyword arguments:
         track_id -- Id of the track to play
+        start_position -- Position in seconds to start playing at
+
+        Returns:
+        Deferred firing with True once the track plays, with False if another
+        track has been asked for in the meantime. False if there is no track.
+        If the stream url isn't resolved in time another track is played,
+        preferably one which is available locally
 
         """
 
@@ -126,48 +440,114 @@ class MusicPlayer(object):
         track_to_play = self.playlist[index_of_track]
 
         if track_to_play is not None:
-            # Request stream url from google music
-            stream_url = self.mobileclient.get_stream_url(track_to_play["storeId"], self.deviceid)
+            return self._play(track_to_play, start_position)
+        else:
+            return False
+
+    def _play(self, track_to_play, start_position, fall_back=True):
+        self.tracer.track_change(track_to_play['id'])
+
+        self.play_requests += 1
+        d = self._resolve_stream_url(track_to_play)
+        d.addCallback(self._load_track, self.play_requests, track_to_play, start_position)
+        if fall_back:
+            d.addErrback(self._resolve_expired, self.play_requests, track_to_play)
+        return d
 
-            # Load stream url to mplayer
+    def _resolve_expired(self, failure, request, track):
+        failure.trap(DeadlineExceeded)
+        if request != self.play_requests:
+            return False
+
+        # Only one fallback, so a slow Google Music doesn't skip through the whole playlist
+        fallback = self._fallback_track(track)
+        if fallback is None:
+            return failure
+        self.resolver.fell_back()
+        print "no stream url for", track["artist"], " - ", track["title"], "in time, playing", \
+            fallback["artist"], " - ", fallback["title"], "instead"
+        return self._play(fallback, 0, fall_back=False)
+
+    def _fallback_track(self, track):
+        index_of_track = self._find_index_of_track_id(track['id'])
+        if index_of_track is None:
+            index_of_track = self.current_track_index
+        others = self.playlist[index_of_track + 1:] + self.playlist[:index_of_track]
+
+        # A track which plays right away, else just the next one
+        for other in others:
+            if self._is_local(other):
+                return other
+        return others[0] if others else None
+
+    def _is_local(self, track):
+        store_id = track.get("storeId")
+        if store_id is None:
+            return False
+        if self.audio_cache is not None and store_id in self.audio_cache:
+            return True
+        return self.stream_proxy is not None and self.stream_proxy.is_buffered(store_id)
+
+    def _load_track(self, stream_url, request, track_to_play, start_position):
+        # The latest track change wins, and the track might have been removed in the meantime
+        index_of_track = self._find_index_of_track_id(track_to_play['id'])
+        if request != self.play_requests or index_of_track is None:
+            return False
+
+        self.tracer.mark('stream_url_resolved')
+
+        # Load stream url to mplayer, the pool records how long it took to get a player there
+        if self.player is None:
+            self.attach_player(self.player_pool.acquire(stream_url))
+        else:
             self.player.loadfile(stream_url)
+        self.tracer.mark('loadfile_written')
 
-            # For some reason OSX needs to unpause mplayer
-            if sys.platform == "darwin":
-                self.player.pause()
+        # Seek to the position to start at
+        if start_position:
+            self.player.seek(float(start_position), 2)
 
-            # Set track
-            self.current_track_index = index_of_track
+        # For some reason OSX needs to unpause mplayer
+        if sys.platform == "darwin" and self.engine == 'mplayer':
+            self.player.pause()
 
-            # Cancel previous timer
-            if self.timer is not None:
-                self.timer.cancel()
+        # Set track
+        self.current_track_index = index_of_track
 
-            # How many minutes does the track last
-            track_duration = long(track_to_play["durationMillis"]) / 1000
+        # Start the clock of the new track
+        self.playback.track_started(track_to_play, start_position)
 
-            # Set Timer to play next track when trackDuration is over
-            self.timer = Timer(track_duration, self.play_next_track)
-            self.timer.daemon = True
-            self.timer.start()
+        # Set Timer to play next track when track is over
+        self._schedule_next_track()
 
-            print "playing", track_to_play["artist"], " - ", track_to_play["title"], " : ", stream_url
+        print "playing", track_to_play["artist"], " - ", track_to_play["title"], " : ", stream_url
 
-            # Fire event that a new track is playing
-            factory.forwarder.dispatch(TRACK_EVENT_PLAYBACK, json.dumps(track_to_play))
+        # Fire event that a new track is playing
+        self._publish(TRACK_EVENT_PLAYBACK, track_to_play)
+        self.tracer.mark('event_published')
 
-            return True
-        else:
-            return False
+        return True
 
     def play_next_track(self):
         """ Play the next track in the playlist.
 
         Returns:
-        True or False
+        See play_track
 
         """
 
+        # Play the track which has been prefetched if it is still there
+        next_track_id = self.next_track_id
+        self.next_track_id = None
+
+        if next_track_id is None or self._find_index_of_track_id(next_track_id) is None:
+            # Obtain the id of the next track to play
+            next_track_id = self.playlist[self._pick_next_track_index()]['id']
+
+        # Play track with that id
+        return self.play_track(next_track_id)
+
+    def _pick_next_track_index(self):
         if self.playtype == PlayType.LINEAR:
             # Index of next track to play
             next_track_index = self.current_track_index + 1
@@ -180,17 +560,13 @@ class MusicPlayer(object):
             # Index of next track to play at random
             next_track_index = random.randrange(0, len(self.playlist), 1)
 
-        # Obtain the id of the next track to play
-        next_track_id = self.playlist[next_track_index]['id']
-
-        # Play track with that id
-        return self.play_track(next_track_id)
+        return next_track_index
 
     def play_previous_track(self):
         """ Play the previous track in the playlist.
 
         Returns:
-        True or False
+        See play_track
 
         """
 
@@ -217,12 +593,50 @@ class MusicPlayer(object):
 
         """
 
-        if self.timer is not None:
-            self.timer.cancel()
+        self._cancel_timer()
+
+        # A track which is still being resolved isn't played anymore
+        self.play_requests += 1
+
+        self.playback.stopped()
 
         if self.player is not None:
             self.player.stop()
 
+    def pause(self):
+        """ Pause or resume playback.
+
+        Returns:
+        True if playback has been paused or resumed. Else False
+
+        """
+
+        if self.playback.position() is None:
+            return False
+
+        self.player.pause()
+
+        if self.playback.is_paused():
+            self.playback.resumed()
+            self._schedule_next_track()
+        else:
+            self.playback.paused()
+            self._cancel_timer()
+
+        return True
+
+    def set_playtype(self, playtype):
+        """ Set the order in which tracks are played.
+
+        Keyword arguments:
+        playtype -- value of a PlayType
+
+        """
+        self.playtype = PlayType(playtype)
+        self.playback.set_playtype(self.playtype.value)
+
+        self._publish(PLAYLIST_EVENT_PLAYTYPE_CHANGED, self.playtype.value)
+
     def play(self):
         """ Start playing current track
 
@@ -233,10 +647,132 @@ class MusicPlayer(object):
         current_track_id = self.playlist[self.current_track_index]
         return self.play_track(current_track_id)
 
-    def _find_index_of_track_id(self, track_id):
+    def request_track_change(self, rpc):
+        """ Begin the trace of a track change a client asked for.
+
+        Keyword arguments:
+        rpc -- name of the RPC
+
+        """
+        self.tracer.request(rpc)
+
+    def traces(self, limit=20):
+        """ Recent track changes and the percentiles of their time to first audio.
+
+        Keyword arguments:
+        limit -- maximum number of traces to return
+
+        Returns:
+        Dict with the traces, newest first, and their summary
+
+        """
+        return {'traces': self.tracer.traces(limit), 'summary': self.tracer.summary()}
+
+    def _resolve_stream_url(self, track):
+        store_id = track.get("storeId")
+
+        # Play a local copy if the track has been played before
+        if self.audio_cache is not None and store_id is not None:
+            cached_path = self.audio_cache.lookup(store_id)
+            if cached_path is not None:
+                return defer.succeed(cached_path)
+
+        # The stream might have been prefetched already
+        if self.stream_proxy is not None and self.stream_proxy.is_buffered(store_id):
+            return defer.succeed(self.stream_proxy.url_for(store_id))
+
+        # Request stream url from google music, ahead of all other calls and hedged against a slow answer
+        d = self.resolver.resolve(self.mobileclient.get_stream_url, store_id, self.deviceid)
+        d.addCallback(self._proxied_url, track)
+        return d
+
+    def _proxied_url(self, stream_url, track):
+        store_id = track.get("storeId")
+
+        # Let mplayer play it through the proxy, which also fills the cache
+        if self.stream_proxy is not None and store_id is not None:
+            self._tune_player_cache()
+            return self.stream_proxy.url_for(store_id, stream_url, self._track_duration(track))
+
+        return stream_url
+
+    def _prefetch_next_track(self):
+        if not self.playlist:
+            return
+
+        # Decide on the next track now
+        track = self.playlist[self._pick_next_track_index()]
+        self.next_track_id = track['id']
+
+        store_id = track.get("storeId")
+        if store_id is None or (self.audio_cache is not None and store_id in self.audio_cache):
+            return
+
+        if not self.stream_proxy.is_buffered(store_id):
+            d = self.scheduler.call(Priority.BACKGROUND, self.mobileclient.get_stream_url, store_id, self.deviceid)
+            d.addCallback(lambda stream_url: self.stream_proxy.prefetch(store_id, stream_url,
+                                                                        self._track_duration(track)))
+            d.addErrback(self._prefetch_failed)
+
+    @staticmethod
+    def _prefetch_failed(failure):
+        # The track is streamed when it's played instead
+        print("prefetching the next track failed: %s" % failure.getErrorMessage())
+
+    def _tune_player_cache(self):
+        # The cache size of a running MPlayer is fixed, so it's adapted for the players to come
+        if self.stream_proxy.buffering is not None:
+            self.player_pool.args = self.stream_proxy.buffering.player_args(self.engine)
+
+    @staticmethod
+    def _track_duration(track):
+        if 'durationMillis' in track:
+            return int(track['durationMillis']) / 1000.0
+        return None
+
+    def _schedule_next_track(self):
+        # Cancel previous timer
+        self._cancel_timer()
+
+        # How many seconds are left of the track
+        remaining = self.playback.duration() - self.playback.position()
+
+        self.timer = reactor.callLater(max(0, remaining), self._advance)
+
+        # Start downloading the next track before this one ends
+        if self.stream_proxy is not None:
+            self.prefetch_timer = reactor.callLater(max(0, remaining - PREFETCH_LEAD), self._prefetch_next_track)
+
+    def _advance(self, attempt=1):
+        # Called by the timer at the end of a track
+        self.timer = None
+        d = defer.maybeDeferred(self.play_next_track)
+        d.addErrback(self._advance_failed, attempt, self.play_requests)
+
+    def _advance_failed(self, failure, attempt, request):
+        print("playing the next track failed: %s" % failure.getErrorMessage())
+        # Nothing to do if another track has been asked for in the meantime
+        if request != self.play_requests or self.timer is not None:
+            return
+        if attempt >= ADVANCE_ATTEMPTS:
+            print("giving up playing the next track after %d attempts" % attempt)
+            return
+        self.timer = reactor.callLater(ADVANCE_RETRY_DELAY, self._advance, attempt + 1)
+
+    def _cancel_timer(self):
+        for timer in (self.timer, self.prefetch_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
+        self.timer = None
+        self.prefetch_timer = None
+
+    def _publish(self, topic, payload):
+        factory.publish(topic, payload)
+
+    def _find_index_of_track_id(self, track_id, tracks=None):
         index = 0
 
-        for track in self.playlist:
+        for track in (tracks if tracks is not None else self.playlist):
             if track['id'] == track_id:
                 return index
             index += 1
@@ -244,118 +780,512 @@ class MusicPlayer(object):
         return None
 
 
+class RpcServerFactory(WampServerFactory):
+
+    def __init__(self, url, musicplayer, event_window=0.05, metrics=None, **kwargs):
+        """
+        Keyword arguments:
+        url -- the websocket url to listen on
+        musicplayer -- the MusicPlayer or, in a worker process, its CoreClient replica
+        event_window -- seconds to collect events for before they are sent
+        metrics -- MetricsRegistry to record the RPCs and events in or None
+
+        """
+        WampServerFactory.__init__(self, url, **kwargs)
+        self.musicplayer = musicplayer
+
+        # Callables(topic, payload) which see every event as it's published
+        self.observers = []
+
+        # Delivers the events to all sessions
+        self.hub = BroadcastHub(self, self._encode_event, COALESCED_TOPICS, SESSION_EVENT_RESYNC)
+
+        # Merges the events of a short window, a track removed right after it was added is never sent
+        self.batcher = EventBatcher(self.hub.publish, event_window, COALESCED_TOPICS,
+                                    (PLAYLIST_EVENT_TRACK_ADDED, PLAYLIST_EVENT_TRACK_REMOVED, lambda track: track['id']))
+
+        self.rpcs = None                    # Timer of the RPCs
+        self.startup = None                 # Startup of this process, RPCs wait for it to be ready
+        if metrics is not None:
+            self.rpcs = metrics.timer('gmusicplayer_rpc', 'RPCs of the websocket clients', ('method',))
+            metrics.collect('gmusicplayer_pubsub', self.hub.stats)
+            metrics.collect('gmusicplayer_batching', self.batcher.stats)
+
+    def publish(self, topic, payload):
+        """ Send an event to all subscribers, encoded for their payload mode.
+
+        Keyword arguments:
+        topic -- the topic uri
+        payload -- the event as plain value
+
+        """
+        self.batcher.add(topic, payload)
+        for observer in self.observers:
+            observer(topic, payload)
+
+    @staticmethod
+    def _encode_event(topic, payload, mode):
+        # Legacy clients get some events as JSON string
+        if mode != PayloadMode.STRUCTURED and topic in JSON_STRING_TOPICS:
+            return json.dumps(payload)
+        return payload
+
+
 class RpcServerProtocol(WampServerProtocol):
 
+    payload_mode = PayloadMode.LEGACY
+    _calls = None                           # Call id -> (method, start time) of the timed RPCs
+
     @exportRpc
-    def search(self, query):
-        result = musicplayer.mobileclient.search_all_access(query, 20)
+    def set_payload_mode(self, mode):
+        """ Choose how results and events are sent to this client.
+
+        Keyword arguments:
+        mode -- value of a PayloadMode
+
+        Returns:
+        The value of the PayloadMode in use, which stays the same if mode is unknown
 
-        return json.dumps(result['song_hits'])
+        """
+        try:
+            self.payload_mode = PayloadMode(mode)
+        except ValueError:
+            pass
+        return self.payload_mode.value
 
     @exportRpc
-    def play(self, track_id):
-        result = dict()
-        result['status'] = musicplayer.play_track(track_id)
+    def search(self, query):
+        return self._result(self.factory.musicplayer.search, query)
 
-        return json.dumps(result)
+    @exportRpc
+    def play(self, track_id):
+        return self._track_change('play', self.factory.musicplayer.play_track, track_id)
 
     @exportRpc
     def get_playlist(self):
-        return json.dumps(musicplayer.playlist)
+        return encode(self.factory.musicplayer.playlist, self.payload_mode)
+
+    @exportRpc
+    def get_playlists(self):
+        return self._result(self.factory.musicplayer.list_playlists)
+
+    @exportRpc
+    def switch_playlist(self, playlist_id):
+        return self._status_result(self.factory.musicplayer.switch_playlist, playlist_id)
 
     @exportRpc
     def play_next_track(self):
-        result = dict()
-        result['status'] = musicplayer.play_next_track()
-        return json.dumps(result)
+        return self._track_change('play_next_track', self.factory.musicplayer.play_next_track)
 
     @exportRpc
     def play_previous_track(self):
-        result = dict()
-        result['status'] = musicplayer.play_previous_track()
-        return json.dumps(result)
+        return self._track_change('play_previous_track', self.factory.musicplayer.play_previous_track)
 
     @exportRpc
     def stop(self):
-        result = dict()
-        result['status'] = True
-
         # Actually stop player
-        musicplayer.stop()
-
-        return json.dumps(result)
+        d = defer.maybeDeferred(self.factory.musicplayer.stop)
+        d.addCallback(lambda _: encode({'status': True}, self.payload_mode))
+        return d
 
     @exportRpc
     def startPlaying(self):
-        result = dict()
-        result['status'] = musicplayer.play()
-        return json.dumps(result)
+        return self._track_change('startPlaying', self.factory.musicplayer.play)
+
+    @exportRpc
+    def pause(self):
+        return self._status_result(self.factory.musicplayer.pause)
 
     @exportRpc
     def get_status(self):
-        status = dict()
+        # Served from the snapshot of the playback state
+        if self.payload_mode == PayloadMode.STRUCTURED:
+            return self.factory.musicplayer.playback.status()
+        return self.factory.musicplayer.playback.snapshot()
 
-        try:
-            current_track_id = musicplayer.playlist.get_current_track_id()
+    @exportRpc
+    def add_to_playlist(self, track_json):
+        # Convert Json to dictionary, structured clients send the track as is
+        track = track_json
+        if not isinstance(track_json, dict):
+            track = json.loads(track_json)
 
-            current_track = musicplayer.playlist.get_track(current_track_id)
+        # Append track to playlist
+        return self.factory.musicplayer.add_track_to_playlist(track)
 
-            status['currentTrack'] = current_track
-        except:
-            pass
+    @exportRpc
+    def remove_from_playlist(self, track_id):
+        return self.factory.musicplayer.remove_track_from_playlist(track_id)
 
-        status['playtype'] = musicplayer.playtype
+    @exportRpc
+    def set_playtype(self, playtype):
+        return self.factory.musicplayer.set_playtype(playtype)
 
-        return json.dumps(status)
+    @exportRpc
+    def get_traces(self, limit=20):
+        return self._result(self.factory.musicplayer.traces, limit)
 
     @exportRpc
-    def add_to_playlist(self, track_json):
-        # Convert Json to dictionary
-        track = json.loads(track_json)
+    def get_startup(self):
+        if self.factory.startup is None:
+            return {'state': 'ready'}
+        return self.factory.startup.report()
 
-        # Append track to playlist
-        musicplayer.add_track_to_playlist(track)
+    @exportRpc
+    def admin_start_profile(self, token, duration=60, interval=0.01):
+        """ Start profiling this process, see AdminTools.
+
+        """
+        self.factory.admin.authorize(token)
+        return self.factory.admin.start_profile(duration, interval)
 
     @exportRpc
-    def remove_from_playlist(self, track_id):
-        return musicplayer.remove_track_from_playlist(track_id)
+    def admin_stop_profile(self, token):
+        self.factory.admin.authorize(token)
+        return self.factory.admin.stop_profile()
 
     @exportRpc
-    def set_playtype(self, playtype):
-        musicplayer.playtype = playtype
-        self.dispatch(PLAYLIST_EVENT_PLAYTYPE_CHANGED, playtype)
+    def admin_memory_snapshot(self, token, limit=25):
+        self.factory.admin.authorize(token)
+        return self.factory.admin.take_snapshot(limit)
+
+    @exportRpc
+    def admin_memory_diff(self, token, first_id, second_id, limit=25):
+        self.factory.admin.authorize(token)
+        return self.factory.admin.diff_snapshots(first_id, second_id, limit)
+
+    @exportRpc
+    def admin_memory_reset(self, token):
+        self.factory.admin.authorize(token)
+        return self.factory.admin.reset_memory()
+
+    def _result(self, f, *args):
+        # The MusicPlayer of the core answers with a Deferred
+        d = defer.maybeDeferred(f, *args)
+        d.addCallback(encode, self.payload_mode)
+        return d
+
+    def _status_result(self, f, *args):
+        d = defer.maybeDeferred(f, *args)
+        d.addCallback(lambda status: encode({'status': status}, self.payload_mode))
+        return d
+
+    def _track_change(self, rpc, f, *args):
+        # The trace of the track change starts with the RPC, a failure to begin it is no reason to fail the RPC
+        defer.maybeDeferred(self.factory.musicplayer.request_track_change, rpc).addErrback(lambda _: None)
+        return self._status_result(f, *args)
 
     def onSessionOpen(self):
         self.registerForPubSub(PLAYLIST_EVENT_TRACK_ADDED)
         self.registerForPubSub(PLAYLIST_EVENT_TRACK_REMOVED)
+        self.registerForPubSub(PLAYLIST_EVENT_TRACKS_ADDED)
+        self.registerForPubSub(PLAYLIST_EVENT_TRACKS_REMOVED)
         self.registerForPubSub(PLAYLIST_EVENT_PLAYTYPE_CHANGED)
+        self.registerForPubSub(PLAYLIST_EVENT_SWITCHED)
         self.registerForPubSub(TRACK_EVENT_PLAYBACK)
+        self.registerForPubSub(TRACK_EVENT_POSITION)
+        self.registerForPubSub(SESSION_EVENT_RESYNC)
 
         self.registerForRpc(self, "musicplayer/music#")
-        factory.forwarder = self
+        self.registerProcedureForRpc(WARMING_UP_URI, self._warming_up)
+        self.factory.hub.attach(self)
+        self._calls = {}
+
+    def onBeforeCall(self, callid, uri, args, isRegistered):
+        method = uri.rpartition('#')[2] if isRegistered else 'unknown'
+        if self.factory.rpcs is not None:
+            self._calls[callid] = (method, self.factory.rpcs.start((method,)))
+        startup = self.factory.startup
+        if isRegistered and startup is not None and not startup.is_ready() and method not in WARMING_UP_CALLS:
+            # The playlist isn't loaded yet
+            uri = WARMING_UP_URI
+        return uri, args
+
+    @staticmethod
+    def _warming_up(*args):
+        raise Exception('the player is warming up, try again in a moment')
+
+    def onAfterCallSuccess(self, result, call):
+        self._call_done(call.callid, False)
+        return result
+
+    def onAfterCallError(self, error, call):
+        self._call_done(call.callid, True)
+        return error
+
+    def _call_done(self, callid, failed):
+        timed = self._calls.pop(callid, None) if self._calls is not None else None
+        if timed is not None:
+            method, started = timed
+            self.factory.rpcs.stop((method,), started, failed)
+
+    def connectionLost(self, reason):
+        self.factory.hub.detach(self)
+        WampServerProtocol.connectionLost(self, reason)
+
+
+def serve_clients(musicplayer, args, stream_proxy=None, shared=False, metrics=None, startup=None):
+    """ Listen for the websocket and web clients.
+
+    Keyword arguments:
+    musicplayer -- the MusicPlayer or its CoreClient replica
+    args -- the parsed command line
+    stream_proxy -- StreamProxy to serve under /stream or None
+    shared -- listen on ports shared with the other worker processes
+    metrics -- MetricsRegistry to serve under /metrics or None
+    startup -- Startup to serve under /startup, which RPCs wait for, or None
+
+    Returns:
+    The RpcServerFactory
+
+    """
+    factory = RpcServerFactory("ws://localhost:%d" % WS_PORT, musicplayer, args.event_window / 1000.0, metrics)
+    factory.protocol = RpcServerProtocol
+    factory.admin = AdminTools(args.admin_token)
+    factory.startup = startup
+    if not enable_compression(factory):
+        print("websocket compression is not supported by this autobahn version")
+
+    root = StaticAssets("web/")
+    report = root.report()
+    print("web ui: %(files)d files, first load %(first)d bytes (%(identity)d uncompressed), repeat load %(repeat)d bytes" % {
+        'files': report['files'],
+        'first': min(report['first_load'].values()),
+        'identity': report['first_load']['identity'],
+        'repeat': min(report['repeat_load'].values())})
+    if stream_proxy is not None:
+        root.putChild('stream', stream_proxy)
+
+    # Now playing and playlist version for clients which don't speak WAMP
+    status = HttpStatus(musicplayer, (PLAYLIST_EVENT_TRACK_ADDED, PLAYLIST_EVENT_TRACK_REMOVED, PLAYLIST_EVENT_SWITCHED,
+                                      SESSION_EVENT_RESYNC))
+    factory.observers.append(status.changed)
+    root.putChild('status', status)
+
+    # Every worker process keeps thumbnails in a directory of its own
+    art_dir = os.path.join(os.path.dirname(args.cache_dir), 'art')
+    if args.worker:
+        art_dir = os.path.join(art_dir, args.worker[1])
+    art = ArtProxy(art_dir)
+    root.putChild('art', art)
+    root.putChild('admin', factory.admin)
+    if startup is not None:
+        root.putChild('startup', startup)
+
+    if metrics is not None:
+        metrics.collect('gmusicplayer_http_status', status.stats)
+        metrics.collect('gmusicplayer_art', art.stats)
+        metrics.collect('gmusicplayer_assets', root.stats)
+        metrics.collect('gmusicplayer_profiler', factory.admin.stats)
+        root.putChild('metrics', metrics)
+    site = server.Site(root)
+
+    if shared:
+        listen_shared(WS_PORT, factory)
+        listen_shared(HTTP_PORT, site)
+    else:
+        listenWS(factory)
+        reactor.listenTCP(HTTP_PORT, site)
 
+    return factory
 
-musicplayer = MusicPlayer()
 
-if __name__ == '__main__':
-    if len(sys.argv) <= 3:
-        print "Usage: Musicplayer.py <username> <password> <playlist_name>"
-        exit()
+def watch_reactor(args, metrics):
+    """ Start logging the calls which block the reactor, unless disabled.
 
-    username = sys.argv[1]
-    password = sys.argv[2]
-    playlist_name = sys.argv[3]
+    Keyword arguments:
+    args -- the parsed command line
+    metrics -- MetricsRegistry to export the lag in
 
-    if musicplayer.login(username, password):
-        musicplayer.load_playlist(playlist_name)
+    Returns:
+    The LagMonitor or None
 
-        factory = WampServerFactory("ws://localhost:9000")
-        factory.protocol = RpcServerProtocol
-        listenWS(factory)
+    """
+    if args.lag_threshold <= 0:
+        return None
+    monitor = LagMonitor(args.lag_threshold / 1000.0, metrics=metrics)
+    metrics.collect('gmusicplayer_reactor', monitor.stats)
+    reactor.callWhenRunning(monitor.start)
+    return monitor
+
+
+def start_worker(args):
+    """ Serve clients from a replica of the state of the core process.
+
+    """
+    client = CoreClient(args.worker[0], PLAYLIST_EVENT_TRACK_ADDED, PLAYLIST_EVENT_TRACK_REMOVED,
+                        PLAYLIST_EVENT_SWITCHED)
+    metrics = MetricsRegistry()
+    watch_reactor(args, metrics)
+
+    def ready(client):
+        # The core may still be warming up, its startup is replicated
+        client.publish = serve_clients(client, args, shared=True, metrics=metrics, startup=client.startup).publish
+
+    def failed(failure):
+        print("worker could not connect to the core: %s" % failure.getErrorMessage())
+        reactor.stop()
 
-        root = static.File("web/")
-        site = server.Site(root)
-        reactor.listenTCP(8080, site)
+    client.connect().addCallbacks(ready, failed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Musicplayer.py')
+    parser.add_argument('username', nargs='?')
+    parser.add_argument('password', nargs='?')
+    parser.add_argument('playlist_name', nargs='?')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='mplayer',
+                        help='playback engine (default: mplayer)')
+    parser.add_argument('--cache-dir', default=os.path.expanduser('~/.gmusicplayer/audio'),
+                        help='directory of the audio cache (default: ~/.gmusicplayer/audio)')
+    parser.add_argument('--cache-size', type=int, default=2048,
+                        help='size of the audio cache in MB, 0 disables it (default: 2048)')
+    parser.add_argument('--event-window', type=int, default=50,
+                        help='milliseconds to collect events for before they are sent, 0 sends them '
+                             'once per reactor iteration (default: 50)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of processes serving the clients, 0 serves them from the player '
+                             'process (default: 0)')
+    parser.add_argument('--core-socket', default=os.path.expanduser('~/.gmusicplayer/core.sock'),
+                        help='socket the worker processes connect to (default: ~/.gmusicplayer/core.sock)')
+    parser.add_argument('--call-rate', type=float, default=10.0,
+                        help='calls per second to Google Music on average, bursts may be twice as many; '
+                             'playback is never held back (default: 10)')
+    parser.add_argument('--playlist-tracks', type=int, default=20000,
+                        help='tracks of all playlists kept in memory for switching, the least recently played '
+                             'playlists are dropped first (default: 20000)')
+    parser.add_argument('--playlist-refresh', type=int, default=300,
+                        help='seconds between two refreshes of the playlists which are not played, 0 disables '
+                             'them (default: 300)')
+    parser.add_argument('--stream-deadline', type=int, default=8000,
+                        help='milliseconds to resolve the stream url of a track in, another track is played '
+                             'if it takes longer (default: 8000)')
+    parser.add_argument('--lag-threshold', type=int, default=250,
+                        help='log the stack of calls which block the reactor for longer than this many ms, '
+                             '0 disables the watchdog (default: 250)')
+    parser.add_argument('--admin-token', default=os.environ.get('GMUSICPLAYER_ADMIN_TOKEN'),
+                        help='token of the admin RPCs and of /admin, e.g. for profiling; without one they are '
+                             'disabled (default: $GMUSICPLAYER_ADMIN_TOKEN)')
+    parser.add_argument('--worker', nargs=2, metavar=('SOCKET', 'INDEX'), help=argparse.SUPPRESS)
+    parser.add_argument('--fake-backend', action='store_true',
+                        help='talk to a local stand-in for Google Music instead, e.g. for load tests')
+    parser.add_argument('--fake-latency', type=int, default=50,
+                        help='median latency of the calls to the fake backend in ms (default: 50)')
+    parser.add_argument('--fake-failure-rate', type=float, default=0.0,
+                        help='fraction of the calls to the fake backend which fail (default: 0)')
+    parser.add_argument('--fake-player', action='store_true',
+                        help='play with a stand-in for the mplayer executable')
+    args = parser.parse_args()
+
+    if args.worker:
+        start_worker(args)
         reactor.run()
+        sys.exit()
+
+    if args.playlist_name is None:
+        parser.error('username, password and playlist_name are required')
+
+    startup = Startup(STARTED)
+    startup.begin('imports', STARTED)
+    startup.end('imports')
+
+    if args.fake_backend:
+        from gmusicplayer.fakes import gmusic
+        from gmusicplayer.fakes.stream_host import FakeStreamHost
+
+        gmusic.configure(latency=args.fake_latency / 1000.0, failure_rate=args.fake_failure_rate,
+                         stream_url='http://127.0.0.1:%d/' % FAKE_STREAM_PORT, playlists={args.playlist_name: 50})
+        MusicPlayer.webclient_class = gmusic.FakeWebclient
+        MusicPlayer.mobileclient_class = gmusic.FakeMobileclient
+        reactor.listenTCP(FAKE_STREAM_PORT, server.Site(FakeStreamHost()), interface='127.0.0.1')
     else:
-        print "login failed"
+        with startup.phase('import gmusicapi'):
+            clients = import_gmusicapi()
+        if clients is None:
+            parser.error('gmusicapi is not installed')
+        MusicPlayer.webclient_class, MusicPlayer.mobileclient_class = clients
+
+    # The playback clock, tracer and buffering controller live on the events of mplayer's stdout
+    Player.events = True
+    if args.fake_player:
+        Player.exec_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'gmusicplayer', 'fakes', 'mplayer_slave.py')
+        with startup.phase('introspect mplayer'):
+            Player.introspect()
+
+    audio_cache = None
+    if args.cache_size > 0:
+        with startup.phase('open audio cache'):
+            audio_cache = AudioCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    # With worker processes the streams are served by this process on a port of its own
+    stream_port = STREAM_PORT if args.workers else HTTP_PORT
+    stream_proxy = StreamProxy('http://127.0.0.1:%d/stream/' % stream_port, audio_cache,
+                               buffering=BufferingController())
+
+    metrics = MetricsRegistry()
+    with startup.phase('create player'):
+        scheduler = CallScheduler(args.call_rate, args.call_rate * 2, metrics=metrics)
+        resolver = HedgedResolver(scheduler, args.stream_deadline / 1000.0)
+        musicplayer = MusicPlayer(args.engine, audio_cache, stream_proxy, metrics, scheduler, resolver,
+                                  PlaylistManager(args.playlist_tracks))
+    metrics.collect('gmusicplayer_scheduler', scheduler.stats)
+    metrics.collect('gmusicplayer_stream_resolution', resolver.stats)
+    metrics.collect('gmusicplayer_playlists', musicplayer.playlists.stats)
+    metrics.collect('gmusicplayer_stream_proxy', stream_proxy.stats)
+    metrics.collect('gmusicplayer_buffering', stream_proxy.buffering.stats)
+    metrics.collect('gmusicplayer_supervisor', musicplayer.supervisor.stats)
+    metrics.collect('gmusicplayer_player_pool', musicplayer.player_pool.stats)
+    metrics.collect('gmusicplayer_tracing', musicplayer.tracer.stats)
+    metrics.collect('gmusicplayer_ttfa', lambda: musicplayer.tracer.summary()['ttfa'])
+    if audio_cache is not None:
+        metrics.collect('gmusicplayer_audio_cache', audio_cache.stats)
+    watch_reactor(args, metrics)
+
+    # Listen right away, until the playlist is loaded the clients are told that the player is warming up
+    with startup.phase('listen'):
+        if args.workers:
+            root = Resource()
+            root.putChild('stream', stream_proxy)
+            root.putChild('metrics', metrics)
+            root.putChild('admin', AdminTools(args.admin_token))
+            root.putChild('startup', startup)
+            reactor.listenTCP(STREAM_PORT, server.Site(root), interface='127.0.0.1')
+
+            # Workers serve the clients, events are replicated to them
+            if args.admin_token:
+                # Workers take the token from the environment, on their command line everybody could read it
+                os.environ['GMUSICPLAYER_ADMIN_TOKEN'] = args.admin_token
+            factory = ClusterCore(musicplayer, args.core_socket, args.workers, worker_command(__file__) + [
+                '--event-window', str(args.event_window), '--lag-threshold', str(args.lag_threshold),
+                '--cache-dir', args.cache_dir, '--worker'], startup=startup, event_window=args.event_window / 1000.0,
+                coalesce=COALESCED_TOPICS, cancel=(PLAYLIST_EVENT_TRACK_ADDED, PLAYLIST_EVENT_TRACK_REMOVED,
+                                                   lambda track: track['id']))
+            factory.start()
+            metrics.collect('gmusicplayer_cluster', factory.stats)
+            metrics.collect('gmusicplayer_cluster_batching', factory.batcher.stats)
+        else:
+            factory = serve_clients(musicplayer, args, stream_proxy, metrics=metrics, startup=startup)
+
+    def ready(_):
+        startup.ready()
+        if args.workers:
+            # The workers get the loaded playlist and stop warming up
+            factory.send_state()
+        # Clients which connected while warming up load the playlist again
+        factory.publish(SESSION_EVENT_RESYNC, None)
+
+        if args.playlist_refresh > 0:
+            musicplayer.refresh_playlists(args.playlist_refresh)
+
+        print(startup.summary())
+
+    def failed(failure):
+        startup.failed(failure.getErrorMessage())
+        print "login failed:", failure.getErrorMessage()
+        reactor.stop()
+
+    sessions = SessionStore(os.path.join(os.path.dirname(args.cache_dir), 'session.json'))
+    warm_up(startup, musicplayer, args.username, args.password, args.playlist_name, sessions).addCallbacks(ready, failed)
+
+    reactor.run()
@@ -0,0 +1,92 @@
+"""Benchmark of the WAMP payload modes for a large get_playlist result.
+
+Compares the legacy mode, where the playlist is serialized to a JSON string
+which WAMP encodes a second time, with the structured mode, where WAMP
+encodes it once. Reports bytes per message with and without
+permessage-deflate and the server side encode time as JSON.
+
+Usage: python bench/payload.py [tracks] [rounds]
+"""
+
+__author__ = 'daniel michels'
+
+import os
+import sys
+import json
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gmusicplayer.payloads import PayloadMode, encode
+
+try:
+    from autobahn.wamp import json_dumps
+except ImportError:
+    json_dumps = json.dumps
+
+# WAMP v1 CALLRESULT message type
+CALL_RESULT = 3
+
+
+def make_playlist(count):
+    """ Returns count tracks shaped like the ones of Google Music.
+
+    """
+    playlist = []
+    for i in range(count):
+        playlist.append({
+            'id': 'a1b2c3d4-0000-4000-8000-%012d' % i,
+            'nid': 'T%026d' % i,
+            'storeId': 'T%026d' % i,
+            'title': 'Track number %d' % i,
+            'artist': 'Artist %d' % (i % 500),
+            'album': 'Album %d' % (i % 1000),
+            'albumArtist': 'Artist %d' % (i % 500),
+            'genre': ('Rock', 'Pop', 'Jazz', 'Electronic')[i % 4],
+            'trackNumber': i % 15 + 1,
+            'discNumber': 1,
+            'year': 1970 + i % 45,
+            'durationMillis': str(180000 + i % 120000),
+            'estimatedSize': str(7200000 + i % 4800000),
+            'albumArtRef': [{'url': 'http://lh3.googleusercontent.com/%040d' % i}],
+            'artistId': ['A%026d' % (i % 500)],
+            'albumId': 'B%026d' % (i % 1000),
+            'kind': 'sj#track'
+        })
+    return playlist
+
+
+def deflated_size(message):
+    # permessage-deflate uses raw deflate streams
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return len(compressor.compress(message) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def measure(playlist, mode, rounds):
+    timings = []
+    for i in range(rounds):
+        started = time.time()
+        message = json_dumps([CALL_RESULT, 'call%d' % i, encode(playlist, mode)])
+        timings.append(time.time() - started)
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
+    timings.sort()
+    return {
+        'bytes': len(message),
+        'bytes_deflate': deflated_size(message),
+        'encode_ms_median': timings[len(timings) // 2] * 1000,
+        'encode_ms_min': timings[0] * 1000
+    }
+
+
+if __name__ == '__main__':
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    playlist = make_playlist(tracks)
+    result = {'tracks': tracks, 'rounds': rounds}
+    for mode in PayloadMode:
+        result[mode.value] = measure(playlist, mode, rounds)
+
+    print(json.dumps(result, indent=2, sort_keys=True))
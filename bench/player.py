@@ -0,0 +1,275 @@
+"""Benchmark of mplayer.Player driving the fake mplayer of gmusicplayer.fakes.
+
+Every measurement runs in a fresh interpreter, once per integration
+(threads, asyncore, gevent), against gmusicplayer/fakes/mplayer_slave.py
+installed as 'mplayer' in a temporary directory on the PATH. Reports as
+JSON:
+
+import -- time to import mplayer with and without introspecting the executable
+spawn -- time to spawn a player, until its first answer and to quit it
+get_property -- round-trip latency percentiles and throughput of property reads
+commands -- throughput of set_property commands written to the player
+dispatch -- rate at which status lines are parsed and dispatched as events
+
+Usage: python bench/player.py [--rounds N] [--latency SECONDS] [--flood LINES] [--output FILE]
+"""
+
+__author__ = 'daniel michels'
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FAKE = os.path.join(ROOT, 'gmusicplayer', 'fakes', 'mplayer_slave.py')
+
+INTEGRATIONS = ('threads', 'asyncore', 'gevent')
+
+# Seconds to wait for a flood to be dispatched
+FLOOD_TIMEOUT = 60
+
+
+def percentiles(samples):
+    """ Returns median, p95, p99 and mean of samples in milliseconds.
+
+    """
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+    return {'p50_ms': at(0.5), 'p95_ms': at(0.95), 'p99_ms': at(0.99),
+            'mean_ms': sum(samples) / len(samples) * 1000}
+
+
+def install_fake(directory):
+    """ Put an 'mplayer' running the fake into directory.
+
+    """
+    path = os.path.join(directory, 'mplayer')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec "{0}" "{1}" "$@"\n'.format(sys.executable, FAKE))
+    os.chmod(path, 0o755)
+
+
+def run_child(child, args, path):
+    """ Run a measurement in a fresh interpreter with the given PATH.
+
+    Returns:
+    The dict printed by the child or a dict describing its failure
+
+    """
+    env = dict(os.environ, PATH=path, PYTHONPATH=ROOT)
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', child] + args,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        lines = err.decode('utf-8', 'ignore').strip().splitlines()
+        return {'error': lines[-1] if lines else 'exit code {0}'.format(proc.returncode)}
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+# Measurements, run in the child processes
+
+def child_import():
+    started = time.time()
+    import mplayer
+    imported = time.time() - started
+    player = mplayer.Player
+    return {
+        'import_ms': imported * 1000,
+        'version': player.version,
+        'properties': len([name for name in dir(player) if isinstance(getattr(player, name), property)])
+    }
+
+
+def player_factory(integration):
+    """ Returns callable(args) creating a started player of an integration or None if unavailable.
+
+    """
+    if integration == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            return None
+        # The waits for answers must not block the hub
+        monkey.patch_all()
+        from mplayer.gevent1 import GeventPlayer
+        return GeventPlayer
+
+    if integration == 'asyncore':
+        import asyncore
+        import importlib
+        from threading import Thread
+        AsyncPlayer = importlib.import_module('mplayer.async').AsyncPlayer
+
+        def create(args):
+            # Every player gets its own map, polled in a thread of its own
+            socket_map = {}
+            player = AsyncPlayer(args, map=socket_map)
+            loop = Thread(target=asyncore.loop, kwargs={'timeout': 0.01, 'use_poll': True, 'map': socket_map})
+            loop.daemon = True
+            loop.start()
+            return player
+
+        return create
+
+    from mplayer import Player
+    return Player
+
+
+def child_integration(integration, rounds, latency, flood):
+    create = player_factory(integration)
+    if create is None:
+        return {'skipped': '{0} is not installed'.format(integration)}
+    from mplayer import EventType, Player
+    from threading import Event
+
+    # The fake prints the flood only with the message levels of the events
+    Player.events = True
+
+    args = ['-fake-latency', str(latency)]
+    result = {}
+
+    # Spawn, first answer, quit
+    spawned, ready, quitted = [], [], []
+    for _ in range(max(1, rounds // 100)):
+        started = time.time()
+        player = create(args)
+        spawned.append(time.time() - started)
+        player.volume
+        ready.append(time.time() - started)
+        started = time.time()
+        player.quit()
+        quitted.append(time.time() - started)
+    result['spawn'] = {
+        'spawn_ms': percentiles(spawned)['p50_ms'],
+        'ready_ms': percentiles(ready)['p50_ms'],
+        'quit_ms': percentiles(quitted)['p50_ms']
+    }
+
+    player = create(args)
+    player.volume
+
+    # Round trips of get_property
+    samples, missing = [], 0
+    started = time.time()
+    for _ in range(rounds):
+        sent = time.time()
+        if player.volume is None:
+            missing += 1
+        samples.append(time.time() - sent)
+    elapsed = time.time() - started
+    result['get_property'] = dict(percentiles(samples), per_second=rounds / elapsed, unanswered=missing)
+
+    # Commands written, then confirmed by the fake
+    count = rounds * 10
+    before = int(player._run_command('get_property', 'fake_commands'))
+    started = time.time()
+    for _ in range(count):
+        player.volume = 50.0
+    written = time.time() - started
+    handled = int(player._run_command('get_property', 'fake_commands')) - before - 1
+    elapsed = time.time() - started
+    result['commands'] = {
+        'written_per_second': count / written,
+        'handled_per_second': count / elapsed,
+        'handled': handled
+    }
+
+    # Status lines parsed and dispatched as events
+    done = Event()
+    events = [0]
+
+    def on_status(event):
+        events[0] += 1
+
+    player.stdout.connect_event(EventType.STATUS, on_status)
+    player.stdout.connect_event(EventType.EOF, lambda event: done.set())
+    started = time.time()
+    player._run_command('flood', str(flood))
+    finished = done.wait(FLOOD_TIMEOUT)
+    elapsed = time.time() - started
+    result['dispatch'] = {
+        'lines': flood,
+        'events': events[0],
+        'events_per_second': events[0] / elapsed,
+        'completed': bool(finished)
+    }
+
+    player.quit()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='player.py')
+    parser.add_argument('--rounds', type=int, default=2000,
+                        help='property reads, ten times as many commands are written (default: 2000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake waits before every answer (default: 0)')
+    parser.add_argument('--flood', type=int, default=200000,
+                        help='status lines for the dispatch rate (default: 200000)')
+    parser.add_argument('--integrations', nargs='+', choices=INTEGRATIONS, default=list(INTEGRATIONS))
+    parser.add_argument('--output', help='also write the results to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        if args.child == 'import':
+            result = child_import()
+        else:
+            result = child_integration(args.child, args.rounds, args.latency, args.flood)
+        print(json.dumps(result))
+        return
+
+    fake_dir = tempfile.mkdtemp(prefix='fake-mplayer-')
+    empty_dir = tempfile.mkdtemp(prefix='no-mplayer-')
+    try:
+        install_fake(fake_dir)
+        result = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {'rounds': args.rounds, 'latency': args.latency, 'flood': args.flood}
+        }
+
+        # Importing without an mplayer on the PATH skips the introspection
+        imports = [run_child('import', [], fake_dir) for _ in range(5)]
+        bare = [run_child('import', [], empty_dir) for _ in range(5)]
+        with_fake = sorted(child['import_ms'] for child in imports if 'import_ms' in child)
+        without = sorted(child['import_ms'] for child in bare if 'import_ms' in child)
+        result['import'] = {
+            'import_ms': with_fake[len(with_fake) // 2] if with_fake else None,
+            'import_without_mplayer_ms': without[len(without) // 2] if without else None,
+            'properties': imports[0].get('properties'),
+            'version': imports[0].get('version'),
+        }
+        if with_fake and without:
+            result['import']['introspection_ms'] = result['import']['import_ms'] - \
+                result['import']['import_without_mplayer_ms']
+
+        result['integrations'] = {}
+        for integration in args.integrations:
+            child_args = ['--rounds', str(args.rounds), '--latency', str(args.latency), '--flood', str(args.flood)]
+            result['integrations'][integration] = run_child(integration, child_args,
+                                                            fake_dir + os.pathsep + os.environ.get('PATH', ''))
+    finally:
+        shutil.rmtree(fake_dir, ignore_errors=True)
+        shutil.rmtree(empty_dir, ignore_errors=True)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
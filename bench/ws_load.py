@@ -0,0 +1,311 @@
+"""End-to-end load test of the websocket server against the fake backend.
+
+Starts MusicPlayer.py with --fake-backend and --fake-player and, for every
+client count, opens that many WAMP sessions. Every session subscribes to
+the events and searches, adds and removes tracks, skips and reads the
+status with random think times in between. Reports as JSON per client
+count:
+
+rpc -- calls, errors and p50/p99 latency per RPC
+fanout -- delay from adding a track until its event reached a session
+server -- CPU used and peak memory of the server process (Linux only)
+driver -- CPU used by this process, near 100% the numbers above are skewed
+
+Usage: python bench/ws_load.py [--clients N ...] [--duration SECONDS] [--think SECONDS]
+"""
+
+__author__ = 'daniel michels'
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+
+from twisted.internet import reactor, defer, task
+from autobahn.websocket import connectWS
+from autobahn.wamp import WampClientFactory, WampClientProtocol
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+URL = 'ws://127.0.0.1:9000'
+RPC = 'musicplayer/music#'
+
+TRACK_ADDED = 'musicplayer/playlist/events/track_added_to_playlist'
+TRACK_REMOVED = 'musicplayer/playlist/events/track_removed_from_playlist'
+TOPICS = (TRACK_ADDED, TRACK_ADDED + '/batch', TRACK_REMOVED, TRACK_REMOVED + '/batch',
+          'musicplayer/playlist/events/playtype_changed', 'musicplayer/events/playback',
+          'musicplayer/events/position', 'musicplayer/events/resync')
+
+# Share of the actions of a session
+ACTIONS = (('search', 0.4), ('get_status', 0.2), ('add_to_playlist', 0.2),
+           ('remove_from_playlist', 0.15), ('play_next_track', 0.05))
+
+QUERIES = ('rock', 'jazz', 'beatles', 'miles davis', 'daft punk', 'live', 'remix', 'piano')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+
+    return {'count': len(samples), 'p50_ms': at(0.5), 'p99_ms': at(0.99), 'max_ms': samples[-1] * 1000}
+
+
+class ProcessMonitor(object):
+    """ CPU time and memory of a process, read from /proc.
+
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self._ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+    def cpu(self):
+        """ Returns the seconds of CPU time used so far or None.
+
+        """
+        try:
+            with open('/proc/{0}/stat'.format(self.pid)) as f:
+                fields = f.read().rpartition(')')[2].split()
+        except IOError:
+            return None
+        return (int(fields[11]) + int(fields[12])) / float(self._ticks)
+
+    def sample(self):
+        try:
+            with open('/proc/{0}/status'.format(self.pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        self.peak_rss = max(self.peak_rss, int(line.split()[1]) * 1024)
+        except IOError:
+            pass
+
+
+class Phase(object):
+    """ Measurements of one client count.
+
+    """
+
+    def __init__(self, clients, think):
+        self.clients = clients
+        self.think = think
+        self.running = False
+        self.sessions = []
+        self.latencies = dict((name, []) for name, _ in ACTIONS)
+        self.errors = dict((name, 0) for name, _ in ACTIONS)
+        self.added = {}                 # Marker -> time the track was added
+        self.fanout = []
+        self.events = 0
+
+    def report(self):
+        rpc = {}
+        for name, samples in self.latencies.items():
+            rpc[name] = dict(percentiles(samples), errors=self.errors[name])
+        return {'clients': self.clients, 'rpc': rpc, 'fanout': percentiles(self.fanout), 'events': self.events,
+                'sessions': len(self.sessions)}
+
+
+class LoadProtocol(WampClientProtocol):
+
+    def onSessionOpen(self):
+        self.tracks = []                # Search hits to add
+        self.own = []                   # Ids of the tracks this session added
+        for topic in TOPICS:
+            self.subscribe(topic, self.on_event)
+        d = self.call(RPC + 'set_payload_mode', 'structured')
+        d.addBoth(lambda _: self.factory.opened(self))
+
+    def on_event(self, topic, event):
+        phase = self.factory.phase
+        phase.events += 1
+        if topic.startswith(TRACK_ADDED):
+            for track in (event if topic.endswith('/batch') else [event]):
+                marker = track.get('benchMarker')
+                if marker in phase.added:
+                    phase.fanout.append(time.time() - phase.added[marker][0])
+                    if phase.added[marker][1] is self:
+                        self.own.append(track['id'])
+
+    def next_action(self):
+        phase = self.factory.phase
+        if phase.running:
+            reactor.callLater(random.expovariate(1.0 / phase.think), self.act)
+
+    def act(self):
+        phase = self.factory.phase
+        if not phase.running:
+            return
+        name = self.pick()
+        args = ()
+        if name == 'search':
+            args = (random.choice(QUERIES),)
+        elif name == 'add_to_playlist':
+            if not self.tracks:
+                name, args = 'search', (random.choice(QUERIES),)
+            else:
+                track = dict(random.choice(self.tracks), benchMarker=uuid.uuid4().hex)
+                phase.added[track['benchMarker']] = (time.time(), self)
+                args = (track,)
+        elif name == 'remove_from_playlist':
+            if not self.own:
+                name = 'get_status'
+            else:
+                args = (self.own.pop(0),)
+
+        started = time.time()
+        d = self.call(RPC + name, *args)
+        d.addCallbacks(self.answered, self.failed, callbackArgs=(name, started), errbackArgs=(name,))
+        d.addBoth(lambda _: self.next_action())
+
+    @staticmethod
+    def pick():
+        value = random.random()
+        for name, share in ACTIONS:
+            value -= share
+            if value < 0:
+                return name
+        return ACTIONS[-1][0]
+
+    def answered(self, result, name, started):
+        self.factory.phase.latencies[name].append(time.time() - started)
+        if name == 'search' and result:
+            self.tracks = [hit['track'] for hit in result]
+
+    def failed(self, failure, name):
+        self.factory.phase.errors[name] += 1
+
+
+class LoadFactory(WampClientFactory):
+
+    protocol = LoadProtocol
+
+    def __init__(self, url, phase):
+        WampClientFactory.__init__(self, url)
+        self.phase = phase
+        self.ready = defer.Deferred()
+
+    def opened(self, proto):
+        self.phase.sessions.append(proto)
+        if len(self.phase.sessions) >= self.phase.clients and not self.ready.called:
+            self.ready.callback(None)
+
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+@defer.inlineCallbacks
+def run_phase(clients, duration, think, server):
+    phase = Phase(clients, think)
+    factory = LoadFactory(URL, phase)
+
+    # Connect in small batches, the listen backlog of the server is short
+    for i in range(clients):
+        connectWS(factory)
+        if i % 50 == 49:
+            yield sleep(0.05)
+    timeout = reactor.callLater(30 + clients / 20.0, lambda: factory.ready.called or factory.ready.callback(None))
+    yield factory.ready
+    if timeout.active():
+        timeout.cancel()
+
+    server_cpu, driver_cpu, started = server.cpu(), sum(os.times()[:2]), time.time()
+    sampler = task.LoopingCall(server.sample)
+    sampler.start(0.5)
+
+    phase.running = True
+    for proto in phase.sessions:
+        proto.next_action()
+    yield sleep(duration)
+    phase.running = False
+
+    # Let the calls in flight finish
+    yield sleep(min(2.0, think * 2))
+    sampler.stop()
+    elapsed = time.time() - started
+
+    report = phase.report()
+    server_used = server.cpu()
+    report['server'] = {
+        'cpu_percent': (server_used - server_cpu) / elapsed * 100 if server_used is not None else None,
+        'peak_rss_bytes': server.peak_rss or None
+    }
+    report['driver'] = {'cpu_percent': (sum(os.times()[:2]) - driver_cpu) / elapsed * 100}
+
+    for proto in phase.sessions:
+        proto.sendClose()
+    yield sleep(1.0)
+    defer.returnValue(report)
+
+
+def start_server(args):
+    cache_dir = tempfile.mkdtemp(prefix='ws-load-')
+    command = [sys.executable, os.path.join(ROOT, 'MusicPlayer.py'), '--fake-backend', '--fake-player',
+               '--fake-latency', str(args.backend_latency), '--cache-dir', os.path.join(cache_dir, 'audio'),
+               'load', 'test', 'load test']
+    devnull = open(os.devnull, 'w')
+    proc = subprocess.Popen(command, cwd=ROOT, stdout=devnull, stderr=devnull)
+
+    # Wait for the websocket port
+    deadline = time.time() + 30
+    while time.time() < deadline and proc.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', 9000), 1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('the server did not start')
+
+
+@defer.inlineCallbacks
+def run(args, server, results):
+    try:
+        for clients in args.clients:
+            report = yield run_phase(clients, args.duration, args.think, server)
+            results.append(report)
+    finally:
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='ws_load.py')
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 100, 1000],
+                        help='numbers of concurrent sessions (default: 10 100 1000)')
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='seconds every client count runs for (default: 20)')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='mean seconds a session waits between two calls (default: 1)')
+    parser.add_argument('--backend-latency', type=int, default=50,
+                        help='median latency of the fake Google Music in ms (default: 50)')
+    parser.add_argument('--output', help='also write the results to this file')
+    args = parser.parse_args()
+
+    proc = start_server(args)
+    results = []
+    try:
+        reactor.callWhenRunning(run, args, ProcessMonitor(proc.pid), results)
+        reactor.run()
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    output = json.dumps({'settings': vars(args), 'phases': results}, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
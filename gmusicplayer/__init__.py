@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+"""Building blocks of the MusicPlayer server
+
+Modules:
+
+artproxy -- album art resized to thumbnails and cached
+assets -- precompressed, fingerprinted static files of the web UI
+audiocache -- on-disk LRU cache of audio streams
+batching -- merges the events of a short window into batches
+buffering -- sizes the buffering of streams by the measured throughput
+cluster -- player core process and the worker processes serving the clients
+hedging -- deadline and hedged duplicate requests for the stream urls
+hub -- fan-out of the events to the WAMP sessions
+httpstatus -- now playing and playlist version over plain HTTP, long-poll and SSE
+lagmonitor -- watchdog of the reactor which logs the calls blocking it
+metrics -- latency histograms and counters in the Prometheus text format
+mpv -- Player replacement which drives mpv over its JSON IPC
+payloads -- encoding of the WAMP payloads
+playback -- server-side model of the playback state
+playlists -- LRU of the loaded playlists with their cursor and play type
+profiling -- on-demand sampling profiler and memory snapshots for admins
+scheduler -- priority classes and rate limiting of the calls to Google Music
+startup -- concurrent logins, stored device ids and timing of the startup phases
+streamproxy -- local read-ahead proxy for the streams played by MPlayer
+supervisor -- replaces a crashed MPlayer process and restores playback
+tracing -- time to first audio of the track changes
+"""
+
+__author__ = 'daniel michels'
@@ -0,0 +1,239 @@
+__author__ = 'daniel michels'
+
+import hashlib
+from io import BytesIO
+from collections import OrderedDict
+
+try:
+    from urllib2 import urlopen
+    from urlparse import urlparse
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.parse import urlparse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from twisted.internet import threads, defer
+from twisted.web import resource, server
+
+from gmusicplayer.audiocache import FileCache
+
+
+class _ThumbnailStore(FileCache):
+    """ The on-disk part of the thumbnail cache, with a budget of its own.
+
+    """
+
+    SUFFIX = '.img'
+
+
+class ArtProxy(resource.Resource):
+    """ Serves album art resized to the thumbnail sizes used by the web UI.
+
+    Requests look like '/art/<size>?u=<url of the original image>'. Every
+    original is downloaded once, even if several clients ask for it at the
+    same time, and resized to the requested size. The thumbnails are kept in
+    a small in-memory LRU backed by a bounded directory on disk and served
+    with an ETag and headers that let browsers cache them for good.
+
+    Without PIL (pip install Pillow) the images are served unchanged, but
+    still cached, and a warning is logged on startup.
+
+    """
+
+    isLeaf = True
+
+    # Sizes in pixels the UI asks for, doubled for high resolution displays
+    SIZES = (34, 68, 120, 240)
+
+    # Hosts album art is served from
+    ALLOWED_HOSTS = ('googleusercontent.com', 'ggpht.com')
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, memory_bytes=4 * 1024 * 1024, quality=85):
+        """
+        Keyword arguments:
+        directory -- directory to keep the thumbnails in
+        max_bytes -- total size of the thumbnails on disk
+        memory_bytes -- total size of the thumbnails kept in memory
+        quality -- JPEG quality of the thumbnails
+
+        """
+        resource.Resource.__init__(self)
+        self.memory_bytes = memory_bytes
+        self.quality = quality
+        self._store = _ThumbnailStore(directory, max_bytes)
+        self._memory = OrderedDict()    # key -> (data, content type, etag), least recently used first
+        self._memory_size = 0
+        self._pending = {}              # key -> Deferreds waiting for the thumbnail
+        self._stats = {
+            'requests': 0,
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'fetches': 0,               # Originals downloaded
+            'joined': 0,                # Requests which waited for a download in progress
+            'errors': 0,
+            'not_modified': 0,          # Requests answered with 304
+            'bytes_fetched': 0,         # Bytes of the originals
+            'bytes_served': 0
+        }
+        if Image is None:
+            print("WARNING: PIL is not installed, album art is served at full size (pip install Pillow)")
+
+    def stats(self):
+        """ Returns a dict of counters describing the cache's performance.
+
+        """
+        stats = dict(self._stats)
+        stats['memory_entries'] = len(self._memory)
+        stats['memory_size'] = self._memory_size
+        stats['disk'] = self._store.stats()
+        return stats
+
+    def render_GET(self, request):
+        self._stats['requests'] += 1
+        url = request.args.get(b'u', [None])[0]
+        try:
+            size = int(request.postpath[0])
+        except (IndexError, ValueError):
+            size = None
+        if size not in self.SIZES or not self._allowed(url):
+            request.setResponseCode(400)
+            return b''
+
+        key = hashlib.sha1('{0}:{1}'.format(size, url).encode('utf-8')).hexdigest()
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._stats['memory_hits'] += 1
+            self._memory[key] = self._memory.pop(key)
+            return self._render(request, entry)
+
+        # Clients which went away before the thumbnail is ready are not answered
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        d = self._get(key, url, size)
+        d.addCallback(self._respond, request, gone)
+        d.addErrback(self._failed, request, gone)
+        return server.NOT_DONE_YET
+
+    def _allowed(self, url):
+        if not url:
+            return False
+        parsed = urlparse(url)
+        host = parsed.hostname or ''
+        return parsed.scheme in ('http', 'https') and \
+            any(host == allowed or host.endswith('.' + allowed) for allowed in self.ALLOWED_HOSTS)
+
+    def _get(self, key, url, size):
+        # Join a download which is already in progress
+        if key in self._pending:
+            self._stats['joined'] += 1
+            d = defer.Deferred()
+            self._pending[key].append(d)
+            return d
+
+        d = defer.Deferred()
+        self._pending[key] = [d]
+
+        path = self._store.lookup(key)
+        if path is not None:
+            self._stats['disk_hits'] += 1
+            loading = threads.deferToThread(self._read, path)
+        else:
+            self._stats['fetches'] += 1
+            loading = threads.deferToThread(self._fetch, url, size, self._store.begin(key))
+            loading.addCallbacks(self._fetched, self._fetch_failed, callbackArgs=(key,), errbackArgs=(key,))
+        loading.addCallback(self._loaded, key)
+        loading.addErrback(self._load_failed, key)
+        return d
+
+    def _read(self, path):
+        # Runs in a thread
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _fetch(self, url, size, path):
+        # Runs in a thread: download, resize and store a thumbnail
+        original = urlopen(url, timeout=30).read()
+        data = self._resize(original, size)
+        if path is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return len(original), data
+
+    def _resize(self, original, size):
+        if Image is None:
+            return original
+        image = Image.open(BytesIO(original))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((size, size), Image.ANTIALIAS if hasattr(Image, 'ANTIALIAS') else Image.LANCZOS)
+        out = BytesIO()
+        image.save(out, 'JPEG', quality=self.quality, optimize=True)
+        return out.getvalue()
+
+    def _fetched(self, result, key):
+        original_size, data = result
+        self._stats['bytes_fetched'] += original_size
+        self._store.commit(key, len(data))
+        return data
+
+    def _fetch_failed(self, failure, key):
+        self._store.abort(key)
+        return failure
+
+    def _loaded(self, data, key):
+        entry = (data, self._content_type(data), '"{0}"'.format(hashlib.sha1(data).hexdigest()))
+        self._remember(key, entry)
+        for d in self._pending.pop(key, ()):
+            d.callback(entry)
+
+    def _load_failed(self, failure, key):
+        self._stats['errors'] += 1
+        for d in self._pending.pop(key, ()):
+            d.errback(failure)
+
+    def _remember(self, key, entry):
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key)[0])
+        self._memory[key] = entry
+        self._memory_size += len(entry[0])
+        while self._memory_size > self.memory_bytes and self._memory:
+            self._memory_size -= len(self._memory.popitem(last=False)[1][0])
+
+    @staticmethod
+    def _content_type(data):
+        if data.startswith(b'\x89PNG'):
+            return b'image/png'
+        if data[:6] in (b'GIF87a', b'GIF89a'):
+            return b'image/gif'
+        return b'image/jpeg'
+
+    def _respond(self, entry, request, gone):
+        if gone:
+            return
+        data = self._render(request, entry)
+        if data:
+            request.write(data)
+        request.finish()
+
+    def _render(self, request, entry):
+        data, content_type, etag = entry
+        request.setHeader(b'etag', etag)
+        request.setHeader(b'cache-control', b'public, max-age=31536000, immutable')
+        if request.getHeader('if-none-match') == etag:
+            self._stats['not_modified'] += 1
+            request.setResponseCode(304)
+            return b''
+        request.setHeader(b'content-type', content_type)
+        self._stats['bytes_served'] += len(data)
+        return data
+
+    def _failed(self, failure, request, gone):
+        if gone:
+            return
+        request.setResponseCode(502)
+        request.finish()
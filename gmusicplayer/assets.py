@@ -0,0 +1,304 @@
+__author__ = 'daniel michels'
+
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+import posixpath
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from twisted.web import resource
+
+
+# Content types mimetypes doesn't know on every platform
+_CONTENT_TYPES = {
+    '.css': 'text/css',
+    '.js': 'application/javascript',
+    '.html': 'text/html; charset=utf-8',
+    '.svg': 'image/svg+xml',
+    '.woff': 'application/font-woff',
+    '.ttf': 'application/x-font-ttf',
+    '.eot': 'application/vnd.ms-fontobject',
+    '.ico': 'image/x-icon'
+}
+
+# Extensions worth compressing
+_COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.ttf', '.eot', '.ico', '.json', '.txt')
+
+_CSS_URL = re.compile(r'''url\((['"]?)([^'")]+)\1\)''')
+_HTML_REF = re.compile(r'''(src|href)=(["'])([^"']+)\2''')
+
+
+class _Asset(object):
+
+    def __init__(self, path, data):
+        self.path = path                # Path relative to the web root
+        self.url = path                 # Fingerprinted path
+        self.content_type = _content_type(path)
+        self.etag = None
+        self.variants = {}              # Content encoding -> bytes
+        self.set_data(data)
+
+    def set_data(self, data):
+        self.variants = {'identity': data}
+        digest = hashlib.sha1(data).hexdigest()
+        self.etag = '"{0}"'.format(digest)
+        name, ext = posixpath.splitext(self.path)
+        self.url = '{0}.{1}{2}'.format(name, digest[:10], ext)
+
+    def compress(self, min_size):
+        data = self.variants['identity']
+        if len(data) < min_size or posixpath.splitext(self.path)[1] not in _COMPRESSIBLE:
+            return
+        out = BytesIO()
+        f = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9, mtime=0)
+        f.write(data)
+        f.close()
+        self._add_variant('gzip', out.getvalue())
+        if brotli is not None:
+            self._add_variant('br', brotli.compress(data))
+
+    def _add_variant(self, encoding, data):
+        # Only worth it if it saves something
+        if len(data) < len(self.variants['identity']) * 0.95:
+            self.variants[encoding] = data
+
+    def negotiate(self, accept_encoding):
+        """ Returns the encoding to send for an Accept-Encoding header.
+
+        """
+        accepted = _parse_accept_encoding(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted.get(encoding, 0) > 0:
+                return encoding
+        return 'identity'
+
+
+class StaticAssets(resource.Resource):
+    """ Serves the web UI from memory with precompressed, fingerprinted assets.
+
+    All files below the directory are read once at startup. Unminified files
+    with a minified twin (e.g. bootstrap.css next to bootstrap.min.css) are
+    skipped. Every asset gets a url containing a hash of its content, and the
+    references in the stylesheets and in index.html are rewritten to these
+    urls, so they can be cached by browsers forever. gzip (and brotli, if
+    the module is installed) variants are computed upfront and picked by the
+    Accept-Encoding of the request.
+
+    Children added with putChild() take precedence over the files.
+
+    """
+
+    INDEX = 'index.html'
+
+    def __init__(self, directory, compress_min=256):
+        """
+        Keyword arguments:
+        directory -- the web root
+        compress_min -- files smaller than this many bytes are sent uncompressed
+
+        """
+        resource.Resource.__init__(self)
+        self.directory = directory
+        self.compress_min = compress_min
+        self.skipped = []               # Paths of the duplicates which aren't served
+        self._assets = {}               # Path or fingerprinted path -> _Asset
+        self._stats = {
+            'requests': 0,
+            'not_modified': 0,
+            'not_found': 0,
+            'bytes_served': 0,
+            'bytes_saved': 0            # Bytes saved by sending compressed variants
+        }
+        self._load()
+
+    def getChild(self, path, request):
+        if path == b'':
+            path = self.INDEX
+        full = '/'.join([path] + request.postpath)
+        asset = self._assets.get(full)
+        return _AssetResource(self, asset, asset is not None and asset.url == full)
+
+    def report(self):
+        """ Returns the bytes a browser downloads for the page by encoding.
+
+        'first_load' counts index.html, every script and stylesheet it
+        references and the woff fonts the stylesheets reference. On a
+        'repeat_load' only index.html is revalidated, everything else is
+        cached by the browser.
+
+        """
+        index = self._assets.get(self.INDEX)
+        if index is None:
+            return {}
+        page = [index]
+        for ref in _HTML_REF.findall(index.variants['identity'].decode('utf-8')):
+            asset = self._assets.get(ref[2])
+            if asset is not None and asset not in page:
+                page.append(asset)
+        for asset in list(page):
+            if asset.path.endswith('.css'):
+                base = posixpath.dirname(asset.path)
+                for quote, ref in _CSS_URL.findall(asset.variants['identity'].decode('utf-8')):
+                    font = self._assets.get(posixpath.normpath(posixpath.join(base, _strip_query(ref))))
+                    if font is not None and font.path.endswith('.woff') and font not in page:
+                        page.append(font)
+
+        report = {'files': len(page), 'first_load': {}, 'repeat_load': {}}
+        for encoding in ('identity', 'gzip', 'br'):
+            if encoding == 'br' and brotli is None:
+                continue
+            report['first_load'][encoding] = sum(len(a.variants.get(encoding, a.variants['identity'])) for a in page)
+            report['repeat_load'][encoding] = len(index.variants.get(encoding, index.variants['identity']))
+        return report
+
+    def stats(self):
+        """ Returns a dict of counters describing the served assets.
+
+        """
+        stats = dict(self._stats)
+        stats['assets'] = len(set(self._assets.values()))
+        stats['skipped'] = len(self.skipped)
+        return stats
+
+    def _load(self):
+        # Read all files
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                path = os.path.relpath(full, self.directory).replace(os.sep, '/')
+                with open(full, 'rb') as f:
+                    files[path] = f.read()
+
+        # Skip unminified files which have a minified twin
+        for path in sorted(files):
+            name, ext = posixpath.splitext(path)
+            if ext in ('.css', '.js') and not name.endswith('.min') and name + '.min' + ext in files:
+                self.skipped.append(path)
+                del files[path]
+
+        assets = dict((path, _Asset(path, data)) for path, data in files.items())
+
+        # Stylesheets reference other assets, so their hash depends on the rewritten content
+        for asset in assets.values():
+            if asset.path.endswith('.css'):
+                asset.set_data(self._rewrite_css(asset, assets))
+
+        # index.html is served under its own name, with all references fingerprinted
+        index = assets.get(self.INDEX)
+        if index is not None:
+            index.set_data(self._rewrite_html(index, assets))
+            index.url = None
+
+        for asset in assets.values():
+            asset.compress(self.compress_min)
+            self._assets[asset.path] = asset
+            if asset.url is not None:
+                self._assets[asset.url] = asset
+
+    @staticmethod
+    def _rewrite_css(css, assets):
+        base = posixpath.dirname(css.path)
+
+        def replace(match):
+            quote, ref = match.groups()
+            path = _strip_query(ref)
+            asset = assets.get(posixpath.normpath(posixpath.join(base, path)))
+            if asset is None or ref.startswith('data:'):
+                return match.group(0)
+            url = posixpath.relpath(asset.url, base) + ref[len(path):]
+            return 'url({0}{1}{0})'.format(quote, url)
+
+        text = css.variants['identity'].decode('utf-8')
+        return _CSS_URL.sub(replace, text).encode('utf-8')
+
+    @staticmethod
+    def _rewrite_html(html, assets):
+        def replace(match):
+            attribute, quote, ref = match.groups()
+            asset = assets.get(ref)
+            if asset is None or asset is html:
+                return match.group(0)
+            return '{0}={1}{2}{1}'.format(attribute, quote, asset.url)
+
+        text = html.variants['identity'].decode('utf-8')
+        return _HTML_REF.sub(replace, text).encode('utf-8')
+
+
+class _AssetResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, assets, asset, fingerprinted):
+        resource.Resource.__init__(self)
+        self.assets = assets
+        self.asset = asset
+        self.fingerprinted = fingerprinted
+
+    def render_GET(self, request):
+        stats = self.assets._stats
+        stats['requests'] += 1
+        asset = self.asset
+        if asset is None:
+            stats['not_found'] += 1
+            request.setResponseCode(404)
+            return b''
+
+        request.setHeader(b'etag', asset.etag)
+        request.setHeader(b'vary', b'Accept-Encoding')
+        if self.fingerprinted:
+            # The url changes with the content
+            request.setHeader(b'cache-control', b'public, max-age=31536000, immutable')
+        else:
+            request.setHeader(b'cache-control', b'no-cache')
+
+        if request.getHeader('if-none-match') == asset.etag:
+            stats['not_modified'] += 1
+            request.setResponseCode(304)
+            return b''
+
+        encoding = asset.negotiate(request.getHeader('accept-encoding'))
+        data = asset.variants[encoding]
+        if encoding != 'identity':
+            request.setHeader(b'content-encoding', encoding)
+        request.setHeader(b'content-type', asset.content_type)
+        stats['bytes_served'] += len(data)
+        stats['bytes_saved'] += len(asset.variants['identity']) - len(data)
+        return data
+
+
+def _content_type(path):
+    ext = posixpath.splitext(path)[1]
+    if ext in _CONTENT_TYPES:
+        return _CONTENT_TYPES[ext]
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def _strip_query(ref):
+    # e.g. '../fonts/glyphicons-halflings-regular.eot?#iefix'
+    for separator in ('?', '#'):
+        ref = ref.partition(separator)[0]
+    return ref
+
+
+def _parse_accept_encoding(header):
+    accepted = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                pass
+        if name:
+            accepted[name.lower()] = quality
+    return accepted
@@ -0,0 +1,225 @@
+__author__ = 'daniel michels'
+
+import os
+import re
+from collections import OrderedDict
+
+
+class FileCache(object):
+    """ Byte-bounded on-disk LRU cache of files keyed by a string.
+
+    Files are written to '<key>.part' (see begin()) and renamed to
+    '<key><SUFFIX>' only once the number of bytes matches the announced
+    length, so a file with the final name is always complete. Partial files
+    found on startup are deleted. The least recently used files are evicted
+    once the total size exceeds max_bytes. Keys which don't match
+    KEY_PATTERN, e.g. containing a '/', are never cached, as they end up in
+    the file names.
+
+    """
+
+    SUFFIX = '.bin'
+    PART_SUFFIX = '.part'
+    KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]+\Z')
+
+    def __init__(self, directory, max_bytes):
+        """
+        Keyword arguments:
+        directory -- directory to keep the files in
+        max_bytes -- total size of all cached files
+
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0                   # Total size of all cached files
+        self._entries = OrderedDict()   # key -> size, least recently used first
+        self._downloads = set()         # keys which are being written
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'discarded': 0,             # Partial or corrupt files thrown away
+            'rejected': 0,              # Lookups and writes of invalid keys
+            'bytes_downloaded': 0,      # Bytes of all files added to the cache
+            'bytes_served': 0           # Bytes read from disk instead of the network
+        }
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._scan()
+
+    def __contains__(self, key):
+        return self.valid(key) and key in self._entries
+
+    def valid(self, key):
+        """ Whether key may be used as the name of a file.
+
+        """
+        try:
+            return self.KEY_PATTERN.match(key) is not None
+        except TypeError:
+            return False
+
+    def path(self, key):
+        if not self.valid(key):
+            raise ValueError('invalid key {0!r}'.format(key))
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def lookup(self, key):
+        """ Returns the path of a cached file or None.
+
+        Keyword arguments:
+        key -- the key of the file
+
+        """
+        if not self.valid(key):
+            self._stats['rejected'] += 1
+            return None
+        size = self._entries.get(key)
+        path = self.path(key)
+
+        # The file must still be there and have the size it was committed with
+        if size is not None and not self._intact(path, size):
+            self._remove(key)
+            self._stats['discarded'] += 1
+            size = None
+
+        if size is None:
+            self._stats['misses'] += 1
+            return None
+
+        # Mark as most recently used
+        self._entries[key] = self._entries.pop(key)
+        os.utime(path, None)
+
+        self._stats['hits'] += 1
+        self._stats['bytes_served'] += size
+        return path
+
+    def begin(self, key):
+        """ Announce that a file is going to be written to the cache.
+
+        Keyword arguments:
+        key -- the key of the file
+
+        Returns:
+        The path to write the file to or None if it's cached, being written already or key is invalid
+
+        """
+        if not self.valid(key):
+            self._stats['rejected'] += 1
+            return None
+        if key in self._entries or key in self._downloads:
+            return None
+        self._downloads.add(key)
+        return self.path(key) + self.PART_SUFFIX
+
+    def abort(self, key):
+        """ Throw away a file which couldn't be written completely.
+
+        """
+        self._downloads.discard(key)
+        self._discard_part(key)
+        self._stats['discarded'] += 1
+
+    def commit(self, key, size):
+        """ Add a completely written '<key>.part' file to the cache.
+
+        Keyword arguments:
+        key -- the key of the file
+        size -- the expected size of the file
+
+        Returns:
+        True if the file was complete and has been added. Else False
+
+        """
+        self._downloads.discard(key)
+
+        part = self.path(key) + self.PART_SUFFIX
+        if not self._intact(part, size):
+            self._discard_part(key)
+            self._stats['discarded'] += 1
+            return False
+
+        os.rename(part, self.path(key))
+
+        if key in self._entries:
+            self.size -= self._entries.pop(key)
+        self._entries[key] = size
+        self.size += size
+        self._stats['bytes_downloaded'] += size
+        self._evict()
+        return True
+
+    def stats(self):
+        """ Returns a dict of counters describing the cache's performance.
+
+        """
+        stats = dict(self._stats)
+        stats['entries'] = len(self._entries)
+        stats['size'] = self.size
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else None
+        return stats
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def _discard_part(self, key):
+        try:
+            os.remove(self.path(key) + self.PART_SUFFIX)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _intact(path, size):
+        try:
+            return os.path.getsize(path) == size
+        except OSError:
+            return False
+
+    def _scan(self):
+        # Rebuild the index from the directory, oldest files first
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(self.PART_SUFFIX):
+                # Left over from an interrupted download
+                os.remove(path)
+                self._stats['discarded'] += 1
+            elif name.endswith(self.SUFFIX) and self.valid(name[:-len(self.SUFFIX)]):
+                files.append((os.path.getmtime(path), name[:-len(self.SUFFIX)], os.path.getsize(path)))
+        for mtime, key, size in sorted(files):
+            self._entries[key] = size
+            self.size += size
+        self._evict()
+
+
+class AudioCache(FileCache):
+    """ Byte-bounded on-disk LRU cache of audio streams keyed by storeId.
+
+    Streams are written to '<storeId>.part' while they are downloaded and
+    renamed to '<storeId>.mp3' once complete, see FileCache.
+
+    """
+
+    SUFFIX = '.mp3'
+
+    def __init__(self, directory, max_bytes=2 * 1024 ** 3):
+        """
+        Keyword arguments:
+        directory -- directory to keep the streams in
+        max_bytes -- total size of all cached streams
+
+        """
+        FileCache.__init__(self, directory, max_bytes)
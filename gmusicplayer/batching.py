@@ -0,0 +1,136 @@
+__author__ = 'daniel michels'
+
+from twisted.internet import reactor
+
+
+def batch_topic(topic):
+    """ Returns the topic a batch of events of topic is published on.
+
+    """
+    return topic + '/batch'
+
+
+def unbatch(topic, payload):
+    """ Returns the events of what an EventBatcher published as [(topic, payload)].
+
+    """
+    suffix = batch_topic('')
+    if topic.endswith(suffix):
+        return [(topic[:-len(suffix)], event) for event in payload]
+    return [(topic, payload)]
+
+
+class EventBatcher(object):
+    """ Collects events for a short window and publishes them in batches.
+
+    The events are kept in the order they came in, as runs of consecutive
+    events of the same topic. Of a run of a coalesced topic only the latest
+    event is published. An event of the add topic followed by the removal of
+    the same item in the same window cancel out and neither is published. A
+    run of a single event is published as is, a longer one as one list on
+    the batch topic of its topic (see batch_topic()).
+
+    """
+
+    def __init__(self, publish, window=0.05, coalesce=(), cancel=None, max_events=500):
+        """
+        Keyword arguments:
+        publish -- callable(topic, payload) to publish an event or a batch
+        window -- seconds to collect events for, 0 flushes once per reactor iteration
+        coalesce -- topics of which only the latest event is published
+        cancel -- (add topic, remove topic, key) where key(added payload) returns the
+                  payload of the removal of that item, or None
+        max_events -- number of collected events which trigger an early flush
+
+        """
+        self.publish = publish
+        self.window = window
+        self.coalesce = frozenset(coalesce)
+        self.cancel = cancel
+        self.max_events = max_events
+        self._pending = []              # [topic, events] runs, in the order the events came in
+        self._count = 0
+        self._call = None
+        self._stats = {
+            'events': 0,                # Events added
+            'coalesced': 0,             # Events replaced by a later one
+            'cancelled': 0,             # Events dropped because an add and a remove cancelled out
+            'messages': 0,              # Single events and batches published
+            'batches': 0,
+            'flushes': 0
+        }
+
+    def add(self, topic, payload):
+        """ Queue an event for the next flush.
+
+        """
+        self._stats['events'] += 1
+
+        if self._cancels(topic, payload):
+            return
+
+        run = self._pending[-1] if self._pending else None
+        if run is None or run[0] != topic:
+            self._pending.append([topic, [payload]])
+            self._count += 1
+        elif topic in self.coalesce:
+            run[1][-1] = payload
+            self._stats['coalesced'] += 1
+        else:
+            run[1].append(payload)
+            self._count += 1
+
+        if self._count >= self.max_events:
+            self.flush()
+        elif self._call is None:
+            self._call = reactor.callLater(self.window, self.flush)
+
+    def flush(self):
+        """ Publish all collected events now.
+
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        pending, self._pending = self._pending, []
+        self._count = 0
+        if not pending:
+            return
+        self._stats['flushes'] += 1
+
+        for topic, events in pending:
+            self._stats['messages'] += 1
+            if len(events) == 1:
+                self.publish(topic, events[0])
+            else:
+                self._stats['batches'] += 1
+                self.publish(batch_topic(topic), events)
+
+    def stats(self):
+        """ Returns a dict of counters describing the batching.
+
+        """
+        stats = dict(self._stats)
+        stats['pending'] = self._count
+        return stats
+
+    def _cancels(self, topic, payload):
+        # Drop the removal of an item which has been added in this window
+        if self.cancel is None:
+            return False
+        add_topic, remove_topic, key = self.cancel
+        if topic != remove_topic:
+            return False
+        for run in self._pending:
+            if run[0] != add_topic:
+                continue
+            for index, event in enumerate(run[1]):
+                if key(event) == payload:
+                    del run[1][index]
+                    if not run[1]:
+                        self._pending.remove(run)
+                    self._count -= 1
+                    self._stats['cancelled'] += 2
+                    return True
+        return False
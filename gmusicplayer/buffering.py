@@ -0,0 +1,197 @@
+__author__ = 'daniel michels'
+
+from mplayer import EventType
+from twisted.internet import reactor
+
+
+class BufferingController(object):
+    """ Picks how much of a stream to buffer before playback starts.
+
+    The controller keeps a moving average of the download throughput of the
+    streams in the StreamProxy. For every track it compares that throughput
+    with the bitrate of the track: on a fast link only a small prefill is
+    needed to start playing, on a slow one enough is buffered upfront that
+    the download never falls behind playback. It also sizes mplayer's own
+    cache and counts stalls. A stall of the proxy, i.e. a reader waiting for
+    the download, is only audible if it lasts longer than the player's cache
+    holds audio for, so those are counted as stalls of the player. That
+    takes a player spawned with the cache arguments of player_args(), the
+    stalls of others aren't classified.
+
+    """
+
+    # Assumed bitrate in bytes per second if a stream's length is unknown
+    DEFAULT_BITRATE = 320 * 1000 / 8
+
+    def __init__(self, min_prefill=32 * 1024, max_prefill=8 * 1024 * 1024, margin=2.0, safety=1.2, smoothing=0.3):
+        """
+        Keyword arguments:
+        min_prefill -- bytes which are always buffered before playback starts
+        max_prefill -- upper bound of the prefill in bytes
+        margin -- seconds of audio to buffer in addition to the computed prefill
+        safety -- factor applied to the computed prefill
+        smoothing -- weight of a new sample in the throughput average
+
+        """
+        self.min_prefill = min_prefill
+        self.max_prefill = max_prefill
+        self.margin = margin
+        self.safety = safety
+        self.smoothing = smoothing
+        self.throughput = None          # Average download rate in bytes per second
+        self.cache_size = None          # Bytes the cache of the observed player holds, None if unknown
+        self._stats = {
+            'tracks': 0,                # Prefills decided
+            'fast_starts': 0,           # Tracks started with the minimal prefill
+            'last_prefill': None,
+            'total_prefill': 0,
+            'startups': 0,              # Streams which started playing
+            'last_startup': None,       # Seconds from request to first byte sent
+            'max_startup': None,
+            'total_startup': 0.0,
+            'proxy_stalls': 0,          # Times the player drained the proxy's buffer
+            'starved_time': 0.0,        # Seconds the player waited for the proxy
+            'player_stalls': 0,         # Times the player's cache ran empty, i.e. audible underruns
+            'min_cache_fill': None      # Lowest fill of mplayer's cache in percent
+        }
+
+    def observe(self, player):
+        """ Pick up the cache size and the cache fill of a player.
+
+        Keyword arguments:
+        player -- the Player instance to observe
+
+        """
+        self.cache_size = self._cache_size(player.args)
+        player.stdout.connect_event(EventType.CACHE_FILL, self._on_cache_fill)
+
+    def sample(self, stream):
+        """ Add the throughput of a (finished) StreamBuffer to the average.
+
+        """
+        throughput = stream.throughput()
+        if throughput is None:
+            return
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput += self.smoothing * (throughput - self.throughput)
+
+    def prefill(self, stream, duration=None):
+        """ Returns the number of bytes to buffer before stream starts playing.
+
+        Keyword arguments:
+        stream -- the StreamBuffer about to be played
+        duration -- duration of the track in seconds or None
+
+        """
+        length = stream.length
+        if length is not None and duration:
+            bitrate = float(length) / duration
+        else:
+            bitrate = self.DEFAULT_BITRATE
+            if length is not None:
+                duration = length / bitrate
+
+        # The rate of this very stream is the best estimate once it's known
+        throughput = stream.throughput() or self.throughput
+
+        if throughput is None or duration is None:
+            # Nothing known yet, buffer the margin only
+            prefill = bitrate * self.margin
+        else:
+            # Buffer what the download would otherwise fall behind by
+            behind = max(0.0, (bitrate - throughput) * duration)
+            prefill = behind * self.safety + bitrate * self.margin
+            if behind == 0 and throughput > 2 * bitrate:
+                prefill = self.min_prefill
+                self._stats['fast_starts'] += 1
+
+        prefill = int(min(self.max_prefill, max(self.min_prefill, prefill)))
+        if length is not None:
+            prefill = min(prefill, length - stream.offset)
+
+        self._stats['tracks'] += 1
+        self._stats['last_prefill'] = prefill
+        self._stats['total_prefill'] += prefill
+        return prefill
+
+    def player_args(self, engine='mplayer'):
+        """ Returns the cache arguments of the player for the measured throughput.
+
+        The player only reads the local proxy, so its cache just has to bridge
+        short hiccups. It grows on slow links where the proxy may run dry.
+
+        Keyword arguments:
+        engine -- 'mplayer' or 'mpv'
+
+        """
+        fast = self.throughput is not None and self.throughput > 2 * self.DEFAULT_BITRATE
+        if engine == 'mpv':
+            return ('--cache=yes', '--cache-secs={0}'.format(5 if fast else 20))
+        if fast:
+            return ('-cache', '256', '-cache-min', '5')
+        return ('-cache', '1024', '-cache-min', '20')
+
+    def started(self, latency):
+        """ A stream started playing latency seconds after it was requested.
+
+        """
+        self._stats['startups'] += 1
+        self._stats['last_startup'] = latency
+        self._stats['total_startup'] += latency
+        if self._stats['max_startup'] is None or latency > self._stats['max_startup']:
+            self._stats['max_startup'] = latency
+
+    def stalled(self):
+        """ The proxy ran out of data while a stream was playing.
+
+        """
+        self._stats['proxy_stalls'] += 1
+
+    def starved(self, seconds, stream, duration=None):
+        """ The player got data again after waiting for the proxy.
+
+        Keyword arguments:
+        seconds -- seconds the player waited
+        stream -- the StreamBuffer it waited for
+        duration -- duration of the track in seconds or None
+
+        """
+        self._stats['starved_time'] += seconds
+        if stream.length is not None and duration:
+            bitrate = float(stream.length) / duration
+        else:
+            bitrate = self.DEFAULT_BITRATE
+        # Meanwhile the player played from its cache, whose default size depends on the player's version
+        if self.cache_size is not None and seconds * bitrate > self.cache_size:
+            self._stats['player_stalls'] += 1
+
+    def stats(self):
+        """ Returns a dict of counters describing the buffering.
+
+        """
+        stats = dict(self._stats)
+        stats['throughput'] = self.throughput
+        stats['avg_prefill'] = stats['total_prefill'] / stats['tracks'] if stats['tracks'] else None
+        stats['avg_startup'] = stats['total_startup'] / stats['startups'] if stats['startups'] else None
+        return stats
+
+    def _on_cache_fill(self, event):
+        # Called by the stdout reader
+        reactor.callFromThread(self._cache_filled, event.percent)
+
+    def _cache_filled(self, percent):
+        if self._stats['min_cache_fill'] is None or percent < self._stats['min_cache_fill']:
+            self._stats['min_cache_fill'] = percent
+
+    @classmethod
+    def _cache_size(cls, args):
+        # From the arguments made by player_args(), None without them
+        args = list(args)
+        if '-cache' in args[:-1]:
+            return int(args[args.index('-cache') + 1]) * 1024
+        for arg in args:
+            if arg.startswith('--cache-secs='):
+                return int(arg.partition('=')[2]) * cls.DEFAULT_BITRATE
+        return None
@@ -0,0 +1,415 @@
+__author__ = 'daniel michels'
+
+import os
+import sys
+import json
+import time
+import socket
+
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import Int32StringReceiver
+
+from gmusicplayer.batching import EventBatcher, unbatch
+from gmusicplayer.startup import Startup
+
+
+class ClusterError(Exception):
+    """ Raised in a worker when a call forwarded to the core failed.
+
+    """
+
+
+def listen_shared(port, factory, interface=''):
+    """ Listen on a TCP port which other processes listen on as well.
+
+    The kernel distributes the connections among all processes which
+    bound the port with SO_REUSEPORT (Linux 3.9 and newer).
+
+    Returns:
+    The IListeningPort
+
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(128)
+    sock.setblocking(False)
+    try:
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor uses a duplicate of the descriptor
+        sock.close()
+
+
+class _Channel(Int32StringReceiver):
+    """ Length-prefixed JSON messages between the core and a worker.
+
+    """
+
+    MAX_LENGTH = 256 * 1024 * 1024
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def send(self, message):
+        self.sendString(json.dumps(message))
+
+    def connectionMade(self):
+        self.owner._connected(self)
+
+    def connectionLost(self, reason):
+        self.owner._disconnected(self)
+
+    def stringReceived(self, data):
+        self.owner._received(self, json.loads(data))
+
+
+class ClusterCore(protocol.ServerFactory):
+    """ The authoritative player process of a multi-process deployment.
+
+    The core owns the MusicPlayer and spawns the worker processes, which
+    serve the websocket and HTTP clients. Workers connect over a UNIX
+    socket, receive the playlist, playback status and startup report, and
+    are sent every event together with the new status so they can answer
+    reads locally. The events are batched like those sent to the clients.
+    The workers are spawned right away, while the core is still warming up
+    they tell their clients so. Changes are forwarded to the core as calls
+    (see CALLS).
+
+    """
+
+    # MusicPlayer methods workers may call
+    CALLS = ('search', 'play', 'play_track', 'play_next_track', 'play_previous_track', 'stop', 'pause',
+             'add_track_to_playlist', 'remove_track_from_playlist', 'set_playtype', 'request_track_change',
+             'traces', 'list_playlists', 'switch_playlist')
+
+    def __init__(self, musicplayer, socket_path, workers, worker_args, respawn_delay=1.0, startup=None,
+                 event_window=0.05, coalesce=(), cancel=None):
+        """
+        Keyword arguments:
+        musicplayer -- the MusicPlayer
+        socket_path -- path of the UNIX socket the workers connect to
+        workers -- number of worker processes
+        worker_args -- command line of a worker, the socket path and worker index are appended
+        respawn_delay -- seconds to wait before a dead worker is replaced
+        startup -- Startup of the core, reported to the workers, or None
+        event_window, coalesce, cancel -- batching of the events, see EventBatcher
+
+        """
+        self.musicplayer = musicplayer
+        self.startup = startup
+        self.batcher = EventBatcher(self._send, event_window, coalesce, cancel)
+        self.socket_path = socket_path
+        self.workers = workers
+        self.worker_args = list(worker_args)
+        self.respawn_delay = respawn_delay
+        self._channels = set()
+        self._processes = {}            # Worker index -> IProcessTransport
+        self._stopping = False
+        self._stats = {
+            'spawned': 0,
+            'died': 0,                  # Workers which exited on their own
+            'calls': 0,                 # Calls forwarded by the workers
+            'errors': 0,                # Failed calls
+            'events': 0
+        }
+
+    def buildProtocol(self, addr):
+        return _Channel(self)
+
+    def start(self):
+        """ Listen for workers and spawn them.
+
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        reactor.listenUNIX(self.socket_path, self)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def stop(self):
+        """ Terminate the workers.
+
+        """
+        self._stopping = True
+        for transport in list(self._processes.values()):
+            try:
+                transport.signalProcess('TERM')
+            except Exception:
+                pass
+
+    def publish(self, topic, payload):
+        """ Send an event and the current playback status to all workers, with the next batch.
+
+        """
+        self._stats['events'] += 1
+        if self._channels:
+            self.batcher.add(topic, payload)
+
+    def send_state(self):
+        """ Send the playlist, playback status and startup report to all workers, e.g. once warmed up.
+
+        """
+        self.batcher.flush()
+        data = json.dumps(self._state())
+        for channel in list(self._channels):
+            channel.sendString(data)
+
+    def _send(self, topic, payload):
+        # Serialize once for all workers
+        data = json.dumps({
+            'type': 'event',
+            'topic': topic,
+            'payload': payload,
+            'status': self.musicplayer.playback.status()
+        })
+        for channel in list(self._channels):
+            channel.sendString(data)
+
+    def stats(self):
+        """ Returns a dict of counters describing the workers.
+
+        """
+        stats = dict(self._stats)
+        stats['workers'] = len(self._processes)
+        stats['connected'] = len(self._channels)
+        return stats
+
+    def _connected(self, channel):
+        self._channels.add(channel)
+
+    def _disconnected(self, channel):
+        self._channels.discard(channel)
+
+    def _received(self, channel, message):
+        if message.get('type') == 'hello':
+            channel.send(self._state())
+        elif message.get('type') == 'call':
+            self._call(channel, message)
+
+    def _state(self):
+        return {
+            'type': 'state',
+            'playlist': self.musicplayer.playlist,
+            'status': self.musicplayer.playback.status(),
+            'startup': self.startup.report() if self.startup is not None else None
+        }
+
+    def _call(self, channel, message):
+        self._stats['calls'] += 1
+        method = message.get('method')
+        if method not in self.CALLS:
+            self._reply(channel, message['id'], None, 'unknown method {0}'.format(method))
+            return
+        d = defer.maybeDeferred(getattr(self.musicplayer, method), *message.get('args', ()))
+        d.addCallbacks(lambda result: self._reply(channel, message['id'], result),
+                       lambda failure: self._reply(channel, message['id'], None, failure.getErrorMessage()))
+
+    def _reply(self, channel, call_id, result, error=None):
+        if error is not None:
+            self._stats['errors'] += 1
+        if channel in self._channels:
+            channel.send({'type': 'result', 'id': call_id, 'result': result, 'error': error})
+
+    def _spawn(self, index):
+        args = self.worker_args + [self.socket_path, str(index)]
+        process = _WorkerProcess(self, index)
+        self._processes[index] = reactor.spawnProcess(process, args[0], args, env=os.environ,
+                                                      childFDs={0: 'w', 1: 1, 2: 2})
+        self._stats['spawned'] += 1
+
+    def _worker_ended(self, index):
+        self._processes.pop(index, None)
+        if not self._stopping:
+            self._stats['died'] += 1
+            print("worker %d died, respawning" % index)
+            reactor.callLater(self.respawn_delay, self._respawn, index)
+
+    def _respawn(self, index):
+        if not self._stopping and index not in self._processes:
+            self._spawn(index)
+
+
+class _WorkerProcess(ProcessProtocol):
+
+    def __init__(self, core, index):
+        self.core = core
+        self.index = index
+
+    def processEnded(self, reason):
+        self.core._worker_ended(self.index)
+
+
+class CoreClient(object):
+    """ Replica of the MusicPlayer of the core in a worker process.
+
+    Provides the attributes the RPC server reads (playlist, playback,
+    startup) from the replicated state, and forwards all other MusicPlayer methods in
+    ClusterCore.CALLS to the core, returning Deferreds. Events received
+    from the core are applied to the replica and passed to publish.
+
+    """
+
+    def __init__(self, socket_path, added_topic, removed_topic, switched_topic=None):
+        """
+        Keyword arguments:
+        socket_path -- path of the UNIX socket of the core
+        added_topic -- topic of the events of tracks added to the playlist
+        removed_topic -- topic of the events of tracks removed from the playlist
+        switched_topic -- topic of the events of another playlist being played or None
+
+        """
+        self.socket_path = socket_path
+        self.added_topic = added_topic
+        self.removed_topic = removed_topic
+        self.switched_topic = switched_topic
+        self.playlist = []
+        self.playback = _PlaybackReplica()
+        self.startup = _StartupReplica()
+        self.publish = None             # callable(topic, payload) for the events of the core
+        self._channel = None
+        self._ready = defer.Deferred()
+        self._calls = {}                # call id -> Deferred
+        self._next_call_id = 1
+
+    def connect(self):
+        """ Connect to the core.
+
+        Returns:
+        A Deferred which fires once the state has been replicated
+
+        """
+        d = protocol.ClientCreator(reactor, _Channel, self).connectUNIX(self.socket_path)
+        d.addErrback(self._ready.errback)
+        return self._ready
+
+    def call(self, method, *args):
+        """ Call a method of the MusicPlayer in the core.
+
+        """
+        if self._channel is None:
+            return defer.fail(ClusterError('not connected to the core'))
+        call_id = self._next_call_id
+        self._next_call_id += 1
+        d = self._calls[call_id] = defer.Deferred()
+        self._channel.send({'type': 'call', 'id': call_id, 'method': method, 'args': args})
+        return d
+
+    def _connected(self, channel):
+        self._channel = channel
+        channel.send({'type': 'hello'})
+
+    def _disconnected(self, channel):
+        self._channel = None
+        calls, self._calls = self._calls, {}
+        for d in calls.values():
+            d.errback(ClusterError('connection to the core lost'))
+        # Without the core there is nothing to serve
+        print("lost the connection to the core")
+        if reactor.running:
+            reactor.stop()
+
+    def _received(self, channel, message):
+        kind = message.get('type')
+        if kind == 'state':
+            self.playlist = message['playlist']
+            self.playback.update(message['status'])
+            if message.get('startup') is not None:
+                self.startup.update(message['startup'])
+            if not self._ready.called:
+                self._ready.callback(self)
+        elif kind == 'event':
+            # Batches are taken apart, the RPC server batches the events for its clients itself
+            self.playback.update(message['status'])
+            for topic, payload in unbatch(message['topic'], message['payload']):
+                self._apply(topic, payload)
+                if self.publish is not None:
+                    self.publish(topic, payload)
+        elif kind == 'result':
+            d = self._calls.pop(message['id'], None)
+            if d is None:
+                return
+            if message.get('error') is not None:
+                d.errback(ClusterError(message['error']))
+            else:
+                d.callback(message.get('result'))
+
+    def _apply(self, topic, payload):
+        if topic == self.added_topic:
+            self.playlist.append(payload)
+        elif topic == self.removed_topic:
+            self.playlist = [track for track in self.playlist if track['id'] != payload]
+        elif topic == self.switched_topic:
+            self.playlist = payload['tracks']
+
+
+def _forward(method):
+    def call(self, *args):
+        return self.call(method, *args)
+
+    call.__name__ = method
+    call.__doc__ = 'Forwards {0}() to the MusicPlayer of the core'.format(method)
+    return call
+
+
+for _method in ClusterCore.CALLS:
+    setattr(CoreClient, _method, _forward(_method))
+
+
+class _PlaybackReplica(object):
+    """ The part of PlaybackClock the RPC server reads, fed by the core.
+
+    Like PlaybackClock, the position of a playing track is computed from
+    the time it started at when the status is read.
+
+    """
+
+    def __init__(self):
+        self._status = None
+        self._snapshot = None
+        self.started = None             # startedAt of the core's status, None while paused or stopped
+
+    def update(self, status):
+        if status != self._status:
+            self._status = status
+            self._snapshot = json.dumps(status)
+            self.started = status.get('startedAt') if status is not None else None
+
+    def status(self):
+        if self._status is None or self.started is None:
+            return self._status
+        now = time.time()
+        return dict(self._status, position=max(0.0, now - self.started), updatedAt=now)
+
+    def snapshot(self):
+        return self._snapshot
+
+
+class _StartupReplica(Startup):
+    """ The Startup of the core as last reported by it, served under '/startup' of the worker.
+
+    """
+
+    def __init__(self):
+        Startup.__init__(self)
+        self._report = None
+
+    def update(self, report):
+        self._report = report
+        self.state = report['state']
+        self.error = report['error']
+
+    def report(self):
+        if self._report is None:
+            return Startup.report(self)
+        return dict(self._report)
+
+
+def worker_command(script):
+    """ Returns the command line of a worker process running script.
+
+    """
+    return [sys.executable, os.path.abspath(script)]
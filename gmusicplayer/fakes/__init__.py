@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-ins for the external programs and services the server talks to
+
+They implement just enough of the real protocols to exercise the server and
+its components without mplayer, mpv or Google.
+
+Modules:
+
+gmusic -- Mobileclient and Webclient of gmusicapi backed by a generated catalog
+mplayer_slave -- executable speaking mplayer's slave protocol
+mpv_ipc -- Unix socket server speaking mpv's JSON IPC protocol
+stream_host -- HTTP host serving deterministic, optionally rate limited streams
+"""
+
+__author__ = 'daniel michels'
@@ -0,0 +1,235 @@
+__author__ = 'daniel michels'
+
+import math
+import time
+import random
+import uuid
+from threading import Lock
+
+
+class FakeCallFailure(Exception):
+    """ Raised by a fake call which failed, like gmusicapi's CallFailure.
+
+    """
+
+
+def make_track(number):
+    """ Returns a catalog track shaped like the ones of Google Music.
+
+    """
+    return {
+        'nid': 'T%026d' % number,
+        'storeId': 'T%026d' % number,
+        'title': 'Track number %d' % number,
+        'artist': 'Artist %d' % (number % 500),
+        'album': 'Album %d' % (number % 1000),
+        'albumArtist': 'Artist %d' % (number % 500),
+        'genre': ('Rock', 'Pop', 'Jazz', 'Electronic')[number % 4],
+        'trackNumber': number % 15 + 1,
+        'discNumber': 1,
+        'year': 1970 + number % 45,
+        'durationMillis': str(180000 + number % 120000),
+        'estimatedSize': str(7200000 + number % 4800000),
+        'albumArtRef': [{'url': 'http://lh3.googleusercontent.com/%040d' % number}],
+        'artistId': ['A%026d' % (number % 500)],
+        'albumId': 'B%026d' % (number % 1000),
+        'kind': 'sj#track'
+    }
+
+
+class FakeBackend(object):
+    """ State and behaviour shared by the fake clients.
+
+    Holds a catalog of generated tracks and the playlists of the account.
+    Every call waits for a log-normally distributed time around the median
+    latency and fails with FakeCallFailure at the given rate, like the calls
+    of gmusicapi, which block until Google answered.
+
+    """
+
+    def __init__(self, catalog_size=10000, latency=0.05, sigma=0.5, failure_rate=0.0,
+                 stream_url='http://127.0.0.1:8082/', playlists=None, seed=None):
+        """
+        Keyword arguments:
+        catalog_size -- number of tracks which can be found
+        latency -- median seconds a call takes, 0 for no delay
+        sigma -- spread of the log-normal latency distribution
+        failure_rate -- fraction of the calls which fail
+        stream_url -- base url of the streams, e.g. of a FakeStreamHost
+        playlists -- dict of playlist name -> number of tracks to create initially
+        seed -- seed of the random numbers for reproducible runs
+
+        """
+        self.catalog_size = catalog_size
+        self.latency = latency
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.stream_url = stream_url
+        self.calls = {}                 # Method -> number of calls
+        self.failures = 0
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._playlists = []            # Playlists like get_all_user_playlist_contents() returns them
+        for name, size in (playlists or {}).items():
+            playlist_id = self.create_playlist(name)
+            self.add_songs(playlist_id, [make_track(i)['nid'] for i in range(size)])
+
+    def call(self, method):
+        """ Account for a call, wait and maybe fail like the real one.
+
+        """
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            delay = self._random.lognormvariate(math.log(self.latency), self.sigma) if self.latency else 0
+            failed = self._random.random() < self.failure_rate
+        if delay:
+            time.sleep(delay)
+        if failed:
+            with self._lock:
+                self.failures += 1
+            raise FakeCallFailure('{0} failed'.format(method))
+
+    def track(self, store_id):
+        try:
+            number = int(store_id.lstrip('T'))
+        except ValueError:
+            return None
+        if 0 <= number < self.catalog_size:
+            return make_track(number)
+        return None
+
+    def search(self, query, max_results):
+        # Matches are spread over the catalog deterministically per query
+        start = sum(ord(c) for c in query) * 7919 % max(1, self.catalog_size)
+        return [make_track((start + i) % self.catalog_size) for i in range(min(max_results, self.catalog_size))]
+
+    def create_playlist(self, name):
+        playlist_id = str(uuid.uuid4())
+        with self._lock:
+            self._playlists.append({'id': playlist_id, 'name': name, 'kind': 'sj#playlist', 'tracks': []})
+        return playlist_id
+
+    def add_songs(self, playlist_id, song_ids):
+        entry_ids = []
+        with self._lock:
+            playlist = self._find(playlist_id)
+            for song_id in song_ids:
+                entry_id = str(uuid.uuid4())
+                entry_ids.append(entry_id)
+                playlist['tracks'].append({'id': entry_id, 'trackId': song_id, 'kind': 'sj#playlistEntry',
+                                           'track': self.track(song_id) or make_track(0)})
+        return entry_ids
+
+    def remove_entries(self, entry_ids):
+        entry_ids = set(entry_ids)
+        removed = []
+        with self._lock:
+            for playlist in self._playlists:
+                kept = []
+                for entry in playlist['tracks']:
+                    if entry['id'] in entry_ids:
+                        removed.append(entry['id'])
+                    else:
+                        kept.append(entry)
+                playlist['tracks'] = kept
+        return removed
+
+    def playlists(self):
+        with self._lock:
+            return [dict(playlist, tracks=[dict(entry, track=dict(entry['track'])) for entry in playlist['tracks']])
+                    for playlist in self._playlists]
+
+    def _find(self, playlist_id):
+        for playlist in self._playlists:
+            if playlist['id'] == playlist_id:
+                return playlist
+        raise FakeCallFailure('playlist {0} does not exist'.format(playlist_id))
+
+
+# Backend of the clients created without one, see configure()
+_default_backend = FakeBackend()
+
+
+def configure(**kwargs):
+    """ Replace the backend used by clients created without one.
+
+    Takes the keyword arguments of FakeBackend.
+
+    Returns:
+    The new FakeBackend
+
+    """
+    global _default_backend
+    _default_backend = FakeBackend(**kwargs)
+    return _default_backend
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+class _FakeClient(object):
+
+    def __init__(self, backend=None):
+        self.backend = backend or _default_backend
+        self.logged_in = False
+
+    def login(self, email, password, *args, **kwargs):
+        self.backend.call('login')
+        self.logged_in = bool(email and password)
+        return self.logged_in
+
+    def logout(self):
+        self.logged_in = False
+        return True
+
+    def is_authenticated(self):
+        return self.logged_in
+
+
+class FakeWebclient(_FakeClient):
+    """ Stand-in for gmusicapi's Webclient.
+
+    """
+
+    def get_registered_devices(self):
+        self.backend.call('get_registered_devices')
+        return [{'id': '0x0123456789abcdef', 'type': 'PHONE', 'name': 'Fake phone'}]
+
+
+class FakeMobileclient(_FakeClient):
+    """ Stand-in for gmusicapi's Mobileclient.
+
+    """
+
+    def get_all_user_playlist_contents(self):
+        self.backend.call('get_all_user_playlist_contents')
+        return self.backend.playlists()
+
+    def create_playlist(self, name, *args, **kwargs):
+        self.backend.call('create_playlist')
+        return self.backend.create_playlist(name)
+
+    def add_songs_to_playlist(self, playlist_id, song_ids):
+        self.backend.call('add_songs_to_playlist')
+        return self.backend.add_songs(playlist_id, _as_list(song_ids))
+
+    def remove_entries_from_playlist(self, entry_ids):
+        self.backend.call('remove_entries_from_playlist')
+        return self.backend.remove_entries(_as_list(entry_ids))
+
+    def search_all_access(self, query, max_results=50):
+        self.backend.call('search_all_access')
+        hits = self.backend.search(query, max_results)
+        return {
+            'song_hits': [{'track': track, 'score': 100.0 - i, 'type': '1'} for i, track in enumerate(hits)],
+            'album_hits': [],
+            'artist_hits': []
+        }
+
+    def get_stream_url(self, song_id, device_id=None):
+        self.backend.call('get_stream_url')
+        return '{0}{1}.mp3'.format(self.backend.stream_url, song_id)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""Stand-in for the mplayer executable, speaking its slave protocol.
+
+Implements what mplayer.core.Player relies on:
+
+mplayer -list-properties -- a version line and a table of properties
+mplayer -input cmdlist -- the commands and the types of their arguments
+mplayer -slave -idle ... -- reads commands from stdin and answers
+                             get_property with ANS_<name>=<value> lines
+
+In slave mode loadfile simulates playback: 'Starting playback...', status
+lines while the file plays and 'EOF code: 1' at its end. pause, stop,
+set_property and quit work as expected, other commands including
+step_property are counted and ignored.
+
+Like mplayer, it prints a line only if -really-quiet and -msglevel allow it:
+the answers are global info (4) messages, 'Starting playback...' is a
+cplayer info message, the status lines are statusline status (5) messages
+terminated by '\r' instead of '\n', and 'EOF code' is a global verbose (6)
+message. So under -really-quiet -msglevel global=4 only the answers are
+printed. Besides mplayer's own arguments it accepts
+
+-fake-latency SECONDS -- delay of every answer
+-fake-duration SECONDS -- length of every loaded file (default: 180)
+-fake-status-interval SECONDS -- time between two status lines, 0 for none
+-fake-flood-rate LINES -- lines per second written by 'flood', 0 for unlimited
+
+The 'flood <count>' command, which mplayer doesn't know, writes count
+status lines followed by 'EOF code: 1' for measuring the output rate of
+the wrapper. Unlike the status lines of playback they are terminated by
+'\n', so every one of them is dispatched. The property 'fake_commands' answers the number of commands
+received so far.
+
+Usage: mplayer_slave.py [mplayer arguments]
+"""
+
+__author__ = 'daniel michels'
+
+import os
+import sys
+import time
+from threading import Thread, Lock
+
+VERSION_LINE = 'MPlayer SVN-r37379-fake (C) 2000-2015 MPlayer Team'
+
+# Name, type, min, max as listed by -list-properties
+PROPERTIES = (
+    ('osdlevel', 'Integer', '0', '3'),
+    ('speed', 'Float', '0.01', '100.00'),
+    ('loop', 'Integer', '-1', 'No'),
+    ('pause', 'Flag', '0', '1'),
+    ('filename', 'String', 'No', 'No'),
+    ('path', 'String', 'No', 'No'),
+    ('demuxer', 'String', 'No', 'No'),
+    ('stream_pos', 'Position', '0', 'No'),
+    ('stream_start', 'Position', '0', 'No'),
+    ('stream_end', 'Position', '0', 'No'),
+    ('stream_length', 'Position', '0', 'No'),
+    ('stream_time_pos', 'Time', '0.00', 'No'),
+    ('length', 'Time', 'No', 'No'),
+    ('percent_pos', 'Integer', '0', '100'),
+    ('time_pos', 'Time', '0.00', 'No'),
+    ('metadata', 'String list', 'No', 'No'),
+    ('volume', 'Float', '0.00', '100.00'),
+    ('balance', 'Float', '-1.00', '1.00'),
+    ('mute', 'Flag', '0', '1'),
+    ('audio_delay', 'Float', '-100.00', '100.00'),
+    ('audio_format', 'Integer', 'No', 'No'),
+    ('audio_codec', 'String', 'No', 'No'),
+    ('audio_bitrate', 'Integer', 'No', 'No'),
+    ('samplerate', 'Integer', 'No', 'No'),
+    ('channels', 'Integer', 'No', 'No'),
+    ('switch_audio', 'Integer', '-2', '255'),
+    ('sub_delay', 'Float', 'No', 'No'),
+)
+
+# Name and argument types as listed by -input cmdlist
+COMMANDS = (
+    ('seek', 'Float [Integer]'),
+    ('edl_mark', ''),
+    ('audio_delay', 'Float [Integer]'),
+    ('speed_incr', 'Float'),
+    ('speed_mult', 'Float'),
+    ('speed_set', 'Float'),
+    ('quit', '[Integer]'),
+    ('stop', ''),
+    ('pause', ''),
+    ('frame_step', ''),
+    ('pt_step', 'Integer [Integer]'),
+    ('pt_up_step', 'Integer [Integer]'),
+    ('alt_src_step', 'Integer'),
+    ('loop', 'Integer [Integer]'),
+    ('volume', 'Float [Integer]'),
+    ('mute', '[Integer]'),
+    ('loadfile', 'String [Integer]'),
+    ('loadlist', 'String [Integer]'),
+    ('run', 'String'),
+    ('get_time_length', ''),
+    ('get_percent_pos', ''),
+    ('get_time_pos', ''),
+    ('get_file_name', ''),
+    ('get_meta_title', ''),
+    ('osd', '[Integer]'),
+    ('osd_show_text', 'String [Integer] [Integer]'),
+    ('osd_show_property_te', 'String [Integer] [Integer]'),
+    ('get_property', 'String'),
+    ('set_property', 'String String'),
+    ('step_property', 'String [Float] [Integer]'),
+    ('seek_chapter', 'Integer [Integer]'),
+)
+
+PREFIXES = ('pausing', 'pausing_toggle', 'pausing_keep', 'pausing_keep_force')
+
+# Message levels of mplayer's -msglevel
+MSGL_INFO = 4
+MSGL_STATUS = 5
+MSGL_V = 6
+
+
+class MessageLevels(object):
+    """ Which messages mplayer prints, given its -msglevel, -quiet and -really-quiet arguments.
+
+    """
+
+    def __init__(self, args):
+        self.verbose = -10 if '-really-quiet' in args else -1 if '-quiet' in args else 0
+        self.levels = {'all': MSGL_STATUS}
+        for i, arg in enumerate(args[:-1]):
+            if arg == '-msglevel':
+                for spec in args[i + 1].split(':'):
+                    module, _, level = spec.partition('=')
+                    if level.lstrip('-').isdigit():
+                        self.levels[module] = int(level)
+
+    def test(self, module, level):
+        # A module's own level applies as given, otherwise the level of all lowered by -(really-)quiet
+        if module in self.levels and module != 'all':
+            return level <= self.levels[module]
+        return level <= self.levels['all'] + self.verbose
+
+
+class FakeSlave(object):
+    """ The slave mode part: a command loop and simulated playback.
+
+    """
+
+    def __init__(self, latency=0.0, duration=180.0, status_interval=0.0, flood_rate=0, levels=None):
+        self.latency = latency
+        self.duration = duration
+        self.status_interval = status_interval
+        self.flood_rate = flood_rate
+        self.levels = levels or MessageLevels(())
+        self.commands = 0
+
+        self._lock = Lock()
+        self._generation = 0            # Incremented whenever a new file is loaded or playback stops
+        self._started = None            # Time the current file would have started without pauses
+        self._paused_at = None
+        self._properties = dict((name, None) for name, _, _, _ in PROPERTIES)
+        self._properties.update({'volume': '100.000000', 'speed': '1.00', 'pause': 'no', 'mute': 'no'})
+
+    def write(self, *lines):
+        self.write_raw(''.join(line + '\n' for line in lines))
+
+    def write_raw(self, data):
+        with self._lock:
+            os.write(1, data.encode('utf-8'))
+
+    def message(self, module, level, *lines):
+        if self.levels.test(module, level):
+            self.write(*lines)
+
+    def run(self):
+        """ Handle commands until quit or the end of stdin.
+
+        """
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                return 0
+            args = line.split()
+            if not args:
+                continue
+            if args[0] in PREFIXES:
+                args.pop(0)
+            if not args:
+                continue
+            self.commands += 1
+            code = self.handle(args[0], args[1:])
+            if code is not None:
+                return code
+
+    def handle(self, name, args):
+        if name == 'quit':
+            return int(args[0]) if args else 0
+        elif name == 'get_property':
+            self.answer(args[0] if args else '')
+        elif name == 'set_property' and len(args) >= 2:
+            if args[0] in self._properties:
+                self._properties[args[0]] = ' '.join(args[1:])
+        elif name == 'loadfile' and args:
+            self.load(args[0])
+        elif name == 'pause':
+            self.pause()
+        elif name == 'stop':
+            self.stop()
+        elif name == 'get_time_pos':
+            self.delayed('ANS_TIME_POSITION={0:.1f}'.format(self.position() or 0.0))
+        elif name == 'flood' and args:
+            background(self.flood, int(args[0]))
+
+    def delayed(self, line):
+        if self.latency:
+            time.sleep(self.latency)
+        self.message('global', MSGL_INFO, line)
+
+    def answer(self, name):
+        if name == 'fake_commands':
+            self.delayed('ANS_fake_commands={0}'.format(self.commands))
+        elif name == 'time_pos':
+            position = self.position()
+            self.delayed('ANS_ERROR=PROPERTY_UNAVAILABLE' if position is None
+                         else 'ANS_time_pos={0:.2f}'.format(position))
+        elif name not in self._properties:
+            self.delayed('ANS_ERROR=PROPERTY_UNKNOWN')
+        elif self._properties[name] is None:
+            self.delayed('ANS_ERROR=PROPERTY_UNAVAILABLE')
+        else:
+            self.delayed('ANS_{0}={1}'.format(name, self._properties[name]))
+
+    def position(self):
+        if self._started is None:
+            return None
+        now = self._paused_at if self._paused_at is not None else time.time()
+        return min(self.duration, now - self._started)
+
+    def load(self, path):
+        self._generation += 1
+        self._started = time.time()
+        self._paused_at = None
+        self._properties.update({'filename': os.path.basename(path), 'path': path, 'pause': 'no',
+                                 'length': '{0:.2f}'.format(self.duration)})
+        self.message('cplayer', MSGL_INFO, 'Playing {0}.'.format(path), 'Starting playback...')
+        background(self.play, self._generation)
+
+    def pause(self):
+        if self._started is None:
+            return
+        if self._paused_at is None:
+            self._paused_at = time.time()
+            self._properties['pause'] = 'yes'
+        else:
+            self._started += time.time() - self._paused_at
+            self._paused_at = None
+            self._properties['pause'] = 'no'
+
+    def stop(self):
+        self._generation += 1
+        self._started = self._paused_at = None
+        self._properties.update({'filename': None, 'path': None, 'length': None})
+
+    def play(self, generation):
+        # Status lines while the file plays, EOF at its end
+        while generation == self._generation:
+            position = self.position()
+            if position >= self.duration:
+                self._generation += 1
+                self._started = None
+                self.message('statusline', MSGL_STATUS, '')
+                self.message('global', MSGL_V, 'EOF code: 1')
+                return
+            if self.status_interval and self._paused_at is None and self.levels.test('statusline', MSGL_STATUS):
+                # Overwritten by the next one on a terminal, so there is no '\n'
+                self.write_raw(self.status_line(position) + '\r')
+            time.sleep(self.status_interval or 0.1)
+
+    def status_line(self, position):
+        return 'A:{0:6.1f} ({1:04.1f}) of {2:.1f} ({3:02d}:{4:04.1f})  0.3% '.format(
+            position, position, self.duration, int(self.duration // 60), self.duration % 60)
+
+    def flood(self, count):
+        # Written in chunks, like a busy mplayer filling the pipe
+        chunk = 256
+        started = time.time()
+        for sent in range(0, count, chunk):
+            lines = [self.status_line(float(i % 3600)) for i in range(sent, min(count, sent + chunk))]
+            self.message('statusline', MSGL_STATUS, *lines)
+            if self.flood_rate:
+                delay = started + float(sent + len(lines)) / self.flood_rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        self.message('global', MSGL_V, 'EOF code: 1')
+
+
+def background(target, *args):
+    thread = Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def option(args, name, default):
+    if name in args:
+        return float(args[args.index(name) + 1])
+    return default
+
+
+def main(args):
+    if '-list-properties' in args:
+        lines = [VERSION_LINE, '', 'Name                 Type            Min        Max']
+        lines.extend('{0:<20} {1:<15} {2:<10} {3}'.format(*prop) for prop in PROPERTIES)
+        lines.append('')
+        sys.stdout.write('\n'.join(lines) + '\n')
+        return 0
+
+    if 'cmdlist' in args:
+        sys.stdout.write(''.join('{0:<20} {1}\n'.format(*command) for command in COMMANDS))
+        return 0
+
+    if '-slave' not in args:
+        sys.stderr.write('This fake only implements the slave mode\n')
+        return 1
+
+    slave = FakeSlave(latency=option(args, '-fake-latency', 0.0),
+                      duration=option(args, '-fake-duration', 180.0),
+                      status_interval=option(args, '-fake-status-interval', 0.0),
+                      flood_rate=option(args, '-fake-flood-rate', 0),
+                      levels=MessageLevels(args))
+    return slave.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
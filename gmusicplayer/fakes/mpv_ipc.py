@@ -0,0 +1,258 @@
+__author__ = 'daniel michels'
+
+import os
+import json
+import time
+import socket
+from threading import Thread, Lock
+
+
+class FakeMpvServer(object):
+    """ Stand-in for mpv's JSON IPC server.
+
+    Supports loadfile (replace/append), stop, seek, cycle pause, quit,
+    get_property, set_property and observe_property. Playback is simulated:
+    every loaded file lasts `duration` seconds, time-pos advances in real time
+    and the usual start-file, file-loaded, playback-restart and end-file
+    events are sent to all clients.
+
+    """
+
+    def __init__(self, path, duration=180.0, latency=0.0, tick=0.25):
+        """
+        Keyword arguments:
+        path -- path of the Unix socket to listen on
+        duration -- length of every simulated file in seconds
+        latency -- seconds to wait before answering a request
+        tick -- seconds between two time-pos updates
+
+        """
+        self.path = path
+        self.duration = duration
+        self.latency = latency
+        self.tick = tick
+        self.requests = 0               # Number of requests handled
+
+        self._lock = Lock()
+        self._clients = []              # [(socket, {observer_id: property name})]
+        self._playlist = []
+        self._running = False
+        self._server = None
+        self._properties = {
+            'filename': None,
+            'time-pos': None,
+            'duration': None,
+            'percent-pos': None,
+            'pause': False,
+            'volume': 100.0,
+            'idle-active': True
+        }
+
+    def start(self):
+        """ Start listening. Returns immediately.
+
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        self._server.listen(16)
+        self._running = True
+        for target in (self._accept_func, self._playback_func):
+            t = Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        """ Stop listening and disconnect all clients.
+
+        """
+        self._running = False
+        with self._lock:
+            clients = self._clients
+            self._clients = []
+        for sock, observed in clients:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _accept_func(self):
+        while self._running:
+            try:
+                sock, address = self._server.accept()
+            except (socket.error, AttributeError):
+                return
+            client = (sock, {})
+            with self._lock:
+                self._clients.append(client)
+            t = Thread(target=self._client_func, args=(client,))
+            t.daemon = True
+            t.start()
+
+    def _client_func(self, client):
+        sock, observed = client
+        reader = sock.makefile('rb')
+        while True:
+            try:
+                line = reader.readline()
+            except socket.error:
+                break
+            if not line:
+                break
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if self.latency:
+                time.sleep(self.latency)
+            answer = self._handle(request.get('command') or [], observed)
+            if 'request_id' in request:
+                answer['request_id'] = request['request_id']
+            self._send(sock, answer)
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def _handle(self, command, observed):
+        self.requests += 1
+        name = command[0] if command else None
+        args = command[1:]
+        props = self._properties
+        with self._lock:
+            if name == 'get_property':
+                if args and props.get(args[0]) is not None:
+                    return {'error': 'success', 'data': props[args[0]]}
+                return {'error': 'property unavailable'}
+            elif name == 'set_property' and len(args) == 2:
+                if args[0] not in props:
+                    return {'error': 'property not found'}
+                props[args[0]] = args[1]
+                changed = [args[0]]
+            elif name == 'observe_property' and len(args) == 2:
+                observed[args[0]] = args[1]
+                changed = []
+                self._send_change_to(observed, args[1])
+            elif name == 'loadfile' and args:
+                mode = args[1] if len(args) > 1 else 'replace'
+                if mode == 'append' and props['filename'] is not None:
+                    self._playlist.append(args[0])
+                    changed = []
+                else:
+                    self._playlist = [args[0]] if mode == 'append-play' else []
+                    changed = self._start_file(args[0])
+            elif name == 'stop':
+                self._playlist = []
+                changed = self._end_file('stop')
+            elif name == 'seek' and args:
+                if props['time-pos'] is None:
+                    return {'error': 'property unavailable'}
+                mode = args[1] if len(args) > 1 else 'relative'
+                value = float(args[0])
+                if mode == 'absolute':
+                    props['time-pos'] = value
+                elif mode == 'absolute-percent':
+                    props['time-pos'] = self.duration * value / 100.0
+                else:
+                    props['time-pos'] += value
+                props['time-pos'] = min(max(0.0, props['time-pos']), self.duration)
+                changed = ['time-pos']
+                self._broadcast({'event': 'seek'})
+                self._broadcast({'event': 'playback-restart'})
+            elif name == 'cycle' and args == ['pause']:
+                props['pause'] = not props['pause']
+                changed = ['pause']
+            elif name == 'quit':
+                self._running = False
+                changed = []
+            else:
+                return {'error': 'invalid parameter'}
+            for pname in changed:
+                self._send_change(pname)
+        if name == 'quit':
+            Thread(target=self.stop).start()
+        return {'error': 'success', 'data': None}
+
+    def _start_file(self, path):
+        # Called with self._lock held
+        changed = self._end_file('stop') if self._properties['filename'] else []
+        self._broadcast({'event': 'start-file'})
+        self._properties.update({'filename': path, 'time-pos': 0.0, 'duration': self.duration,
+                                 'percent-pos': 0.0, 'idle-active': False})
+        self._broadcast({'event': 'file-loaded'})
+        self._broadcast({'event': 'playback-restart'})
+        return changed + ['filename', 'time-pos', 'duration', 'percent-pos', 'idle-active']
+
+    def _end_file(self, reason):
+        # Called with self._lock held
+        if self._properties['filename'] is None:
+            return []
+        self._properties.update({'filename': None, 'time-pos': None, 'duration': None,
+                                 'percent-pos': None, 'idle-active': True})
+        self._broadcast({'event': 'end-file', 'reason': reason})
+        return ['filename', 'time-pos', 'duration', 'percent-pos', 'idle-active']
+
+    def _playback_func(self):
+        while self._running:
+            time.sleep(self.tick)
+            with self._lock:
+                props = self._properties
+                if props['time-pos'] is None or props['pause']:
+                    continue
+                props['time-pos'] += self.tick
+                if props['time-pos'] < self.duration:
+                    props['percent-pos'] = 100.0 * props['time-pos'] / self.duration
+                    self._send_change('time-pos')
+                    self._send_change('percent-pos')
+                    continue
+                changed = self._end_file('eof')
+                if self._playlist:
+                    changed += self._start_file(self._playlist.pop(0))
+                for pname in changed:
+                    self._send_change(pname)
+
+    def _send_change(self, pname):
+        for sock, observed in self._clients:
+            self._send_change_to(observed, pname, sock)
+
+    def _send_change_to(self, observed, pname, sock=None):
+        if sock is None:
+            sock = [s for s, o in self._clients if o is observed][0]
+        for observer_id, name in observed.items():
+            if name == pname:
+                self._send(sock, {'event': 'property-change', 'id': observer_id,
+                                  'name': name, 'data': self._properties.get(name)})
+
+    def _broadcast(self, message):
+        for sock, observed in self._clients:
+            self._send(sock, message)
+
+    @staticmethod
+    def _send(sock, message):
+        try:
+            sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        except socket.error:
+            pass
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: mpv_ipc.py <socket_path> [duration] [latency]")
+        exit()
+
+    server = FakeMpvServer(sys.argv[1], *[float(arg) for arg in sys.argv[2:4]])
+    server.start()
+
+    try:
+        while server._running:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        server.stop()
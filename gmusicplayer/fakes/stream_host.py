@@ -0,0 +1,113 @@
+__author__ = 'daniel michels'
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web import resource, server
+
+
+def stream_bytes(name, offset, size):
+    """ Returns the deterministic content of stream `name` at offset.
+
+    """
+    pattern = (name.encode('utf-8') + b'-') * 64
+    start = offset % len(pattern)
+    data = pattern * (2 + size // len(pattern))
+    return data[start:start + size]
+
+
+class FakeStreamHost(resource.Resource):
+    """ Stand-in for the host serving the Google Music streams.
+
+    Every path is a stream of `size` bytes with deterministic content (see
+    stream_bytes()). Single byte ranges are supported and the transfer rate
+    can be limited, which allows simulating slow networks.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self, size=8 * 1024 * 1024, rate=None, latency=0.0, tick=0.05):
+        """
+        Keyword arguments:
+        size -- length of every stream in bytes
+        rate -- bytes per second per request or None for unlimited
+        latency -- seconds to wait before sending the response headers
+        tick -- seconds between two writes of a rate limited response
+
+        """
+        resource.Resource.__init__(self)
+        self.size = size
+        self.rate = rate
+        self.latency = latency
+        self.tick = tick
+        self.requests = []              # (path, range header) of every request
+        self.bytes_sent = 0
+
+    def render_GET(self, request):
+        self.requests.append((request.path, request.getHeader('range')))
+        reactor.callLater(self.latency, self._respond, request)
+        return server.NOT_DONE_YET
+
+    def _respond(self, request):
+        start, stop = 0, self.size - 1
+        header = request.getHeader('range')
+        if header and header.startswith('bytes='):
+            first, _, last = header[6:].partition('-')
+            start = int(first)
+            if last.isdigit():
+                stop = min(int(last), stop)
+            if start > stop:
+                request.setResponseCode(416)
+                request.finish()
+                return
+            request.setResponseCode(206)
+            request.setHeader(b'content-range', 'bytes {0}-{1}/{2}'.format(start, stop, self.size))
+        request.setHeader(b'content-type', b'audio/mpeg')
+        request.setHeader(b'content-length', str(stop - start + 1))
+        _Sender(self, request, request.path.decode('utf-8'), start, stop + 1).start()
+
+
+class _Sender(object):
+
+    def __init__(self, host, request, name, offset, end):
+        self.host = host
+        self.request = request
+        self.name = name
+        self.offset = offset
+        self.end = end
+        self.call = None
+        request.notifyFinish().addErrback(self._stop)
+
+    def start(self):
+        if self.host.rate is None:
+            self._send(self.end - self.offset)
+            return
+        self.call = LoopingCall(self._send, max(1, int(self.host.rate * self.host.tick)))
+        self.call.start(self.host.tick)
+
+    def _send(self, size):
+        size = min(size, self.end - self.offset)
+        if size > 0:
+            self.request.write(stream_bytes(self.name, self.offset, size))
+            self.offset += size
+            self.host.bytes_sent += size
+        if self.offset >= self.end:
+            self._stop(None)
+            self.request.finish()
+
+    def _stop(self, reason):
+        if self.call is not None and self.call.running:
+            self.call.stop()
+        self.offset = self.end
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) < 2:
+        print("Usage: stream_host.py <port> [size] [rate]")
+        exit()
+
+    host = FakeStreamHost(*[int(arg) for arg in sys.argv[2:4]])
+    reactor.listenTCP(int(sys.argv[1]), server.Site(host))
+    reactor.run()
@@ -0,0 +1,179 @@
+__author__ = 'daniel michels'
+
+import time
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from gmusicplayer.scheduler import Priority
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a stream url hasn't been resolved in time.
+
+    """
+
+
+# Hedges which may be sent in a row after a quiet period
+MAX_HEDGE_BURST = 5.0
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class _Resolution(object):
+
+    def __init__(self, f, args):
+        self.d = defer.Deferred()
+        self.f = f
+        self.args = args
+        self.pending = 0                # Requests without an answer
+        self.failure = None             # Failure of the last failed request
+        self.timers = []
+
+
+class HedgedResolver(object):
+    """ Resolves stream urls with a deadline and a hedged second request.
+
+    If the first request hasn't answered after the 95th percentile of the
+    recent latencies, the same request is sent once more and the first
+    answer is used, the other is discarded. By definition only about one
+    in twenty requests is hedged, and max_hedge_ratio caps it, e.g. when
+    Google Music is slow for everybody and all requests take long.
+
+    """
+
+    def __init__(self, scheduler, deadline=8.0, percentile=0.95, initial_delay=1.0, min_samples=20, window=200,
+                 max_hedge_ratio=0.1):
+        """
+        Keyword arguments:
+        scheduler -- CallScheduler running the requests
+        deadline -- seconds after which the resolution fails with DeadlineExceeded
+        percentile -- percentile of the latencies after which a request is hedged
+        initial_delay -- seconds after which a request is hedged until min_samples latencies are known
+        min_samples -- number of latencies needed to use the percentile
+        window -- number of recent latencies the percentile is computed from
+        max_hedge_ratio -- largest fraction of the requests which are hedged, in the long run
+
+        """
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self._latencies = deque(maxlen=window)
+        self._budget = 1.0              # Hedges which may be sent, every resolution adds max_hedge_ratio
+        self._stats = {
+            'resolutions': 0,
+            'hedged': 0,
+            'hedge_won': 0,             # Hedges which answered first
+            'deadline_exceeded': 0,
+            'failed': 0,
+            'fallbacks': 0              # Other tracks played as the deadline was exceeded
+        }
+
+    def hedge_delay(self):
+        """ Returns the seconds after which a request is hedged.
+
+        """
+        if len(self._latencies) < self.min_samples:
+            delay = self.initial_delay
+        else:
+            delay = _percentile(self._latencies, self.percentile)
+        # The hedge needs time to answer before the deadline, too
+        return min(delay, self.deadline / 2)
+
+    def resolve(self, f, *args):
+        """ Call the blocking f, e.g. get_stream_url, hedged and with a deadline.
+
+        Returns:
+        Deferred firing with the first result or failing with DeadlineExceeded
+        or the failure of the last request
+
+        """
+        self._stats['resolutions'] += 1
+        self._budget = min(MAX_HEDGE_BURST, self._budget + self.max_hedge_ratio)
+        resolution = _Resolution(f, args)
+        self._request(resolution, False)
+        resolution.timers.append(reactor.callLater(self.deadline, self._expired, resolution))
+        resolution.timers.append(reactor.callLater(self.hedge_delay(), self._hedge, resolution))
+        return resolution.d
+
+    def fell_back(self):
+        """ Count another track played because a stream url wasn't resolved in time.
+
+        """
+        self._stats['fallbacks'] += 1
+
+    def stats(self):
+        """ Returns a dict of counters, the hedge delay and the latency percentiles.
+
+        """
+        stats = dict(self._stats, hedge_delay=self.hedge_delay())
+        if self._latencies:
+            stats.update(latency_p50=_percentile(self._latencies, 0.5),
+                         latency_p95=_percentile(self._latencies, 0.95),
+                         latency_p99=_percentile(self._latencies, 0.99))
+        return stats
+
+    def _request(self, resolution, hedge):
+        resolution.pending += 1
+        d = self.scheduler.call(Priority.PLAYBACK, resolution.f, *resolution.args)
+        d.addBoth(self._answered, resolution, hedge, time.time())
+
+    def _hedge(self, resolution):
+        if resolution.d.called:
+            return
+        if self._budget >= 1:
+            self._budget -= 1
+            self._stats['hedged'] += 1
+            self._request(resolution, True)
+        elif resolution.pending == 0:
+            self._fail(resolution, resolution.failure)
+
+    def _answered(self, result, resolution, hedge, started):
+        resolution.pending -= 1
+        failed = isinstance(result, Failure)
+        if not failed:
+            self._latencies.append(time.time() - started)
+        if resolution.d.called:
+            # The loser, or an answer after the deadline
+            return None
+
+        if failed:
+            resolution.failure = result
+            if resolution.pending == 0:
+                hedge_timer = resolution.timers[1]
+                if hedge_timer.active():
+                    # The first request failed early, the hedge is sent right away instead
+                    hedge_timer.cancel()
+                    self._hedge(resolution)
+                else:
+                    self._fail(resolution, result)
+            return None
+
+        if hedge:
+            self._stats['hedge_won'] += 1
+        self._finish(resolution)
+        resolution.d.callback(result)
+        return None
+
+    def _fail(self, resolution, failure):
+        self._stats['failed'] += 1
+        self._finish(resolution)
+        resolution.d.errback(failure)
+
+    def _expired(self, resolution):
+        self._stats['deadline_exceeded'] += 1
+        self._finish(resolution)
+        resolution.d.errback(DeadlineExceeded('no stream url after {0:.1f}s'.format(self.deadline)))
+
+    @staticmethod
+    def _finish(resolution):
+        for timer in resolution.timers:
+            if timer.active():
+                timer.cancel()
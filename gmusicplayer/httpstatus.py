@@ -0,0 +1,253 @@
+__author__ = 'daniel michels'
+
+import json
+import hashlib
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web import resource, server
+
+
+class _Document(object):
+    """ A JSON document serialized once per change, with its strong ETag.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.body = None
+        self.etag = None
+        self.seq = 0                    # Sequence number of the last change
+        self.frame = None               # The document as Server-Sent Event
+
+    def update(self, value, seq):
+        """ Replace the document.
+
+        Returns:
+        True if the document changed. Else False
+
+        """
+        body = json.dumps(value, sort_keys=True).encode('utf-8')
+        if body == self.body:
+            return False
+        self.body = body
+        self.etag = '"{0}"'.format(hashlib.sha1(body).hexdigest()[:20]).encode('ascii')
+        self.seq = seq
+        self.frame = b'id: ' + str(seq).encode('ascii') + b'\nevent: ' + self.name.encode('ascii') + \
+            b'\ndata: ' + body + b'\n\n'
+        return True
+
+
+class HttpStatus(resource.Resource):
+    """ Plain HTTP view of the player for clients which don't speak WAMP.
+
+    '/status/now-playing' -- current track, playtype and playback state
+    '/status/playlist-version' -- content hash and length of the playlist
+    '/status/playlist' -- the playlist, its ETag is the playlist version
+    '/status/events' -- Server-Sent Events stream of the two documents above
+
+    The documents are serialized once per change and the same bytes are
+    sent to every client. They carry strong ETags, so pollers sending
+    If-None-Match get a 304. A poller adding '?wait=<seconds>' is parked
+    until the document changes instead, and answered with 304 if it
+    doesn't change in time. Since the position moves all the time, the
+    now-playing document contains the time the track started at.
+
+    """
+
+    isLeaf = True
+
+    # Longest long-poll in seconds
+    MAX_WAIT = 60
+
+    def __init__(self, musicplayer, playlist_topics, keepalive=20.0):
+        """
+        Keyword arguments:
+        musicplayer -- the MusicPlayer or its CoreClient replica
+        playlist_topics -- topics of the events which change the playlist
+        keepalive -- seconds between two comments sent to the event streams
+
+        """
+        resource.Resource.__init__(self)
+        self.musicplayer = musicplayer
+        self.playlist_topics = frozenset(playlist_topics)
+        self._seq = 0
+        self._now_playing = _Document('now-playing')
+        self._playlist_version = _Document('playlist-version')
+        self._documents = {d.name: d for d in (self._now_playing, self._playlist_version)}
+        self._playlist = None           # (ETag, body) of the serialized playlist
+        self._waiters = {}              # Document name -> parked long-poll requests
+        self._streams = set()           # Requests of the event streams
+        self._refresh_call = None
+        self._playlist_dirty = True
+        self._keepalive = LoopingCall(self._ping)
+        self._keepalive_interval = keepalive
+        self._stats = {
+            'requests': 0,
+            'not_modified': 0,          # Requests answered with 304
+            'long_polls': 0,
+            'woken': 0,                 # Parked requests answered because of a change
+            'streams': 0,               # Event streams opened
+            'changes': 0,               # Documents changed
+            'bytes_served': 0
+        }
+        self._refresh()
+
+    def changed(self, topic, payload):
+        """ An event was published, refresh the documents.
+
+        Several events in one reactor iteration cause one refresh.
+
+        """
+        if topic in self.playlist_topics:
+            self._playlist_dirty = True
+        if self._refresh_call is None:
+            self._refresh_call = reactor.callLater(0, self._refresh)
+
+    def stats(self):
+        """ Returns a dict of counters describing the HTTP clients.
+
+        """
+        stats = dict(self._stats)
+        stats['waiting'] = sum(len(waiters) for waiters in self._waiters.values())
+        stats['streaming'] = len(self._streams)
+        return stats
+
+    def render_GET(self, request):
+        self._stats['requests'] += 1
+        name = request.postpath[0] if request.postpath else None
+        request.setHeader(b'cache-control', b'no-cache')
+
+        if name == 'events':
+            return self._stream(request)
+        if name == 'playlist':
+            return self._render_playlist(request)
+
+        document = self._documents.get(name)
+        if document is None:
+            request.setResponseCode(404)
+            return b''
+
+        if request.getHeader('if-none-match') != document.etag:
+            return self._render(request, document)
+
+        wait = self._wait(request)
+        if not wait:
+            return self._not_modified(request, document.etag)
+
+        # Park the request until the document changes
+        self._stats['long_polls'] += 1
+        waiters = self._waiters.setdefault(name, set())
+        waiters.add(request)
+        timeout = reactor.callLater(wait, self._timed_out, request, document)
+        request.notifyFinish().addBoth(self._finished, name, request, timeout)
+        return server.NOT_DONE_YET
+
+    def _wait(self, request):
+        try:
+            wait = float(request.args.get(b'wait', [0])[0])
+        except ValueError:
+            return 0
+        return max(0, min(wait, self.MAX_WAIT))
+
+    def _render(self, request, document):
+        request.setHeader(b'etag', document.etag)
+        request.setHeader(b'content-type', b'application/json')
+        self._stats['bytes_served'] += len(document.body)
+        return document.body
+
+    def _not_modified(self, request, etag):
+        self._stats['not_modified'] += 1
+        request.setHeader(b'etag', etag)
+        request.setResponseCode(304)
+        return b''
+
+    def _render_playlist(self, request):
+        etag = self._playlist_version.etag
+        if request.getHeader('if-none-match') == etag:
+            return self._not_modified(request, etag)
+
+        # Serialized on the first request after a change only
+        if self._playlist is None or self._playlist[0] != etag:
+            self._playlist = (etag, json.dumps(self.musicplayer.playlist).encode('utf-8'))
+        request.setHeader(b'etag', etag)
+        request.setHeader(b'content-type', b'application/json')
+        self._stats['bytes_served'] += len(self._playlist[1])
+        return self._playlist[1]
+
+    def _stream(self, request):
+        self._stats['streams'] += 1
+        request.setHeader(b'content-type', b'text/event-stream')
+        request.write(b'retry: 5000\n\n')
+
+        # Send the documents the client hasn't seen yet
+        try:
+            last_seen = int(request.getHeader('last-event-id'))
+        except (TypeError, ValueError):
+            last_seen = -1
+        for document in sorted(self._documents.values(), key=lambda d: d.seq):
+            if document.seq > last_seen:
+                request.write(document.frame)
+
+        self._streams.add(request)
+        if not self._keepalive.running:
+            self._keepalive.start(self._keepalive_interval, now=False)
+        request.notifyFinish().addBoth(self._stream_finished, request)
+        return server.NOT_DONE_YET
+
+    def _stream_finished(self, _, request):
+        self._streams.discard(request)
+        if not self._streams and self._keepalive.running:
+            self._keepalive.stop()
+
+    def _ping(self):
+        for request in list(self._streams):
+            request.write(b': keepalive\n\n')
+
+    def _refresh(self):
+        self._refresh_call = None
+        self._update(self._now_playing, self._now_playing_value())
+        if self._playlist_dirty:
+            self._playlist_dirty = False
+            self._update(self._playlist_version, self._playlist_version_value())
+
+    def _update(self, document, value):
+        if not document.update(value, self._seq + 1):
+            return
+        self._seq += 1
+        self._stats['changes'] += 1
+
+        # Wake the parked pollers and the event streams with the same bytes
+        for request in list(self._waiters.pop(document.name, ())):
+            self._stats['woken'] += 1
+            request.write(self._render(request, document))
+            request.finish()
+        for request in list(self._streams):
+            request.write(document.frame)
+
+    def _now_playing_value(self):
+        # The start time of the clock only changes with the playback state or a resync,
+        # unlike the position and the time of the status
+        status = dict(self.musicplayer.playback.status() or {})
+        position = status.pop('position', None)
+        status.pop('updatedAt', None)
+        if position is not None and status.get('paused'):
+            status['position'] = int(position)
+        return status
+
+    def _playlist_version_value(self):
+        playlist = self.musicplayer.playlist
+        ids = u'\n'.join(track['id'] for track in playlist)
+        return {'version': hashlib.sha1(ids.encode('utf-8')).hexdigest()[:16], 'tracks': len(playlist)}
+
+    def _timed_out(self, request, document):
+        waiters = self._waiters.get(document.name, ())
+        if request in waiters:
+            waiters.discard(request)
+            request.write(self._not_modified(request, document.etag))
+            request.finish()
+
+    def _finished(self, _, name, request, timeout):
+        self._waiters.get(name, set()).discard(request)
+        if timeout.active():
+            timeout.cancel()
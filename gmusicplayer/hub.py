@@ -0,0 +1,197 @@
+__author__ = 'daniel michels'
+
+import time
+from collections import deque
+
+from autobahn.wamp import WampProtocol
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+
+class BroadcastHub(object):
+    """ Fans events out to all WAMP sessions of a factory.
+
+    Every session gets an outgoing queue which is drained as fast as its
+    connection accepts data. An event is serialized once per payload mode
+    and the same prepared message is queued for every subscriber. Events of
+    the coalesced topics replace an older event of the same topic which is
+    still queued, so a slow client only gets the latest position. A client
+    whose queue overflows nonetheless is sent the resync event instead of
+    the queued events, telling it to reload the state. Clients which keep
+    falling behind, i.e. are resynced max_resyncs times within
+    resync_window seconds, are dropped.
+
+    """
+
+    def __init__(self, factory, encode, coalesce=(), resync_topic=None, max_queue=256, max_resyncs=3,
+                 resync_window=60.0):
+        """
+        Keyword arguments:
+        factory -- the WampServerFactory of the sessions
+        encode -- callable(topic, payload, mode) returning the event payload for a payload mode
+        coalesce -- topics of which only the latest queued event is sent
+        resync_topic -- topic of the event sent instead of the dropped events or None
+        max_queue -- number of events queued per session before it's resynced
+        max_resyncs -- number of resyncs within resync_window after which a session is dropped
+        resync_window -- seconds in which the resyncs of a session are counted
+
+        """
+        self.factory = factory
+        self.encode = encode
+        self.coalesce = frozenset(coalesce)
+        self.resync_topic = resync_topic
+        self.max_queue = max_queue
+        self.max_resyncs = max_resyncs
+        self.resync_window = resync_window
+        self._outboxes = {}             # Protocol -> _Outbox
+        self._stats = {
+            'published': 0,             # Events published
+            'delivered': 0,             # Messages written to connections
+            'bytes': 0,                 # Bytes of the delivered messages, before compression
+            'coalesced': 0,             # Queued events replaced by a newer one
+            'resyncs': 0,
+            'dropped': 0,               # Sessions disconnected for being too slow
+            'max_queued': 0             # Longest queue seen
+        }
+
+    def attach(self, proto):
+        """ Start delivering events to a session.
+
+        """
+        if proto not in self._outboxes:
+            outbox = self._outboxes[proto] = _Outbox(self, proto)
+            proto.registerProducer(outbox, True)
+
+    def detach(self, proto):
+        """ Forget a session, e.g. because its connection was lost.
+
+        """
+        outbox = self._outboxes.pop(proto, None)
+        if outbox is not None:
+            outbox.close()
+
+    def publish(self, topic, payload):
+        """ Send an event to all subscribers of topic.
+
+        Keyword arguments:
+        topic -- the topic uri
+        payload -- the event as plain value, see encode
+
+        """
+        self._stats['published'] += 1
+        prepared = {}                   # Payload mode -> prepared message
+        for proto in tuple(self.factory.subscriptions.get(topic, ())):
+            outbox = self._outboxes.get(proto)
+            if outbox is None:
+                continue
+            mode = getattr(proto, 'payload_mode', None)
+            if mode not in prepared:
+                prepared[mode] = self._prepare(topic, self.encode(topic, payload, mode))
+            outbox.put(topic, prepared[mode])
+
+    def stats(self):
+        """ Returns a dict of counters describing the fan-out.
+
+        """
+        stats = dict(self._stats)
+        stats['sessions'] = len(self._outboxes)
+        stats['queued'] = sum(len(outbox) for outbox in self._outboxes.values())
+        stats['paused'] = sum(1 for outbox in self._outboxes.values() if outbox.paused)
+        return stats
+
+    def _prepare(self, topic, event):
+        message = self.factory._serialize([WampProtocol.MESSAGE_TYPEID_EVENT, topic, event])
+        prepared = self.factory.prepareMessage(message)
+        prepared.size = len(message)
+        return prepared
+
+    def _overflow(self, outbox):
+        if outbox.recent_resyncs(self.resync_window) >= self.max_resyncs or self.resync_topic is None:
+            self._stats['dropped'] += 1
+            self.detach(outbox.proto)
+            outbox.proto.dropConnection(abort=True)
+            return
+        self._stats['resyncs'] += 1
+        outbox.resync(self._prepare(self.resync_topic, None))
+
+
+@implementer(IPushProducer)
+class _Outbox(object):
+    """ Queue of the prepared messages to send to one session.
+
+    """
+
+    def __init__(self, hub, proto):
+        self.hub = hub
+        self.proto = proto
+        self.paused = False             # Whether the connection's write buffer is full
+        self.closed = False
+        self.resyncs = deque()          # Times of the resyncs, the oldest first
+        self._queue = deque()           # [topic, prepared message]
+        self._latest = {}               # Coalesced topic -> its entry in the queue
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, topic, message):
+        if topic in self._latest:
+            # Replace the stale event in place, keeping the order of the topics
+            self._latest[topic][1] = message
+            self.hub._stats['coalesced'] += 1
+            return
+        entry = [topic, message]
+        self._queue.append(entry)
+        if topic in self.hub.coalesce:
+            self._latest[topic] = entry
+
+        queued = len(self._queue)
+        if queued > self.hub._stats['max_queued']:
+            self.hub._stats['max_queued'] = queued
+        if queued > self.hub.max_queue:
+            self.hub._overflow(self)
+        else:
+            self._flush()
+
+    def recent_resyncs(self, window):
+        # Forget the resyncs which are older than window seconds
+        expired = time.time() - window
+        while self.resyncs and self.resyncs[0] < expired:
+            self.resyncs.popleft()
+        return len(self.resyncs)
+
+    def resync(self, message):
+        # The queued events are replaced by a request to reload everything
+        self.resyncs.append(time.time())
+        self._queue.clear()
+        self._latest.clear()
+        self._queue.append([None, message])
+        self._flush()
+
+    def close(self):
+        self.closed = True
+        self._queue.clear()
+        self._latest.clear()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._flush()
+
+    def stopProducing(self):
+        self.close()
+
+    def _flush(self):
+        stats = self.hub._stats
+        while self._queue and not self.paused and not self.closed:
+            topic, message = self._queue.popleft()
+            self._latest.pop(topic, None)
+            try:
+                self.proto.sendPreparedMessage(message)
+            except Exception:
+                # The connection is going away, connectionLost will detach it
+                self.close()
+                return
+            stats['delivered'] += 1
+            stats['bytes'] += message.size
@@ -0,0 +1,175 @@
+__author__ = 'daniel michels'
+
+import os
+import sys
+import time
+import threading
+from collections import deque
+
+from twisted.internet import reactor
+
+from gmusicplayer.metrics import Histogram
+
+# Frames of files below this directory belong to the player, the others to libraries
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Upper bounds in seconds of the buckets of the lag histogram
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LagMonitor(object):
+    """ Watchdog of the reactor which finds the calls blocking it.
+
+    A timer on the reactor measures how late every tick runs. A sampler
+    thread checks when the reactor ticked last and, once it's more than
+    threshold seconds late, takes the stack of the reactor thread every
+    sample_interval seconds until the reactor runs again. The stall is then
+    logged with the stack seen most often and the innermost function of the
+    player in it, which is the one that made the blocking call.
+
+    Sampling only happens during stalls, otherwise the costs are a timer
+    call per interval on the reactor and a comparison per sample_interval
+    in the thread.
+
+    """
+
+    def __init__(self, threshold=0.25, interval=0.1, sample_interval=0.02, window=600, metrics=None):
+        """
+        Keyword arguments:
+        threshold -- seconds of lag above which a stall is logged
+        interval -- seconds between two ticks
+        sample_interval -- seconds between two stack samples during a stall
+        window -- number of recent ticks the percentiles are computed from
+        metrics -- MetricsRegistry to record the lag in or None
+
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_interval = sample_interval
+        self._lags = deque(maxlen=window)
+        self._stalls = deque(maxlen=20)     # Reports of the recent stalls
+        self._expected = None               # Time the next tick is due
+        self._reactor_thread = None
+        self._samples = {}                  # Stack -> times sampled during the current stall
+        self._tick_call = None
+        self._sampler = None
+        self._running = False
+        self._histogram = None
+        if metrics is not None:
+            self._histogram = metrics.add(Histogram('gmusicplayer_reactor_lag_seconds',
+                                                    'Delay of the reactor ticks, in seconds', buckets=LAG_BUCKETS))
+        self._stats = {
+            'ticks': 0,
+            'stalls': 0,
+            'samples': 0,
+            'max_lag': 0.0
+        }
+
+    def start(self):
+        """ Start ticking and sampling, call it from the reactor thread.
+
+        """
+        if self._running:
+            return
+        self._running = True
+        self._reactor_thread = threading.current_thread().ident
+        self._expected = time.time() + self.interval
+        self._tick_call = reactor.callLater(self.interval, self._tick)
+        self._sampler = threading.Thread(target=self._sample_loop, name='lag-sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """ Stop ticking and wait for the sampler thread to end.
+
+        """
+        self._running = False
+        if self._tick_call is not None and self._tick_call.active():
+            self._tick_call.cancel()
+        self._tick_call = None
+        if self._sampler is not None:
+            self._sampler.join(1.0)
+            self._sampler = None
+
+    def stalls(self):
+        """ Returns the reports of the recent stalls, the newest first.
+
+        """
+        return list(reversed(self._stalls))
+
+    def stats(self):
+        """ Returns a dict of counters and the percentiles of the recent lags.
+
+        """
+        stats = dict(self._stats)
+        lags = sorted(self._lags)
+        if lags:
+            stats.update(lag_p50=_percentile(lags, 0.5), lag_p95=_percentile(lags, 0.95),
+                         lag_p99=_percentile(lags, 0.99))
+        return stats
+
+    def _tick(self):
+        now = time.time()
+        lag = max(0.0, now - self._expected)
+        self._lags.append(lag)
+        self._stats['ticks'] += 1
+        self._stats['max_lag'] = max(self._stats['max_lag'], lag)
+        if self._histogram is not None:
+            self._histogram.observe(lag)
+
+        samples, self._samples = self._samples, {}
+        if lag >= self.threshold:
+            self._stalled(lag, samples)
+
+        if self._running:
+            self._expected = now + self.interval
+            self._tick_call = reactor.callLater(self.interval, self._tick)
+
+    def _stalled(self, lag, samples):
+        self._stats['stalls'] += 1
+        report = {'time': time.time(), 'lag': lag, 'samples': sum(samples.values()), 'function': None, 'stack': []}
+        if samples:
+            stack = max(samples, key=samples.get)
+            report['stack'] = ['{0}:{1} in {2}'.format(filename, lineno, name) for filename, lineno, name in stack]
+            report['function'] = self._culprit(stack)
+        self._stalls.append(report)
+
+        print("reactor blocked for %.3fs in %s" % (lag, report['function'] or 'an unknown function'))
+        for line in report['stack']:
+            print("    " + line)
+
+    @staticmethod
+    def _culprit(stack):
+        # The innermost frame of the player, or the innermost at all if the player isn't on the stack
+        for filename, lineno, name in reversed(stack):
+            if os.path.abspath(filename).startswith(PROJECT_DIR + os.sep):
+                return '{0} ({1}:{2})'.format(name, os.path.relpath(filename, PROJECT_DIR), lineno)
+        filename, lineno, name = stack[-1]
+        return '{0} ({1}:{2})'.format(name, filename, lineno)
+
+    def _sample_loop(self):
+        # Runs in the sampler thread
+        while self._running:
+            time.sleep(self.sample_interval)
+            expected = self._expected
+            if expected is not None and time.time() - expected >= self.threshold:
+                self._sample()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._reactor_thread)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        # Only the thread samples, the reactor swaps the dict when it's back
+        samples = self._samples
+        samples[stack] = samples.get(stack, 0) + 1
+        self._stats['samples'] += 1
@@ -0,0 +1,270 @@
+__author__ = 'daniel michels'
+
+import time
+import weakref
+from numbers import Number
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web import resource
+
+# Upper bounds in seconds of the latency buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Metric(object):
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}               # Label values -> value
+        # Timed calls run in threads as well, e.g. those to Google Music
+        self._lock = Lock()
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} {1}'.format(self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for values, value in items:
+            lines.append('{0}{1} {2}'.format(self.name, _format_labels(self.labels, values), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    """ A value which only goes up.
+
+    """
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """ A value which goes up and down.
+
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) - amount
+
+
+class Histogram(_Metric):
+    """ Counts observations in buckets, e.g. latencies.
+
+    Only the bucket an observation falls into is counted, the cumulative
+    counts the text format asks for are computed when it's rendered.
+
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Counts per bucket and one for +Inf, then sum
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help), '# TYPE {0} histogram'.format(self.name)]
+        with self._lock:
+            items = [(values, (list(counts), total)) for values, (counts, total) in sorted(self._values.items())]
+        for values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, values, [('le', _format_value(float(bound)))])
+                lines.append('{0}_bucket{1} {2}'.format(self.name, labels, cumulative))
+            labels = _format_labels(self.labels, values)
+            lines.append('{0}_sum{1} {2}'.format(self.name, labels, repr(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Timer(object):
+    """ Latency histogram, error counter and in-flight gauge of an operation.
+
+    """
+
+    def __init__(self, registry, name, help, labels=()):
+        self.seconds = registry.add(Histogram(name + '_seconds', help + ', in seconds', labels))
+        self.errors = registry.add(Counter(name + '_errors_total', help + ' which failed', labels))
+        self.in_flight = registry.add(Gauge(name + '_in_flight', help + ' in progress', labels))
+
+    def start(self, labels):
+        self.in_flight.inc(labels)
+        return time.time()
+
+    def stop(self, labels, started, failed=False):
+        self.in_flight.dec(labels)
+        self.seconds.observe(time.time() - started, labels)
+        if failed:
+            self.errors.inc(labels)
+
+    def call(self, labels, f, *args, **kwargs):
+        """ Call f and time it, until its Deferred fired if it returns one.
+
+        """
+        started = self.start(labels)
+        try:
+            result = f(*args, **kwargs)
+        except Exception:
+            self.stop(labels, started, True)
+            raise
+        if isinstance(result, defer.Deferred):
+            result.addBoth(self._stopped, labels, started)
+        else:
+            self.stop(labels, started)
+        return result
+
+    def _stopped(self, result, labels, started):
+        self.stop(labels, started, isinstance(result, Failure))
+        return result
+
+
+class MetricsRegistry(resource.Resource):
+    """ Metrics of the server, served in the Prometheus text format.
+
+    Operations are timed as they happen, which costs a few dict updates
+    each, under a lock per metric as they may happen in threads. The stats() of the components are registered as collectors and
+    only read when somebody scrapes.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self._metrics = []
+        self._collectors = []           # (prefix, callable returning a stats dict)
+
+    def add(self, metric):
+        """ Register a metric.
+
+        Returns:
+        The metric
+
+        """
+        self._metrics.append(metric)
+        return metric
+
+    def timer(self, name, help, labels=()):
+        """ Returns a new Timer, see Timer.
+
+        """
+        return Timer(self, name, help, labels)
+
+    def collect(self, prefix, stats):
+        """ Export the numbers of a stats dict on every scrape.
+
+        Keyword arguments:
+        prefix -- prefix of the names of the metrics
+        stats -- callable returning a dict, nested dicts are flattened
+
+        """
+        self._collectors.append((prefix, stats))
+
+    def instrument(self, obj, timer, methods, labels=()):
+        """ Time the calls of methods of an object.
+
+        The methods are replaced by wrappers on the object itself, so the
+        class and other instances are left alone. The wrappers only keep a
+        weak reference to the object, which keeps objects with a __del__,
+        like Player, collectable.
+
+        Keyword arguments:
+        obj -- the object
+        timer -- Timer whose labels are labels followed by the method name
+        methods -- names of the methods of its class, missing ones are skipped
+        labels -- values of the leading labels of timer
+
+        """
+        ref = weakref.ref(obj)
+        for name in methods:
+            method = getattr(type(obj), name, None)
+            if method is None:
+                continue
+            setattr(obj, name, self._timed(timer, tuple(labels) + (name,), method, ref))
+
+    @staticmethod
+    def _timed(timer, labels, method, ref):
+        @wraps(method)
+        def timed(*args, **kwargs):
+            return timer.call(labels, method, ref(), *args, **kwargs)
+        return timed
+
+    def render_text(self):
+        """ Returns all metrics in the Prometheus text format.
+
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, stats in self._collectors:
+            for name, value in sorted(self._flatten(prefix, stats()).items()):
+                lines.append('# TYPE {0} untyped'.format(name))
+                lines.append('{0} {1}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+        request.setHeader(b'cache-control', b'no-cache')
+        return self.render_text().encode('utf-8')
+
+    def _flatten(self, prefix, stats):
+        values = {}
+        for key, value in (stats or {}).items():
+            name = '{0}_{1}'.format(prefix, key)
+            if isinstance(value, dict):
+                values.update(self._flatten(name, value))
+            elif isinstance(value, bool):
+                values[name] = int(value)
+            elif isinstance(value, Number):
+                values[name] = value
+        return values
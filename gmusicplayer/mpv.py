@@ -0,0 +1,368 @@
+__author__ = 'daniel michels'
+
+import os
+import json
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+from threading import Thread, Lock, Event
+
+from mplayer import EventType
+from mplayer.misc import EofEvent, AnswerEvent, StatusEvent, PlaybackStartedEvent, CacheFillEvent, CacheEmptyEvent, ExitEvent
+
+
+class MpvError(Exception):
+    """ Raised when mpv answers a request with an error.
+
+    """
+
+
+class MpvPlayer(object):
+    """ Drop-in replacement for mplayer.Player which drives mpv over its JSON IPC.
+
+    Every request carries a request_id, so answers are matched to requests
+    exactly instead of by prefix. Properties are observed asynchronously, and
+    the changes are turned into the same events mplayer's stdout wrapper
+    emits, so subscribers work with either engine.
+
+    Only the part of the Player API used by the MusicPlayer is provided:
+    loadfile, pause, stop, seek, quit, is_alive and the time_pos, length,
+    paused, percent_pos and volume properties.
+
+    """
+
+    _base_args = ('--idle=yes', '--no-video', '--no-terminal')
+    exec_path = 'mpv'
+
+    # mplayer property name -> (mpv property name, settable)
+    _properties = {
+        'time_pos': ('time-pos', True),
+        'length': ('duration', False),
+        'percent_pos': ('percent-pos', True),
+        'paused': ('pause', False),
+        'volume': ('volume', True),
+        'filename': ('filename', False)
+    }
+
+    def __init__(self, args=(), socket_path=None, autospawn=True, timeout=1.0):
+        """
+        Keyword arguments:
+        args -- additional mpv arguments
+        socket_path -- path of the IPC socket (default: a file in a temporary directory,
+                       which is removed when mpv quits or dies)
+        autospawn -- call spawn() after instantiation
+        timeout -- seconds to wait for the answer to a request
+
+        """
+        self.args = tuple(args)
+        self.socket_path = socket_path
+        self._temporary = socket_path is None   # Whether the socket is in a directory of its own
+        self.timeout = timeout
+        self._proc = None
+        self._sock = None
+        self._stdout = _EventWrapper(self)
+        self._send_lock = Lock()
+        self._pending = {}              # request_id -> _Request
+        self._next_request_id = 1
+        self._quitting = False
+        if autospawn:
+            self.spawn()
+
+    def __repr__(self):
+        if self.is_alive():
+            status = 'connected to {0}'.format(self.socket_path)
+        else:
+            status = 'not running'
+        return '<{0} {1}>'.format(self.__class__.__name__, status)
+
+    @property
+    def stdout(self):
+        """ Event publisher with the interface of the stdout of mplayer.Player """
+        return self._stdout
+
+    def spawn(self, connect_timeout=5.0):
+        """ Spawn mpv and connect to its IPC socket.
+
+        """
+        if self.is_alive():
+            return
+        if self._temporary:
+            self.socket_path = os.path.join(tempfile.mkdtemp(prefix='mpv'), 'ipc')
+        args = [self.exec_path]
+        args.extend(self._base_args)
+        args.append('--input-ipc-server={0}'.format(self.socket_path))
+        args.extend(self.args)
+        self._proc = subprocess.Popen(args, stdin=subprocess.PIPE, close_fds=True)
+
+        # mpv creates the socket once it is initialized
+        deadline = time.time() + connect_timeout
+        while True:
+            try:
+                self.connect()
+                return
+            except socket.error:
+                if time.time() > deadline or self._proc.poll() is not None:
+                    raise
+                time.sleep(0.02)
+
+    def connect(self):
+        """ Connect to the IPC socket of an already running mpv.
+
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self._sock = sock
+        self._quitting = False
+        t = Thread(target=self._thread_func, args=(sock,))
+        t.daemon = True
+        t.start()
+        self._stdout._connected()
+
+    def quit(self, retcode=0):
+        """ Terminate mpv. Returns its exit status or None if not running.
+
+        """
+        if not self.is_alive():
+            return
+        self._quitting = True
+        self.command('quit', retcode, wait=False)
+        if self._proc is not None:
+            retcode = self._proc.wait()
+            self._remove_socket()
+            return retcode
+
+    def is_alive(self):
+        """ Check if mpv is running and connected.
+
+        """
+        if self._sock is None:
+            return False
+        if self._proc is not None:
+            return self._proc.poll() is None
+        return True
+
+    def loadfile(self, path, append=None):
+        """ Load a file. If append is true, it's added to the playlist instead.
+
+        """
+        self.command('loadfile', path, 'append' if append else 'replace', wait=False)
+
+    def pause(self):
+        """ Toggle pause like mplayer's pause command.
+
+        """
+        self.command('cycle', 'pause', wait=False)
+
+    def stop(self):
+        self.command('stop', wait=False)
+
+    def seek(self, value, type=None):
+        """ Seek like mplayer's seek command.
+
+        type -- 0 is relative, 1 is a percentage and 2 is absolute (default: 0)
+
+        """
+        mode = {1: 'absolute-percent', 2: 'absolute'}.get(type, 'relative')
+        self.command('seek', value, mode, wait=False)
+
+    def get_property(self, name):
+        """ Returns the value of an mpv property or None if it's unavailable.
+
+        """
+        try:
+            return self.command('get_property', name)
+        except MpvError:
+            return None
+
+    def set_property(self, name, value):
+        self.command('set_property', name, value, wait=False)
+
+    def command(self, *args, **kwargs):
+        """ Send a command and return its data.
+
+        Waits for the answer unless wait=False is given. Raises MpvError if
+        mpv reports an error or doesn't answer in time.
+
+        """
+        wait = kwargs.get('wait', True)
+        if not self.is_alive():
+            return
+        request = None
+        with self._send_lock:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            if wait:
+                request = self._pending[request_id] = _Request()
+            message = json.dumps({'command': list(args), 'request_id': request_id}) + '\n'
+            try:
+                self._sock.sendall(message.encode('utf-8'))
+            except (socket.error, AttributeError):
+                # The connection is gone
+                self._pending.pop(request_id, None)
+                return
+        if request is None:
+            return
+        if not request.done.wait(self.timeout):
+            self._pending.pop(request_id, None)
+            raise MpvError('timeout')
+        if request.error != 'success':
+            raise MpvError(request.error)
+        return request.data
+
+    def observe_property(self, name, observer_id):
+        self.command('observe_property', observer_id, name, wait=False)
+
+    def _thread_func(self, sock):
+        reader = sock.makefile('rb')
+        while True:
+            try:
+                line = reader.readline()
+            except socket.error:
+                line = None
+            if not line:
+                break
+            try:
+                message = json.loads(line.decode('utf-8', 'ignore'))
+            except ValueError:
+                continue
+            if 'request_id' in message and 'event' not in message:
+                request = self._pending.pop(message['request_id'], None)
+                if request is not None:
+                    request.data = message.get('data')
+                    request.error = message.get('error')
+                    request.done.set()
+            else:
+                self._stdout._process_event(message)
+
+        # Fail all outstanding requests
+        self._sock = None
+        for request in list(self._pending.values()):
+            request.error = 'disconnected'
+            request.done.set()
+        self._pending.clear()
+        # mpv quit or died, nobody is going to connect to its socket again
+        self._remove_socket()
+        if not self._quitting:
+            self._stdout._emit(EventType.EXIT, ExitEvent())
+
+    def _remove_socket(self):
+        if self._temporary and self.socket_path is not None:
+            shutil.rmtree(os.path.dirname(self.socket_path), ignore_errors=True)
+
+
+def _gen_property(pname, settable):
+    def fget(self):
+        return self.get_property(pname)
+
+    def fset(self, value):
+        self.set_property(pname, value)
+
+    return property(fget, fset if settable else None, doc='mpv property {0}'.format(pname))
+
+
+for _name, (_pname, _settable) in MpvPlayer._properties.items():
+    setattr(MpvPlayer, _name, _gen_property(_pname, _settable))
+
+
+class _Request(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.data = None
+        self.error = None
+
+
+class _EventWrapper(object):
+    """ Turns mpv events and property changes into mplayer stdout events.
+
+    """
+
+    # Event type -> mpv property to observe for it
+    _observed = {
+        EventType.STATUS: 'time-pos',
+        EventType.ANSWER: 'volume',
+        EventType.CACHE_FILL: 'cache-buffering-state',
+        EventType.CACHE_EMPTY: 'paused-for-cache'
+    }
+
+    def __init__(self, player):
+        self._player = player
+        self._subscribers = []
+        self._event_subscribers = {}
+        self._observer_ids = {}
+        self._duration = None
+
+    def connect(self, subscriber):
+        """ Connect a subscriber to the raw JSON messages of mpv """
+        if subscriber not in self._subscribers:
+            self._subscribers.append(subscriber)
+
+    def disconnect(self, subscriber=None):
+        if subscriber is None:
+            self._subscribers = []
+        elif subscriber in self._subscribers:
+            self._subscribers.remove(subscriber)
+
+    def connect_event(self, etype, subscriber):
+        """ Connect a subscriber to the events of the given EventType """
+        subscribers = list(self._event_subscribers.get(etype, ()))
+        if subscriber not in subscribers:
+            subscribers.append(subscriber)
+        self._event_subscribers[etype] = subscribers
+        self._observe(etype)
+
+    def disconnect_event(self, etype, subscriber=None):
+        subscribers = list(self._event_subscribers.get(etype, ()))
+        if subscriber is None:
+            subscribers = []
+        elif subscriber in subscribers:
+            subscribers.remove(subscriber)
+        self._event_subscribers[etype] = subscribers
+
+    def _connected(self):
+        # (Re-)establish the observations on a new connection
+        self._observer_ids = {}
+        self._observe_property('duration')
+        for etype in list(self._event_subscribers):
+            self._observe(etype)
+
+    def _observe(self, etype):
+        if etype in self._observed:
+            self._observe_property(self._observed[etype])
+
+    def _observe_property(self, name):
+        if name in self._observer_ids or not self._player.is_alive():
+            return
+        observer_id = self._observer_ids[name] = len(self._observer_ids) + 1
+        self._player.observe_property(name, observer_id)
+
+    def _process_event(self, message):
+        event = message.get('event')
+        if self._subscribers:
+            line = json.dumps(message)
+            for subscriber in self._subscribers:
+                subscriber(line)
+        if event == 'property-change':
+            name = message.get('name')
+            data = message.get('data')
+            if name == 'duration':
+                self._duration = data
+            elif name == 'time-pos' and data is not None:
+                self._emit(EventType.STATUS, StatusEvent(float(data), self._duration))
+            elif name == 'volume' and data is not None:
+                self._emit(EventType.ANSWER, AnswerEvent('volume', str(data)))
+            elif name == 'cache-buffering-state' and data is not None:
+                self._emit(EventType.CACHE_FILL, CacheFillEvent(float(data), None))
+            elif name == 'paused-for-cache' and data:
+                self._emit(EventType.CACHE_EMPTY, CacheEmptyEvent())
+        elif event == 'file-loaded':
+            self._emit(EventType.PLAYBACK_STARTED, PlaybackStartedEvent())
+        elif event == 'end-file':
+            # Use mplayer's EOF codes: 1 for the end of the file, 4 otherwise
+            self._emit(EventType.EOF, EofEvent(1 if message.get('reason') == 'eof' else 4))
+
+    def _emit(self, etype, event):
+        for subscriber in self._event_subscribers.get(etype, ()):
+            subscriber(event)
@@ -0,0 +1,50 @@
+__author__ = 'daniel michels'
+
+import json
+
+from enum import Enum
+
+try:
+    from autobahn.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+except ImportError:
+    # autobahn without WebSocket compression
+    PerMessageDeflateOffer = PerMessageDeflateOfferAccept = None
+
+
+class PayloadMode(Enum):
+    """ Describes how RPC results and events are put into WAMP messages.
+
+    """
+    LEGACY = 'json'             # Serialized to a JSON string, which WAMP encodes again
+    STRUCTURED = 'structured'   # Sent as is and encoded by WAMP only once
+
+
+def encode(value, mode):
+    """ Returns value as payload of a message to a client in the given mode.
+
+    """
+    if mode == PayloadMode.LEGACY:
+        return json.dumps(value)
+    return value
+
+
+def enable_compression(factory):
+    """ Let the clients of a WampServerFactory negotiate permessage-deflate.
+
+    Clients which don't offer the extension keep talking uncompressed.
+
+    Returns:
+    True if autobahn supports compression. Else False
+
+    """
+    if PerMessageDeflateOffer is None:
+        return False
+
+    def accept(offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(offer)
+        return None
+
+    factory.setProtocolOptions(perMessageCompressionAccept=accept)
+    return True
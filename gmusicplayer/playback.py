@@ -0,0 +1,243 @@
+__author__ = 'daniel michels'
+
+import json
+import time
+
+from mplayer import EventType
+from twisted.internet import reactor, threads
+from twisted.internet.task import LoopingCall
+
+
+class PlaybackClock(object):
+    """ Server-side model of the playback state.
+
+    The state (track, start time, paused intervals, volume and playtype) is
+    maintained from the events of the MusicPlayer, so the position of the
+    current track can be computed without asking mplayer. A serialized
+    snapshot of the state is kept ready for get_status and refreshed whenever
+    the state changes or a position update is published. Besides the
+    position it carries startedAt, the time the track would have started at
+    without pauses, and updatedAt, the time of the snapshot, so a client can
+    tell the current position from a snapshot of a few seconds ago. The
+    volume is asked from mplayer with every position update, time_pos right
+    before it when resyncing, as the player answers one query at a time.
+
+    """
+
+    def __init__(self, publish, topic, position_interval=5.0, resync_interval=60.0, tolerance=0.5):
+        """
+        Keyword arguments:
+        publish -- callable(topic, payload) used to publish position updates
+        topic -- topic of the position updates
+        position_interval -- seconds between two position updates
+        resync_interval -- seconds between two comparisons with mplayer's time_pos
+        tolerance -- drift in seconds which is tolerated before resyncing
+
+        """
+        self.publish = publish
+        self.topic = topic
+        self.position_interval = position_interval
+        self.resync_interval = resync_interval
+        self.tolerance = tolerance
+
+        self.track = None           # Track which is playing
+        self.started = None         # Time at which the track would have started without pauses
+        self.paused_at = None       # Time at which playback has been paused
+        self.paused_total = 0.0     # Seconds the current track has been paused for
+        self.volume = None          # Last volume reported by mplayer
+        self.playtype = None        # Current playtype
+        self.player = None          # Player used to resync the clock
+
+        self._status = None
+        self._snapshot = None
+        self._last_resync = 0
+        self._last_status = 0
+        self._generation = 0            # Incremented with every track_started()
+        self._status_generation = 0     # Generation the status lines read belong to
+        self._ticker = LoopingCall(self._tick)
+        self._update_snapshot()
+
+    def observe(self, player):
+        """ Pick up volume and position answers of a player.
+
+        Keyword arguments:
+        player -- the Player instance to observe
+
+        """
+        self.player = player
+        player.stdout.connect_event(EventType.ANSWER, self._on_answer)
+        player.stdout.connect_event(EventType.STATUS, self._on_status)
+        player.stdout.connect_event(EventType.PLAYBACK_STARTED, self._on_playback_started)
+        self._query()
+
+    def position(self):
+        """ Returns the position of the current track in seconds or None.
+
+        """
+        if self.started is None:
+            return None
+        now = self.paused_at if self.paused_at is not None else time.time()
+        return max(0.0, now - self.started)
+
+    def duration(self):
+        """ Returns the duration of the current track in seconds or None.
+
+        """
+        if self.track is None:
+            return None
+        return int(self.track['durationMillis']) / 1000.0
+
+    def is_paused(self):
+        return self.paused_at is not None
+
+    def status(self):
+        """ Returns the status as dict without contacting mplayer, with the current position.
+
+        """
+        return dict(self._status, position=self.position(), updatedAt=time.time())
+
+    def snapshot(self):
+        """ Returns the serialized status without contacting mplayer.
+
+        """
+        return self._snapshot
+
+    def track_started(self, track, position=0):
+        """ A track started playing.
+
+        Keyword arguments:
+        track -- the track that is playing
+        position -- position in seconds the track started at
+
+        """
+        self.track = track
+        self._generation += 1
+        self.started = time.time() - position
+        self.paused_at = None
+        self.paused_total = 0.0
+        self._last_resync = time.time()
+        if not self._ticker.running:
+            self._ticker.start(self.position_interval, now=False)
+        self._changed()
+
+    def stopped(self):
+        """ Playback has been stopped.
+
+        """
+        self.started = None
+        self.paused_at = None
+        if self._ticker.running:
+            self._ticker.stop()
+        self._changed()
+
+    def paused(self):
+        """ Playback has been paused.
+
+        """
+        if self.started is not None and self.paused_at is None:
+            self.paused_at = time.time()
+            self._changed()
+
+    def resumed(self):
+        """ Playback has been resumed after a pause.
+
+        """
+        if self.paused_at is not None:
+            paused_for = time.time() - self.paused_at
+            self.started += paused_for
+            self.paused_total += paused_for
+            self.paused_at = None
+            self._changed()
+
+    def set_playtype(self, playtype):
+        self.playtype = playtype
+        self._update_snapshot()
+
+    def _changed(self):
+        self._update_snapshot()
+        self._publish_position()
+
+    def _update_snapshot(self):
+        status = dict()
+        status['currentTrack'] = self.track
+        status['playtype'] = self.playtype
+        status['playing'] = self.started is not None
+        status['paused'] = self.is_paused()
+        status['position'] = self.position()
+        status['startedAt'] = self.started if self.started is not None and not self.is_paused() else None
+        status['updatedAt'] = time.time()
+        status['duration'] = self.duration()
+        status['volume'] = self.volume
+        self._status = status
+        self._snapshot = json.dumps(status)
+
+    def _publish_position(self):
+        position = dict()
+        position['playing'] = self.started is not None
+        position['paused'] = self.is_paused()
+        position['position'] = self.position()
+        position['duration'] = self.duration()
+        self.publish(self.topic, position)
+
+    def _tick(self):
+        self._update_snapshot()
+        self._publish_position()
+
+        # Compare with mplayer's clock every once in a while
+        resync = not self.is_paused() and time.time() - self._last_resync >= self.resync_interval
+        if resync:
+            self._last_resync = time.time()
+        self._query(resync)
+
+    def _query(self, resync=False):
+        # The volume is needed to restore a respawned player, nothing else asks
+        # for it. Both properties are asked in the same thread, one after the
+        # other. The volume is picked up by _on_answer.
+        if self.player is None:
+            return
+        d = threads.deferToThread(_query_player, self.player, resync)
+        if resync:
+            generation = self._generation
+            d.addCallback(lambda answer: self._resync(answer[0], answer[1], generation))
+
+    def _resync(self, time_pos, requested_at, generation):
+        # Positions of a track which has been replaced since are ignored
+        if time_pos is None or self.started is None or self.is_paused() or generation != self._generation:
+            return
+        drift = (requested_at - self.started) - time_pos
+        if abs(drift) > self.tolerance:
+            self.started += drift
+            self._update_snapshot()
+
+    def _on_answer(self, event):
+        # Called by the stdout reader
+        if event.name == 'volume' and event.value is not None:
+            reactor.callFromThread(self._set_volume, float(event.value))
+
+    def _on_status(self, event):
+        # Called by the stdout reader several times per second. Status lines
+        # come for free, so use them to resync once per second.
+        now = time.time()
+        if now - self._last_status >= 1.0:
+            self._last_status = now
+            reactor.callFromThread(self._resync, event.time_pos, now, self._status_generation)
+
+    def _on_playback_started(self, event):
+        # Called by the stdout reader. The status lines which follow belong to
+        # the track loaded last, those before it to the previous one.
+        reactor.callFromThread(self._playback_started)
+
+    def _playback_started(self):
+        self._status_generation = self._generation
+
+    def _set_volume(self, volume):
+        self.volume = volume
+        self._update_snapshot()
+
+
+def _query_player(player, time_pos):
+    # Called in a thread, as the answers are waited for
+    requested_at = time.time()
+    position = player.time_pos if time_pos else None
+    player.volume
+    return position, requested_at
@@ -0,0 +1,241 @@
+__author__ = 'daniel michels'
+
+import time
+from collections import OrderedDict
+
+
+class Playlist(object):
+    """ A loaded playlist and where the player is in it.
+
+    """
+
+    def __init__(self, playlist_id, name, tracks):
+        self.id = playlist_id
+        self.name = name
+        self.tracks = tracks            # Array of all tracks, the MusicPlayer's playlist while active
+        self.cursor = 0                 # Index of the current track
+        self.playtype = None            # Value of the PlayType, None for the default
+        self.refreshed = time.time()
+
+    def summary(self):
+        return {'id': self.id, 'name': self.name, 'tracks': len(self.tracks)}
+
+    def position(self):
+        """ Returns (id of the current track, cursor, playtype), to restore them with restore().
+
+        """
+        current = self.tracks[self.cursor]['id'] if self.cursor < len(self.tracks) else None
+        return current, self.cursor, self.playtype
+
+    def restore(self, position):
+        """ Go back to a position, to the same track if it's still there.
+
+        """
+        current, cursor, self.playtype = position
+        ids = [track['id'] for track in self.tracks]
+        self.cursor = ids.index(current) if current in ids else max(0, min(cursor, len(self.tracks) - 1))
+
+
+def _tracks(playlist):
+    # The entry id identifies a track in the playlist, the same song may be in it twice
+    tracks = []
+    for track_obj in playlist['tracks']:
+        if 'track' in track_obj:
+            track_obj['track']['id'] = track_obj['id']
+            tracks.append(track_obj['track'])
+    return tracks
+
+
+class PlaylistManager(object):
+    """ Track-bounded LRU of the playlists held in memory.
+
+    The playlists of the account are listed as fetched by
+    get_all_user_playlist_contents, their tracks are only kept for the
+    recently used ones. Every loaded playlist keeps its cursor and play
+    type, so switching back continues where it was left. The least
+    recently used playlists are dropped once they hold more than
+    max_tracks tracks in total, only their positions are kept. The active
+    one is never dropped and is only changed by the MusicPlayer, not by a
+    refresh.
+
+    """
+
+    def __init__(self, max_tracks=20000):
+        """
+        Keyword arguments:
+        max_tracks -- total number of tracks of the loaded playlists
+
+        """
+        self.max_tracks = max_tracks
+        self.active = None              # The Playlist being played
+        self._loaded = OrderedDict()    # Id -> Playlist, least recently used first
+        self._index = OrderedDict()     # Id -> summary of every playlist of the account
+        self._positions = {}            # Id -> position of the playlists dropped from memory
+        self._stats = {
+            'switches': 0,
+            'hits': 0,                  # Switches to a loaded playlist
+            'misses': 0,                # Switches which had to fetch the playlist
+            'evictions': 0,
+            'refreshes': 0
+        }
+
+    def __contains__(self, playlist_id):
+        return playlist_id in self._loaded
+
+    def get(self, playlist_id):
+        """ Returns a loaded Playlist or None.
+
+        """
+        return self._loaded.get(playlist_id)
+
+    def add(self, playlist_id, name, tracks=None):
+        """ Load a playlist, e.g. one which has just been created.
+
+        Returns:
+        The Playlist
+
+        """
+        playlist = self._new(playlist_id, name, tracks if tracks is not None else [])
+        self._index[playlist_id] = playlist.summary()
+        self._store(playlist)
+        return playlist
+
+    def update(self, playlists):
+        """ Take the playlists fetched by get_all_user_playlist_contents.
+
+        Loaded playlists get the fetched tracks, except the active one, and
+        the others are loaded as long as max_tracks allows.
+
+        Keyword arguments:
+        playlists -- the playlists of the account
+
+        """
+        self._stats['refreshes'] += 1
+        index = OrderedDict()
+        filled = []
+        total = self.tracks()
+        for fetched in playlists:
+            playlist_id = fetched['id']
+            index[playlist_id] = {'id': playlist_id, 'name': fetched['name'], 'tracks': len(fetched['tracks'])}
+            if self.active is not None and playlist_id == self.active.id:
+                index[playlist_id] = self.active.summary()
+                continue
+
+            loaded = self._loaded.get(playlist_id)
+            if loaded is not None:
+                total -= len(loaded.tracks)
+                self._refresh(loaded, fetched)
+                total += len(loaded.tracks)
+            elif total + len(fetched['tracks']) <= self.max_tracks:
+                playlist = self._new(playlist_id, fetched['name'], _tracks(fetched))
+                filled.append((playlist_id, playlist))
+                total += len(playlist.tracks)
+
+        # Not used yet, so they are the first to go
+        self._loaded = OrderedDict(filled + list(self._loaded.items()))
+
+        # Deleted playlists are dropped, the active one is kept until another is activated
+        for playlist_id in list(self._loaded):
+            if playlist_id not in index and self._loaded[playlist_id] is not self.active:
+                del self._loaded[playlist_id]
+        for playlist_id in list(self._positions):
+            if playlist_id not in index:
+                del self._positions[playlist_id]
+        self._evict()
+        if self.active is not None and self.active.id not in index:
+            index[self.active.id] = self.active.summary()
+        self._index = index
+
+    def load(self, playlist_id, playlists):
+        """ Load a playlist from the fetched playlists of the account.
+
+        Returns:
+        The Playlist or None if it's not one of them
+
+        """
+        for fetched in playlists:
+            if fetched['id'] == playlist_id:
+                playlist = self._new(playlist_id, fetched['name'], _tracks(fetched))
+                self._index[playlist_id] = playlist.summary()
+                self._store(playlist)
+                return playlist
+        return None
+
+    def activate(self, playlist_id):
+        """ Make a loaded playlist the active one.
+
+        Returns:
+        The Playlist
+
+        """
+        playlist = self._touch(playlist_id)
+        if self.active is not None and self.active is not playlist:
+            self._stats['switches'] += 1
+            self._index[self.active.id] = self.active.summary()
+        self.active = playlist
+        self._evict()
+        return playlist
+
+    def hit(self, loaded):
+        """ Count a switch to a loaded playlist if loaded, else to one which had to be fetched.
+
+        """
+        self._stats['hits' if loaded else 'misses'] += 1
+
+    def playlists(self):
+        """ Returns the summaries of the playlists of the account, with whether they are loaded and active.
+
+        """
+        if self.active is not None:
+            self._index[self.active.id] = self.active.summary()
+        return [dict(summary, loaded=playlist_id in self._loaded,
+                     active=self.active is not None and playlist_id == self.active.id)
+                for playlist_id, summary in self._index.items()]
+
+    def tracks(self):
+        """ Returns the total number of tracks of the loaded playlists.
+
+        """
+        return sum(len(playlist.tracks) for playlist in self._loaded.values())
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats.update(loaded=len(self._loaded), tracks=self.tracks(), known=len(self._index))
+        return stats
+
+    def _new(self, playlist_id, name, tracks):
+        playlist = Playlist(playlist_id, name, tracks)
+        position = self._positions.pop(playlist_id, None)
+        if position is not None:
+            playlist.restore(position)
+        return playlist
+
+    def _store(self, playlist):
+        self._loaded.pop(playlist.id, None)
+        self._loaded[playlist.id] = playlist
+        self._evict(playlist)
+
+    def _touch(self, playlist_id):
+        playlist = self._loaded.pop(playlist_id)
+        self._loaded[playlist_id] = playlist
+        return playlist
+
+    @staticmethod
+    def _refresh(loaded, fetched):
+        position = loaded.position()
+        loaded.tracks = _tracks(fetched)
+        loaded.name = fetched['name']
+        loaded.refreshed = time.time()
+        loaded.restore(position)
+
+    def _evict(self, keep=None):
+        # The active playlist counts, but it isn't dropped, nor is keep, which is about to be used
+        tracks = self.tracks()
+        for playlist_id, playlist in list(self._loaded.items()):
+            if tracks <= self.max_tracks:
+                break
+            if playlist is not self.active and playlist is not keep:
+                del self._loaded[playlist_id]
+                self._positions[playlist_id] = playlist.position()
+                tracks -= len(playlist.tracks)
+                self._stats['evictions'] += 1
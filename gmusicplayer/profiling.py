@@ -0,0 +1,383 @@
+__author__ = 'daniel michels'
+
+import gc
+import os
+import sys
+import time
+import hmac
+import json
+import threading
+from collections import OrderedDict
+
+from twisted.web import resource
+
+try:
+    import tracemalloc
+except ImportError:
+    # Only on Python 3.4+ or a Python 2 patched for pytracemalloc
+    tracemalloc = None
+
+
+class AdminError(Exception):
+    """ Raised by an admin operation which is not allowed or not possible.
+
+    """
+
+
+class SamplingProfiler(object):
+    """ Statistical profiler of all threads of the process.
+
+    A thread takes the stacks of the other threads every interval seconds,
+    which covers the reactor, the threads reading from mplayer and the
+    thread pool alike. The samples are counted per stack and rendered as
+    collapsed stacks, one 'thread;outer;...;inner count' line per stack, the
+    input of flamegraph.pl and speedscope.
+
+    """
+
+    def __init__(self, max_stacks=20000):
+        """
+        Keyword arguments:
+        max_stacks -- number of distinct stacks kept, the samples of further ones are counted as truncated
+
+        """
+        self.max_stacks = max_stacks
+        self.started = None             # Time the current or last profile started
+        self.stopped = None
+        self.interval = None
+        self._counts = {}               # Collapsed stack -> number of samples
+        self._thread = None
+        self._running = False
+        self._stats = {
+            'profiles': 0,
+            'samples': 0,
+            'truncated': 0
+        }
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, duration=None, interval=0.01):
+        """ Start sampling, the samples of the last profile are dropped.
+
+        Keyword arguments:
+        duration -- seconds after which sampling stops by itself or None
+        interval -- seconds between two samples
+
+        """
+        if self._running:
+            raise AdminError('the profiler is already running')
+        self._counts = {}
+        self.started = time.time()
+        self.stopped = None
+        self.interval = interval
+        self._running = True
+        self._stats['profiles'] += 1
+        self._thread = threading.Thread(target=self._sample_loop, args=(duration, interval), name='profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop sampling and wait for the sampler thread to end.
+
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(1.0)
+            self._thread = None
+
+    def result(self):
+        """ Returns a dict describing the current or last profile.
+
+        """
+        end = self.stopped or time.time()
+        return {
+            'running': self._running,
+            'started': self.started,
+            'seconds': end - self.started if self.started else 0.0,
+            'interval': self.interval,
+            'samples': sum(self._counts.values()),
+            'stacks': len(self._counts)
+        }
+
+    def collapsed(self):
+        """ Returns the samples as collapsed stacks, the most frequent first.
+
+        """
+        counts = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in counts)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['running'] = self._running
+        return stats
+
+    def _sample_loop(self, duration, interval):
+        # Runs in the profiler thread
+        own = threading.current_thread().ident
+        deadline = time.time() + duration if duration else None
+        while self._running and (deadline is None or time.time() < deadline):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident != own:
+                    self._count(names.get(ident, 'thread-{0}'.format(ident)), frame)
+            frames = frame = None
+            time.sleep(interval)
+        self._running = False
+        self.stopped = time.time()
+
+    def _count(self, thread_name, frame):
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            labels.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+            frame = frame.f_back
+        labels.append(thread_name.replace(' ', '_'))
+        stack = ';'.join(reversed(labels))
+
+        self._stats['samples'] += 1
+        if stack not in self._counts and len(self._counts) >= self.max_stacks:
+            self._stats['truncated'] += 1
+            stack = thread_name + ';[truncated]'
+        self._counts[stack] = self._counts.get(stack, 0) + 1
+
+
+class MemorySnapshots(object):
+    """ Snapshots of the memory of the process and the differences between them.
+
+    With tracemalloc the snapshots are the allocations per source line.
+    Tracing starts with the first snapshot and slows every allocation
+    down, reset() stops it again. Without tracemalloc they are the number
+    of objects per type the garbage collector tracks.
+
+    """
+
+    def __init__(self, frames=1, keep=10):
+        """
+        Keyword arguments:
+        frames -- number of frames tracemalloc records per allocation
+        keep -- number of snapshots kept, the oldest are dropped
+
+        """
+        self.frames = frames
+        self.keep = keep
+        self.backend = 'tracemalloc' if tracemalloc is not None else 'gc'
+        self._snapshots = OrderedDict()     # Id -> (time, snapshot)
+        self._next_id = 1
+
+    def snapshot(self):
+        """ Take a snapshot.
+
+        Returns:
+        Id of the snapshot
+
+        """
+        if tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        else:
+            snapshot = {}
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                snapshot[name] = snapshot.get(name, 0) + 1
+
+        snapshot_id = self._next_id
+        self._next_id += 1
+        self._snapshots[snapshot_id] = (time.time(), snapshot)
+        while len(self._snapshots) > self.keep:
+            self._snapshots.popitem(last=False)
+        return snapshot_id
+
+    def top(self, snapshot_id, limit=25):
+        """ Returns the lines allocating the most or the most common types of a snapshot.
+
+        """
+        snapshot = self._get(snapshot_id)
+        if tracemalloc is not None:
+            return [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        counts = sorted(snapshot.items(), key=lambda item: item[1], reverse=True)
+        return ['{0}: count={1}'.format(name, count) for name, count in counts[:limit]]
+
+    def diff(self, first_id, second_id, limit=25):
+        """ Returns what grew or shrank the most from the first snapshot to the second.
+
+        """
+        first, second = self._get(first_id), self._get(second_id)
+        if tracemalloc is not None:
+            return [str(stat) for stat in second.compare_to(first, 'lineno')[:limit]]
+        deltas = [(name, second.get(name, 0), second.get(name, 0) - first.get(name, 0))
+                  for name in set(first) | set(second)]
+        deltas = sorted([delta for delta in deltas if delta[2]], key=lambda delta: abs(delta[2]), reverse=True)
+        return ['{0}: count={1} ({2:+d})'.format(name, count, delta) for name, count, delta in deltas[:limit]]
+
+    def snapshots(self):
+        """ Returns id and time of the kept snapshots, the oldest first.
+
+        """
+        return [{'id': snapshot_id, 'time': taken} for snapshot_id, (taken, _) in self._snapshots.items()]
+
+    def reset(self):
+        """ Drop the snapshots and stop tracing.
+
+        """
+        self._snapshots.clear()
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _get(self, snapshot_id):
+        try:
+            return self._snapshots[int(snapshot_id)][1]
+        except (KeyError, ValueError, TypeError):
+            raise AdminError('there is no snapshot {0}'.format(snapshot_id))
+
+
+class AdminTools(resource.Resource):
+    """ Profiler and memory snapshots of the process, for admins only.
+
+    The admin RPCs of RpcServerProtocol control them. They are also
+    controlled and their results downloaded here, with the admin token as
+    'Authorization: Bearer <token>' header or 'token' argument:
+
+    'POST /admin/profile/start' -- start profiling, takes 'duration' and 'interval'
+    'POST /admin/profile/stop' -- stop profiling
+    'GET /admin/profile' -- collapsed stacks of the current or last profile
+    'POST /admin/memory' -- take a memory snapshot
+    'POST /admin/memory/reset' -- drop the snapshots and stop tracing
+    'GET /admin/memory/<id>' -- top allocations of a snapshot
+    'GET /admin/memory/<id>/<id>' -- difference between two snapshots
+
+    This also reaches the core in multi-process mode, whose RPCs are served
+    by the workers. Without a token everything is refused.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self, token):
+        """
+        Keyword arguments:
+        token -- the admin token or None
+
+        """
+        resource.Resource.__init__(self)
+        self.token = token
+        self.profiler = SamplingProfiler()
+        self.memory = MemorySnapshots()
+
+    def authorize(self, token):
+        """ Raise AdminError unless token is the admin token.
+
+        """
+        if not self.token:
+            raise AdminError('admin operations are disabled')
+        if not isinstance(token, basestring) or not hmac.compare_digest(token.encode('utf-8'),
+                                                                        self.token.encode('utf-8')):
+            raise AdminError('not authorized')
+
+    def start_profile(self, duration=60.0, interval=0.01):
+        """ Start the profiler, see SamplingProfiler.start().
+
+        Returns:
+        Dict describing the profile
+
+        """
+        self.profiler.start(float(duration) if duration else None, max(0.001, float(interval)))
+        return self.profiler.result()
+
+    def stop_profile(self):
+        """ Stop the profiler.
+
+        Returns:
+        Dict describing the profile with the collapsed stacks
+
+        """
+        self.profiler.stop()
+        return dict(self.profiler.result(), collapsed=self.profiler.collapsed())
+
+    def take_snapshot(self, limit=25):
+        """ Take a memory snapshot.
+
+        Returns:
+        Dict with the id of the snapshot and its top allocations
+
+        """
+        snapshot_id = self.memory.snapshot()
+        return {'id': snapshot_id, 'backend': self.memory.backend, 'top': self.memory.top(snapshot_id, limit)}
+
+    def diff_snapshots(self, first_id, second_id, limit=25):
+        """ Returns a dict with the difference between two memory snapshots.
+
+        """
+        return {'first': first_id, 'second': second_id, 'backend': self.memory.backend,
+                'diff': self.memory.diff(first_id, second_id, limit)}
+
+    def reset_memory(self):
+        self.memory.reset()
+        return {'snapshots': self.memory.snapshots()}
+
+    def stats(self):
+        return self.profiler.stats()
+
+    def render_GET(self, request):
+        if not self._authorized(request):
+            return b''
+
+        request.setHeader(b'content-type', b'text/plain; charset=utf-8')
+        request.setHeader(b'cache-control', b'no-cache')
+        path = request.postpath
+        try:
+            if path == ['profile']:
+                request.setHeader(b'content-disposition', b'attachment; filename="profile.collapsed"')
+                return self.profiler.collapsed().encode('utf-8')
+            if len(path) == 2 and path[0] == 'memory':
+                return '\n'.join(self.memory.top(path[1], 100)).encode('utf-8') + b'\n'
+            if len(path) == 3 and path[0] == 'memory':
+                return '\n'.join(self.memory.diff(path[1], path[2], 100)).encode('utf-8') + b'\n'
+        except AdminError:
+            pass
+        request.setResponseCode(404)
+        return b''
+
+    def render_POST(self, request):
+        if not self._authorized(request):
+            return b''
+
+        path = request.postpath
+        argument = lambda name, default: request.args.get(name, [default])[0]
+        try:
+            if path == ['profile', 'start']:
+                result = self.start_profile(argument('duration', 60.0), argument('interval', 0.01))
+            elif path == ['profile', 'stop']:
+                result = self.stop_profile()
+            elif path == ['memory']:
+                result = self.take_snapshot()
+            elif path == ['memory', 'reset']:
+                result = self.reset_memory()
+            else:
+                request.setResponseCode(404)
+                return b''
+        except (AdminError, ValueError) as e:
+            request.setResponseCode(409)
+            result = {'error': str(e)}
+
+        request.setHeader(b'content-type', b'application/json')
+        request.setHeader(b'cache-control', b'no-cache')
+        return json.dumps(result, sort_keys=True).encode('utf-8')
+
+    def _authorized(self, request):
+        token = request.args.get('token', [None])[0]
+        authorization = request.getHeader('authorization') or ''
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        try:
+            self.authorize(token)
+        except AdminError:
+            request.setResponseCode(403)
+            return False
+        return True
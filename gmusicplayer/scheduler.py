@@ -0,0 +1,172 @@
+__author__ = 'daniel michels'
+
+import time
+from collections import deque
+
+from enum import Enum
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+from gmusicplayer.metrics import Histogram
+
+
+class Priority(Enum):
+    """ Classes of the calls to Google Music, the most urgent first.
+
+    """
+    PLAYBACK = 0        # Stream url of the track to play now
+    MUTATION = 1        # Changes of the playlist
+    INTERACTIVE = 2     # Searches of the users
+    BACKGROUND = 3      # Prefetching and syncing
+
+
+# Calls of a class which run at the same time. Mutations run one by one, so the playlist changes in order
+DEFAULT_CONCURRENCY = {
+    Priority.PLAYBACK: 2,
+    Priority.MUTATION: 1,
+    Priority.INTERACTIVE: 2,
+    Priority.BACKGROUND: 1
+}
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TokenBucket(object):
+    """ Allows rate calls per second on average and bursts of up to burst calls.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self._updated = time.time()
+
+    def delay(self):
+        """ Returns the seconds until a token is available, 0 if one is.
+
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """ Take a token, even if there is none. The debt is paid back before the next one is available.
+
+        """
+        self._refill()
+        self.tokens -= 1
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class CallScheduler(object):
+    """ Runs the blocking calls to Google Music in threads, the most urgent first.
+
+    Every call is queued in its Priority class. The queues are served in
+    the order of the classes, as far as the concurrency of a class allows,
+    and every call takes a token from a shared TokenBucket. Only playback
+    calls never wait for a token, they go into debt instead, which the
+    other classes have to wait for. A burst of searches can thus neither
+    hold up the stream url of the next track nor run into the quota.
+
+    """
+
+    def __init__(self, rate=10.0, burst=20, concurrency=None, window=500, metrics=None):
+        """
+        Keyword arguments:
+        rate -- calls per second on average
+        burst -- calls which may be made at once after a quiet period
+        concurrency -- dict of Priority -> number of calls running at the same time, see DEFAULT_CONCURRENCY
+        window -- number of recent calls per class the wait percentiles are computed from
+        metrics -- MetricsRegistry to record the waits in or None
+
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = dict(DEFAULT_CONCURRENCY, **(concurrency or {}))
+        self._queues = dict((priority, deque()) for priority in Priority)
+        self._running = dict((priority, 0) for priority in Priority)
+        self._waits = dict((priority, deque(maxlen=window)) for priority in Priority)
+        self._pool = ThreadPool(0, sum(self.concurrency.values()), 'gmusic-calls')
+        self._retry_call = None
+        self._histogram = None
+        if metrics is not None:
+            self._histogram = metrics.add(Histogram('gmusicplayer_scheduler_wait_seconds',
+                                                    'Time the calls to Google Music waited in the queue, in seconds',
+                                                    ('priority',)))
+        self._stats = dict((priority, {'calls': 0, 'errors': 0, 'throttled': 0}) for priority in Priority)
+
+    def call(self, priority, f, *args, **kwargs):
+        """ Queue a call of the blocking f.
+
+        Keyword arguments:
+        priority -- the Priority of the call
+
+        Returns:
+        Deferred firing with the result of f
+
+        """
+        if not self._pool.started:
+            self._pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+        d = defer.Deferred()
+        self._queues[priority].append((time.time(), d, f, args, kwargs))
+        self._dispatch()
+        return d
+
+    def stats(self):
+        """ Returns a dict with the queue depths, waits and counters per Priority.
+
+        """
+        stats = {'tokens': self.bucket.tokens}
+        for priority in Priority:
+            waits = sorted(self._waits[priority])
+            entry = dict(self._stats[priority], queued=len(self._queues[priority]), running=self._running[priority])
+            if waits:
+                entry.update(wait_p50=_percentile(waits, 0.5), wait_p99=_percentile(waits, 0.99), wait_max=waits[-1])
+            stats[priority.name.lower()] = entry
+        return stats
+
+    def _dispatch(self):
+        for priority in Priority:
+            queue = self._queues[priority]
+            while queue and self._running[priority] < self.concurrency[priority]:
+                if priority is not Priority.PLAYBACK:
+                    delay = self.bucket.delay()
+                    if delay > 0:
+                        # The less urgent classes wait for this one
+                        self._stats[priority]['throttled'] += 1
+                        self._retry_later(delay)
+                        return
+                self.bucket.take()
+                self._start(priority, *queue.popleft())
+
+    def _retry_later(self, delay):
+        if self._retry_call is None or not self._retry_call.active():
+            self._retry_call = reactor.callLater(delay, self._dispatch)
+
+    def _start(self, priority, queued, d, f, args, kwargs):
+        waited = time.time() - queued
+        self._waits[priority].append(waited)
+        if self._histogram is not None:
+            self._histogram.observe(waited, (priority.name.lower(),))
+        self._running[priority] += 1
+        self._stats[priority]['calls'] += 1
+        call = threads.deferToThreadPool(reactor, self._pool, f, *args, **kwargs)
+        call.addBoth(self._finished, priority, d)
+
+    def _finished(self, result, priority, d):
+        self._running[priority] -= 1
+        self._dispatch()
+        if isinstance(result, Failure):
+            self._stats[priority]['errors'] += 1
+            d.errback(result)
+        else:
+            d.callback(result)
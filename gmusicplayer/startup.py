@@ -0,0 +1,261 @@
+__author__ = 'daniel michels'
+
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+from twisted.internet import defer, threads
+from twisted.web import resource
+
+
+class StartupError(Exception):
+    """ Raised when the player can't be started, e.g. because a login failed.
+
+    """
+
+
+def import_gmusicapi():
+    """ Import the clients of gmusicapi, which takes a while.
+
+    Only done when Google Music is actually used, so the worker processes
+    and the fake backend start without it.
+
+    Returns:
+    (Webclient, Mobileclient) or None if gmusicapi is not installed
+
+    """
+    try:
+        from gmusicapi import Mobileclient, Webclient
+    except ImportError:
+        return None
+    return Webclient, Mobileclient
+
+
+class SessionStore(object):
+    """ Persists what's worth keeping from one login to the next.
+
+    For now that's the device id, which otherwise takes a login of the
+    Webclient and a lookup of the registered devices. It's stored per
+    account, the username only as hash, and expires after max_age seconds.
+
+    """
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        """
+        Keyword arguments:
+        path -- file the sessions are kept in
+        max_age -- seconds after which a stored device id isn't used anymore
+
+        """
+        self.path = path
+        self.max_age = max_age
+
+    def device_id(self, username):
+        """ Returns the stored device id of an account or None.
+
+        """
+        session = self._load().get(self._key(username))
+        if session is None or time.time() - session.get('stored', 0) > self.max_age:
+            return None
+        return session.get('device_id')
+
+    def store_device_id(self, username, device_id):
+        sessions = self._load()
+        sessions[self._key(username)] = {'device_id': device_id, 'stored': time.time()}
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Written to a new file which replaces the old one, only readable by the owner
+        temp = self.path + '.tmp'
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sessions, f)
+        os.rename(temp, self.path)
+
+    @staticmethod
+    def _key(username):
+        return hashlib.sha1(username.lower().encode('utf-8')).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                sessions = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return sessions if isinstance(sessions, dict) else {}
+
+
+class Startup(resource.Resource):
+    """ Runs the phases of the startup and reports how long they took.
+
+    Synchronous phases are timed with phase(), blocking calls are run in
+    the thread pool with run() so several of them proceed at the same time
+    while the reactor already serves the clients. Until ready() is called
+    the player is warming up: '/startup' answers with 503 and the report,
+    afterwards with 200.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self, started=None):
+        """
+        Keyword arguments:
+        started -- time the process started at, defaults to now
+
+        """
+        resource.Resource.__init__(self)
+        self.started = started or time.time()
+        self.state = 'warming_up'           # 'warming_up', 'ready' or 'failed'
+        self.error = None
+        self._phases = OrderedDict()        # Name -> [start, end or None]
+
+    def is_ready(self):
+        return self.state == 'ready'
+
+    def begin(self, name, at=None):
+        self._phases[name] = [at or time.time(), None]
+
+    def end(self, name):
+        self._phases[name][1] = time.time()
+
+    def phase(self, name):
+        """ Returns a context manager timing the phase name.
+
+        """
+        return _Phase(self, name)
+
+    def run(self, name, f, *args, **kwargs):
+        """ Call a blocking f in a thread as phase name.
+
+        Returns:
+        Deferred firing with the result of f
+
+        """
+        self.begin(name)
+        d = threads.deferToThread(f, *args, **kwargs)
+        d.addBoth(self._ended, name)
+        return d
+
+    def ready(self):
+        self.state = 'ready'
+        self.begin('ready', self.started)
+        self.end('ready')
+
+    def failed(self, error):
+        self.state = 'failed'
+        self.error = str(error)
+
+    def report(self):
+        """ Returns a dict with the state and the phases, times relative to the start of the process.
+
+        """
+        phases = []
+        for name, (start, end) in self._phases.items():
+            phases.append({'name': name, 'start': start - self.started,
+                           'duration': end - start if end is not None else None})
+        return {'state': self.state, 'error': self.error, 'elapsed': time.time() - self.started, 'phases': phases}
+
+    def summary(self):
+        """ Returns the report as one line.
+
+        """
+        parts = []
+        for phase in self.report()['phases']:
+            if phase['duration'] is not None and phase['name'] != 'ready':
+                parts.append('{0} {1:.0f}ms'.format(phase['name'], phase['duration'] * 1000))
+        return 'startup {0} after {1:.0f}ms: {2}'.format(self.state.replace('_', ' '),
+                                                         (time.time() - self.started) * 1000, ', '.join(parts))
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        request.setHeader(b'cache-control', b'no-cache')
+        if not self.is_ready():
+            request.setResponseCode(503)
+            request.setHeader(b'retry-after', b'1')
+        return json.dumps(self.report(), sort_keys=True).encode('utf-8')
+
+    def _ended(self, result, name):
+        self.end(name)
+        return result
+
+
+class _Phase(object):
+
+    def __init__(self, startup, name):
+        self.startup = startup
+        self.name = name
+
+    def __enter__(self):
+        self.startup.begin(self.name)
+
+    def __exit__(self, *exc_info):
+        self.startup.end(self.name)
+
+
+def warm_up(startup, musicplayer, username, password, playlist_name, sessions):
+    """ Log in and load the playlist, with the blocking calls running concurrently.
+
+    The Mobileclient logs in and loads the playlist while the Webclient
+    logs in and looks up the device id. With a device id stored by an
+    earlier run the player is ready without waiting for the Webclient,
+    whose lookup then only refreshes the stored id.
+
+    Keyword arguments:
+    startup -- the Startup timing the phases
+    musicplayer -- the MusicPlayer
+    username, password -- the credentials of the account
+    playlist_name -- name of the playlist to play
+    sessions -- SessionStore with the device ids of earlier runs
+
+    Returns:
+    Deferred firing when the player is ready, failing with StartupError
+
+    """
+    stored_id = sessions.device_id(username)
+    if stored_id is not None:
+        musicplayer.deviceid = stored_id
+
+    def logged_in(success, client):
+        if not success:
+            raise StartupError('login of the {0} failed'.format(client))
+
+    def loaded(playlists):
+        with startup.phase('apply playlist'):
+            musicplayer.load_playlist(playlist_name, playlists)
+
+    def found(device_id):
+        if device_id != stored_id:
+            musicplayer.deviceid = device_id
+            sessions.store_device_id(username, device_id)
+
+    def lookup_failed(failure):
+        # The stored id is used, maybe it's valid still
+        print("looking up the device id failed, using the stored one: %s" % failure.getErrorMessage())
+
+    def failed(failure):
+        # The first error of the gathered Deferreds, other exceptions are wrapped
+        if failure.check(defer.FirstError):
+            failure = failure.value.subFailure
+        if failure.check(StartupError):
+            return failure
+        raise StartupError('{0}: {1}'.format(failure.type.__name__, failure.getErrorMessage()))
+
+    mobile = startup.run('mobileclient login', musicplayer.mobileclient.login, username, password)
+    mobile.addCallback(logged_in, 'Mobileclient')
+    mobile.addCallback(lambda _: startup.run('fetch playlists', musicplayer.mobileclient.get_all_user_playlist_contents))
+    mobile.addCallback(loaded)
+
+    device = startup.run('webclient login', musicplayer.webclient.login, username, password)
+    device.addCallback(logged_in, 'Webclient')
+    device.addCallback(lambda _: startup.run('device lookup', musicplayer.lookup_device_id))
+    device.addCallback(found)
+
+    if stored_id is not None:
+        device.addErrback(lookup_failed)
+        return mobile.addErrback(failed)
+    d = defer.gatherResults([mobile, device], consumeErrors=True)
+    d.addErrback(failed)
+    return d
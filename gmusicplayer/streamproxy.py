@@ -0,0 +1,592 @@
+__author__ = 'daniel michels'
+
+import mmap
+import time
+from collections import OrderedDict
+from threading import Thread, Condition
+
+try:
+    from urllib2 import urlopen, Request
+except ImportError:
+    from urllib.request import urlopen, Request
+
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import resource, server
+from zope.interface import implementer
+
+
+class RingBuffer(object):
+    """ Fixed-size ring buffer in an anonymous memory map.
+
+    Bytes are addressed by their absolute offset in the stream. Only the
+    last `capacity` bytes written are retained, i.e. the range [start, end).
+
+    """
+
+    def __init__(self, capacity, offset=0):
+        """
+        Keyword arguments:
+        capacity -- size of the buffer in bytes
+        offset -- absolute offset of the first byte that will be written
+
+        """
+        self.capacity = capacity
+        self.start = offset
+        self.end = offset
+        self._map = mmap.mmap(-1, capacity)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def write(self, data):
+        size = len(data)
+        if size > self.capacity:
+            data = data[-self.capacity:]
+            self.end += size - self.capacity
+            size = self.capacity
+        pos = self.end % self.capacity
+        first = min(size, self.capacity - pos)
+        self._map[pos:pos + first] = data[:first]
+        if first < size:
+            self._map[0:size - first] = data[first:]
+        self.end += size
+        self.start = max(self.start, self.end - self.capacity)
+
+    def read(self, offset, size):
+        """ Returns up to size bytes at offset or b'' if they aren't retained.
+
+        """
+        if offset < self.start or offset >= self.end:
+            return b''
+        size = min(size, self.end - offset)
+        pos = offset % self.capacity
+        first = min(size, self.capacity - pos)
+        data = self._map[pos:pos + first]
+        if first < size:
+            data += self._map[0:size - first]
+        return data
+
+    def close(self):
+        self._map.close()
+
+
+class StreamBuffer(object):
+    """ Downloads a stream into a RingBuffer on a thread of its own.
+
+    The download only overwrites bytes which all readers have consumed, so a
+    slow reader throttles it. A reader counts from the moment it attaches,
+    before reading anything, so the download advances to where it's going to
+    read. Before the first reader attaches nothing is overwritten, which lets
+    a prefetched buffer be played from the start. If tee_path is given, the
+    stream is also written to that file. A download which gets no data for
+    timeout seconds fails, along with its readers.
+
+    """
+
+    def __init__(self, url, capacity, offset=0, tee_path=None, chunk_size=64 * 1024, timeout=30.0):
+        self.url = url
+        self.timeout = timeout          # Seconds to wait for the connection and every chunk
+        self.offset = offset            # Offset the download started at
+        self.length = None              # Total length of the stream
+        self.content_type = 'audio/mpeg'
+        self.complete = False
+        self.failed = False
+        self.ring = RingBuffer(capacity, offset)
+        self.tee_path = tee_path
+        self.chunk_size = chunk_size
+        self.headers_received = False   # Whether length and type are known
+        self.finished = defer.Deferred() # Fires with True when complete, else False
+
+        # Statistics
+        self.started = time.time()
+        self.first_byte = None          # Time the first byte arrived at
+        self.last_byte = None
+        self.bytes_fetched = 0
+        self.blocked = 0.0              # Seconds the download waited for readers
+
+        self._cond = Condition()
+        self._readers = {}              # reader -> offset it has consumed up to
+        self._attached = False          # Whether a reader has ever attached
+        self._waiters = []              # Callbacks waiting for more data
+        self._header_waiters = []       # Deferreds waiting for length and type
+        self._cancelled = False
+
+        t = Thread(target=self._thread_func)
+        t.daemon = True
+        t.start()
+
+    @property
+    def end(self):
+        return self.ring.end
+
+    def fill(self, offset=None):
+        """ Returns the number of bytes buffered ahead of offset (default: the slowest reader).
+
+        """
+        with self._cond:
+            if offset is None:
+                offset = min(self._readers.values()) if self._readers else self.ring.start
+            return max(0, self.ring.end - offset)
+
+    def throughput(self):
+        """ Returns the download rate in bytes per second or None.
+
+        """
+        if self.first_byte is None or self.last_byte is None:
+            return None
+        # Time spent waiting for readers says nothing about the network
+        elapsed = self.last_byte - self.started - self.blocked
+        if elapsed <= 0:
+            return None
+        return self.bytes_fetched / elapsed
+
+    def headers(self):
+        """ Returns a Deferred of its own which fires with this buffer once length and type are known.
+
+        """
+        if self.headers_received:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._header_waiters.append(d)
+        return d
+
+    def attach(self, reader, offset):
+        """ Register a reader which is going to read from offset.
+
+        """
+        with self._cond:
+            self._attached = True
+            self._readers[reader] = offset
+            self._cond.notify()
+
+    def read(self, reader, offset, size):
+        """ Read and consume up to size bytes at offset on behalf of reader.
+
+        """
+        with self._cond:
+            data = self.ring.read(offset, size)
+            if data:
+                self._attached = True
+                self._readers[reader] = offset + len(data)
+                self._cond.notify()
+            return data
+
+    def retains(self, offset, slack):
+        """ Whether offset is or will soon be available from this buffer.
+
+        """
+        if self.failed or offset < self.ring.start:
+            return False
+        if self.length is not None and offset > self.length:
+            return False
+        return offset <= self.ring.end + slack
+
+    def wait(self, callback):
+        """ Call callback on the reactor thread when there is more data.
+
+        """
+        self._waiters.append(callback)
+
+    def detach(self, reader):
+        with self._cond:
+            self._readers.pop(reader, None)
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify()
+
+    def _space(self):
+        # Called with self._cond held: bytes which may be written right now
+        if self._readers:
+            keep_from = min(self._readers.values())
+        elif not self._attached or self.tee_path is None:
+            keep_from = self.ring.start
+        else:
+            # Nobody reads anymore but the tee still wants the whole stream
+            return self.ring.capacity
+        return self.ring.capacity - (self.ring.end - keep_from)
+
+    def _thread_func(self):
+        tee = None
+        try:
+            request = Request(self.url)
+            if self.offset:
+                request.add_header('Range', 'bytes={0}-'.format(self.offset))
+            response = urlopen(request, timeout=self.timeout)
+            info = response.info()
+            length = info.get('Content-Length')
+            if length is not None:
+                length = int(length) + self.offset
+            content_range = info.get('Content-Range')
+            if content_range and '/' in content_range:
+                total = content_range.rpartition('/')[2]
+                if total.isdigit():
+                    length = int(total)
+            elif self.offset:
+                # The server ignored the range, skip to the offset
+                skip = self.offset
+                while skip > 0:
+                    skipped = len(response.read(min(skip, self.chunk_size)))
+                    if not skipped:
+                        break
+                    skip -= skipped
+                if length is not None:
+                    length -= self.offset
+            content_type = info.get('Content-Type') or self.content_type
+            reactor.callFromThread(self._headers_received, length, content_type)
+
+            if self.tee_path is not None:
+                tee = open(self.tee_path, 'wb')
+
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    break
+                with self._cond:
+                    if self._space() < len(chunk):
+                        blocked = time.time()
+                        while not self._cancelled and self._space() < len(chunk):
+                            self._cond.wait(1.0)
+                        self.blocked += time.time() - blocked
+                    if self._cancelled:
+                        break
+                    self.ring.write(chunk)
+                now = time.time()
+                if self.first_byte is None:
+                    self.first_byte = now
+                self.last_byte = now
+                self.bytes_fetched += len(chunk)
+                if tee is not None:
+                    tee.write(chunk)
+                reactor.callFromThread(self._data_received)
+        except Exception:
+            reactor.callFromThread(self._done, False)
+        else:
+            complete = not self._cancelled and (length is None or self.ring.end == length)
+            reactor.callFromThread(self._done, complete)
+        finally:
+            if tee is not None:
+                tee.close()
+
+    def _headers_received(self, length, content_type):
+        self.length = length
+        self.content_type = content_type
+        self._fire_headers()
+
+    def _fire_headers(self):
+        self.headers_received = True
+        waiters, self._header_waiters = self._header_waiters, []
+        for d in waiters:
+            d.callback(self)
+
+    def _data_received(self):
+        waiters, self._waiters = self._waiters, []
+        for callback in waiters:
+            callback()
+
+    def _done(self, complete):
+        self.complete = complete
+        self.failed = not complete
+        if not self.headers_received:
+            self._fire_headers()
+        self._data_received()
+        self.finished.callback(complete)
+
+
+@implementer(IPushProducer)
+class _StreamProducer(object):
+    """ Writes the bytes [offset, end) of a StreamBuffer to a request.
+
+    """
+
+    def __init__(self, proxy, request, stream, offset, end, prefill=0, duration=None):
+        self.proxy = proxy
+        self.request = request
+        self.stream = stream
+        self.first_offset = offset
+        self.offset = offset
+        self.end = end
+        self.prefill = prefill          # Bytes to buffer before the first write
+        self.duration = duration        # Duration of the track in seconds if known
+        self.requested = time.time()
+        self.starved_at = None          # Time playback caught up with the download
+        self.paused = False
+        self.done = False
+        self.waiting = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addBoth(self._finished)
+        self.stream.attach(self, self.offset)
+        self._write()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._write()
+
+    def stopProducing(self):
+        self._finished(None)
+
+    def _write(self):
+        self.waiting = False
+        while not self.paused and not self.done:
+            if self.offset >= self.end:
+                self._finish()
+                return
+            if self.prefill:
+                if self.stream.fill(self.offset) < self.prefill and not (self.stream.complete or self.stream.failed):
+                    # Buffer some more before playback starts
+                    self.waiting = True
+                    self.stream.wait(self._write)
+                    return
+                self.prefill = 0
+            data = self.stream.read(self, self.offset, min(self.stream.chunk_size, self.end - self.offset))
+            if not data:
+                if self.stream.complete or self.stream.failed:
+                    # Nothing more will come
+                    self._finish()
+                    return
+                # Playback caught up with the download
+                if self.offset > self.first_offset and self.starved_at is None:
+                    self.starved_at = time.time()
+                    self.proxy._stats['stalls'] += 1
+                    if self.proxy.buffering is not None:
+                        self.proxy.buffering.stalled()
+                self.waiting = True
+                self.stream.wait(self._write)
+                return
+            if self.proxy.buffering is not None:
+                if self.offset == self.first_offset:
+                    self.proxy.buffering.started(time.time() - self.requested)
+                elif self.starved_at is not None:
+                    self.proxy.buffering.starved(time.time() - self.starved_at, self.stream, self.duration)
+            self.starved_at = None
+            self.offset += len(data)
+            self.proxy._stats['bytes_served'] += len(data)
+            self.request.write(data)
+
+    def _finish(self):
+        if not self.done:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self._finished(None)
+
+    def _finished(self, result):
+        if not self.done:
+            self.done = True
+            self.stream.detach(self)
+            self.proxy._producer_finished(self)
+
+
+class _Entry(object):
+
+    def __init__(self, store_id, url, stream, duration=None):
+        self.store_id = store_id
+        self.url = url
+        self.stream = stream
+        self.duration = duration        # Duration of the track in seconds if known
+        self.prefetched = False         # Registered ahead of playback and not played yet
+
+
+class StreamProxy(resource.Resource):
+    """ Local HTTP proxy which mplayer plays the Google Music streams from.
+
+    Streams are fetched into a memory-mapped ring buffer as soon as they are
+    registered, so the next track can be downloaded before the current one
+    ends. Range requests within the buffered window are served from memory,
+    all others trigger a separate ranged download. If an AudioCache is given,
+    complete streams are teed into it. If a BufferingController is given, it
+    decides how much of a stream is buffered before the first byte is sent.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self, base_url, audio_cache=None, capacity=16 * 1024 * 1024, max_streams=3, buffering=None):
+        """
+        Keyword arguments:
+        base_url -- url under which this resource is reachable for mplayer
+        audio_cache -- AudioCache to tee complete streams into or None
+        buffering -- BufferingController sizing the prefill of the streams or None
+        capacity -- size of the ring buffer of every stream in bytes
+        max_streams -- number of streams to keep buffered
+
+        """
+        resource.Resource.__init__(self)
+        self.base_url = base_url
+        self.audio_cache = audio_cache
+        self.capacity = capacity
+        self.max_streams = max_streams
+        self.buffering = buffering
+        self._entries = OrderedDict()   # storeId -> _Entry
+        self._producers = set()
+        self._stats = {
+            'streams': 0,               # Streams registered
+            'prefetches': 0,            # Streams registered ahead of playback
+            'prefetch_hits': 0,         # Prefetched streams which were played
+            'range_fetches': 0,         # Ranged downloads for seeks outside the buffer
+            'stalls': 0,                # Times a reader had to wait for data
+            'bytes_served': 0
+        }
+
+    def url_for(self, store_id, remote_url=None, duration=None):
+        """ Returns the local url of a stream, registering it if necessary.
+
+        Keyword arguments:
+        store_id -- the storeId of the track
+        remote_url -- the stream url, only needed if the stream isn't buffered yet
+        duration -- duration of the track in seconds if known
+
+        """
+        if self.is_buffered(store_id):
+            entry = self._entries.pop(store_id)
+            self._entries[store_id] = entry
+            if entry.prefetched:
+                entry.prefetched = False
+                self._stats['prefetch_hits'] += 1
+        else:
+            self._register(store_id, remote_url, duration)
+        return self.base_url + store_id
+
+    def prefetch(self, store_id, remote_url, duration=None):
+        """ Start downloading a stream which is going to be played soon.
+
+        """
+        if not self.is_buffered(store_id):
+            self._register(store_id, remote_url, duration).prefetched = True
+            self._stats['prefetches'] += 1
+
+    def is_buffered(self, store_id):
+        entry = self._entries.get(store_id)
+        return entry is not None and not entry.stream.failed
+
+    def stats(self):
+        """ Returns a dict describing the buffers and their performance.
+
+        """
+        stats = dict(self._stats)
+        streams = []
+        for entry in self._entries.values():
+            streams.append({
+                'storeId': entry.store_id,
+                'fill': entry.stream.fill(),
+                'fetched': entry.stream.bytes_fetched,
+                'length': entry.stream.length,
+                'throughput': entry.stream.throughput(),
+                'complete': entry.stream.complete
+            })
+        stats['buffers'] = streams
+        return stats
+
+    def render_GET(self, request):
+        store_id = request.postpath[0] if request.postpath else None
+        entry = self._entries.get(store_id)
+        if entry is None:
+            request.setResponseCode(404)
+            return b''
+
+        start, stop = self._parse_range(request.getHeader('range'))
+
+        # Use the main buffer if the requested range is (about to be) in there
+        stream = entry.stream
+        if not stream.retains(start, self.capacity // 2):
+            self._stats['range_fetches'] += 1
+            stream = StreamBuffer(entry.url, self.capacity, start)
+            self._sample(stream)
+
+        # mplayer may give up on the request before the headers are known
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        d = stream.headers()
+        d.addCallback(self._respond, request, start, stop, entry.duration, gone)
+        return server.NOT_DONE_YET
+
+    def _respond(self, stream, request, start, stop, duration=None, gone=()):
+        if gone:
+            self._release(stream)
+            return stream
+        if stream.failed and not stream.bytes_fetched:
+            request.setResponseCode(502)
+            request.finish()
+            return stream
+        length = stream.length
+        if stop is None or (length is not None and stop >= length):
+            stop = length - 1 if length is not None else None
+        request.setHeader(b'content-type', stream.content_type)
+        request.setHeader(b'accept-ranges', b'bytes')
+        if stop is not None:
+            request.setHeader(b'content-length', str(stop - start + 1))
+        if start or request.getHeader('range'):
+            request.setResponseCode(206)
+            request.setHeader(b'content-range', 'bytes {0}-{1}/{2}'.format(
+                start, stop if stop is not None else '', length if length is not None else '*'))
+        end = stop + 1 if stop is not None else float('inf')
+        prefill = 0
+        if self.buffering is not None and not stream.complete:
+            # The ring buffer must be able to hold the prefill
+            prefill = min(self.buffering.prefill(stream, duration), self.capacity // 2)
+        producer = _StreamProducer(self, request, stream, start, end, prefill, duration)
+        self._producers.add(producer)
+        producer.start()
+        return stream
+
+    def _producer_finished(self, producer):
+        self._producers.discard(producer)
+        self._release(producer.stream)
+
+    def _release(self, stream):
+        # Ranged downloads belong to a single request
+        if not any(entry.stream is stream for entry in self._entries.values()):
+            if not any(p.stream is stream for p in self._producers):
+                stream.cancel()
+
+    @staticmethod
+    def _parse_range(header):
+        # Only single ranges of the form 'bytes=start-[stop]' are supported
+        if header and header.startswith('bytes='):
+            start, _, stop = header[6:].partition('-')
+            if start.isdigit():
+                return int(start), int(stop) if stop.isdigit() else None
+        return 0, None
+
+    def _register(self, store_id, remote_url, duration=None):
+        tee_path = None
+        if self.audio_cache is not None:
+            tee_path = self.audio_cache.begin(store_id)
+
+        stream = StreamBuffer(remote_url, self.capacity, tee_path=tee_path)
+        entry = self._entries[store_id] = _Entry(store_id, remote_url, stream, duration)
+        self._stats['streams'] += 1
+        self._sample(stream)
+
+        if tee_path is not None:
+            stream.finished.addCallback(self._teed, store_id, stream)
+
+        # Forget the least recently used streams
+        while len(self._entries) > self.max_streams:
+            old_id, old = self._entries.popitem(last=False)
+            if not any(p.stream is old.stream for p in self._producers):
+                old.stream.cancel()
+
+        return entry
+
+    def _sample(self, stream):
+        # Feed the throughput of every download into the controller
+        if self.buffering is not None:
+            stream.finished.addCallback(self._sampled, stream)
+
+    def _sampled(self, complete, stream):
+        self.buffering.sample(stream)
+        return complete
+
+    def _teed(self, complete, store_id, stream):
+        if complete and stream.length is not None:
+            self.audio_cache.commit(store_id, stream.length)
+        else:
+            self.audio_cache.abort(store_id)
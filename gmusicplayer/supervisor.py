@@ -0,0 +1,129 @@
+__author__ = 'daniel michels'
+
+import time
+
+from mplayer import EventType
+from twisted.internet import defer, reactor
+
+
+class PlayerSupervisor(object):
+    """ Watches the MPlayer process of a MusicPlayer and replaces it when it dies.
+
+    The death of MPlayer is detected through the EXIT event which the stdout
+    reader emits when it hits EOF without having been detached by quit().
+    The replacement is taken from the player pool (usually a warm standby),
+    the volume is restored and the current track is resumed at the position
+    the playback clock of the MusicPlayer reports.
+
+    """
+
+    def __init__(self, musicplayer, pool, deadline=10.0, retry_interval=0.5):
+        """
+        Keyword arguments:
+        musicplayer -- the MusicPlayer whose player is supervised
+        pool -- PlayerPool to take replacement players from
+        deadline -- seconds after the crash until recovery is given up
+        retry_interval -- seconds to wait before retrying a failed respawn
+
+        """
+        self.musicplayer = musicplayer
+        self.pool = pool
+        self.deadline = deadline
+        self.retry_interval = retry_interval
+        self._stats = {
+            'crashes': 0,           # Number of detected crashes
+            'recoveries': 0,        # Number of successful recoveries
+            'failures': 0,          # Recoveries given up after the deadline or failed to resume
+            'superseded': 0,        # Recoveries whose track was replaced or removed meanwhile
+            'last_recovery_time': None,
+            'max_recovery_time': None
+        }
+
+    def watch(self, player):
+        """ Start watching a player.
+
+        Keyword arguments:
+        player -- the Player instance to watch
+
+        """
+        # The stdout reader emits events on its own thread
+        def on_exit(event):
+            reactor.callFromThread(self._recover, player, time.time(), 1)
+
+        player.stdout.connect_event(EventType.EXIT, on_exit)
+
+    def stats(self):
+        """ Returns a dict of counters describing the recoveries.
+
+        """
+        return dict(self._stats)
+
+    def _recover(self, dead_player, crashed_at, attempt):
+        musicplayer = self.musicplayer
+
+        # Nothing to do if the player has been replaced in the meantime
+        if musicplayer.player is not dead_player:
+            return
+
+        if attempt == 1:
+            self._stats['crashes'] += 1
+            print("mplayer died, recovering")
+
+        try:
+            player = self.pool.acquire()
+        except Exception as e:
+            # E.g. mpv's IPC socket didn't get ready in time, retry until the deadline is reached
+            if time.time() - crashed_at + self.retry_interval < self.deadline:
+                reactor.callLater(self.retry_interval, self._recover, dead_player, crashed_at, attempt + 1)
+            else:
+                self._stats['failures'] += 1
+                print("giving up recovering mplayer after %d attempts: %r" % (attempt, e))
+            return
+
+        # Set before the new player is observed, which asks it for its volume
+        playback = musicplayer.playback
+        if playback.volume is not None:
+            player.volume = playback.volume
+        musicplayer.attach_player(player)
+
+        # The dead process is of no use anymore, the pool quits it
+        self.pool.release(dead_player)
+
+        # Resume the track where it was when mplayer died
+        position = playback.position()
+        index = musicplayer.current_track_index
+        if position is None or not 0 <= index < len(musicplayer.playlist):
+            self._recovered(True, crashed_at)
+            return
+        paused = playback.is_paused()
+        track_id = musicplayer.playlist[index]['id']
+        d = defer.maybeDeferred(musicplayer.play_track, track_id, position)
+        if paused:
+            # Once the stream url is resolved and the track is loaded
+            d.addCallback(self._pause, musicplayer)
+        # Recovered once playback actually resumed
+        d.addCallbacks(self._recovered, self._recovery_failed, callbackArgs=(crashed_at,))
+
+    @staticmethod
+    def _pause(playing, musicplayer):
+        if playing is True:
+            musicplayer.pause()
+        return playing
+
+    def _recovered(self, result, crashed_at):
+        # False if another track has been asked for or the track is gone
+        if result is not True:
+            self._stats['superseded'] += 1
+            return result
+        recovery_time = time.time() - crashed_at
+        self._stats['recoveries'] += 1
+        self._stats['last_recovery_time'] = recovery_time
+        if self._stats['max_recovery_time'] is None or recovery_time > self._stats['max_recovery_time']:
+            self._stats['max_recovery_time'] = recovery_time
+
+        print("recovered mplayer in %.3fs" % recovery_time)
+        return result
+
+    def _recovery_failed(self, failure):
+        self._stats['failures'] += 1
+        print("resuming the track after mplayer died failed: %s" % failure.getErrorMessage())
@@ -0,0 +1,256 @@
+__author__ = 'daniel michels'
+
+import time
+from collections import deque
+
+from mplayer import EventType
+from twisted.internet import reactor, threads
+from twisted.internet.task import LoopingCall
+
+# Spans of a track change in the order they usually happen
+SPANS = ('rpc_received', 'track_change', 'stream_url_resolved', 'loadfile_written', 'event_published',
+         'playback_started', 'first_position')
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+    return {'count': len(values), 'p50': at(0.5), 'p95': at(0.95), 'p99': at(0.99), 'max': values[-1]}
+
+
+class _Trace(object):
+
+    def __init__(self, trace_id, trigger):
+        self.id = trace_id
+        self.trigger = trigger          # RPC which asked for the change or 'internal'
+        self.started = time.time()
+        self.track_id = None
+        self.spans = []                 # [(name, seconds since started)]
+        self.outcome = None             # None while in progress
+        self.ttfa = None                # Seconds to the first audio
+
+    def mark(self, name, at=None):
+        self.spans.append((name, (at or time.time()) - self.started))
+
+    def offset(self, name):
+        for span, offset in self.spans:
+            if span == name:
+                return offset
+        return None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'trigger': self.trigger,
+            'trackId': self.track_id,
+            'started': self.started,
+            'spans': [{'name': name, 'offset': offset} for name, offset in self.spans],
+            'outcome': self.outcome,
+            'ttfa': self.ttfa
+        }
+
+
+class TrackChangeTracer(object):
+    """ Traces the track changes from the request to the first audio.
+
+    A trace begins when an RPC asks for a track change, or when the player
+    changes the track on its own, and collects the spans listed in SPANS.
+    It ends with the first position past 0 of the new track, which is when
+    the track is audible. The position is taken from the status lines
+    following 'Starting playback'. Players which print no status lines
+    (mplayer without Player.events) are polled with time_pos after the
+    loadfile instead, one query at a time. Traces without a position after
+    timeout seconds end as 'started' if mplayer reported 'Starting
+    playback' and as 'timeout' otherwise. A trace still in progress when
+    the next track change begins ends as 'superseded'. The recent traces
+    are kept in a ring buffer.
+
+    """
+
+    def __init__(self, capacity=200, timeout=15.0, adopt_window=1.0, poll_interval=0.05):
+        """
+        Keyword arguments:
+        capacity -- number of finished traces to keep
+        timeout -- seconds after which a trace without audio ends
+        adopt_window -- seconds a trace begun by an RPC waits for its track change
+        poll_interval -- seconds between two polls of time_pos after the loadfile, if polled
+
+        """
+        self.timeout = timeout
+        self.adopt_window = adopt_window
+        self.poll_interval = poll_interval
+        self._player = None
+        self._poll = None               # LoopingCall polling the position of the active trace
+        self._polling = False           # A poll is waiting for its answer
+        self._traces = deque(maxlen=capacity)
+        self._requested = None          # Trace begun by an RPC, waiting for the track change
+        self._active = None             # Trace waiting for the first audio
+        self._timeout_call = None
+        self._next_id = 1
+        self._stats = {
+            'traces': 0,
+            'completed': 0,
+            'started': 0,
+            'superseded': 0,
+            'timeout': 0
+        }
+
+    def observe(self, player):
+        """ Pick up playback start and positions from a player.
+
+        """
+        self._player = player
+        player.stdout.connect_event(EventType.PLAYBACK_STARTED, self._on_playback_started)
+        player.stdout.connect_event(EventType.STATUS, self._on_status)
+
+    def request(self, trigger):
+        """ An RPC asked for a track change.
+
+        """
+        trace = self._new_trace(trigger)
+        trace.mark('rpc_received', trace.started)
+        self._requested = trace
+
+    def track_change(self, track_id):
+        """ The player starts changing the track.
+
+        """
+        trace = self._requested
+        self._requested = None
+        if trace is None or time.time() - trace.started > self.adopt_window:
+            trace = self._new_trace('internal')
+        trace.track_id = track_id
+        trace.mark('track_change')
+
+        if self._active is not None:
+            self._finish(self._active, 'superseded')
+        self._active = trace
+        self._timeout_call = reactor.callLater(self.timeout, self._timed_out, trace)
+
+    def mark(self, name):
+        """ Add a span to the track change in progress.
+
+        """
+        if self._active is not None:
+            self._active.mark(name)
+            if name == 'loadfile_written':
+                self._start_polling(self._active)
+
+    def traces(self, limit=20):
+        """ Returns the most recent finished traces as dicts, the newest first.
+
+        """
+        traces = list(self._traces)[-limit:] if limit else []
+        return [trace.as_dict() for trace in reversed(traces)]
+
+    def summary(self):
+        """ Returns percentiles of the time to first audio and of every span.
+
+        """
+        completed = [trace for trace in self._traces if trace.ttfa is not None]
+        spans = {}
+        for name in SPANS:
+            offsets = [trace.offset(name) for trace in completed]
+            spans[name] = _percentiles([offset for offset in offsets if offset is not None])
+        return {'ttfa': _percentiles([trace.ttfa for trace in completed]), 'spans': spans}
+
+    def stats(self):
+        """ Returns a dict of counters describing the traces.
+
+        """
+        stats = dict(self._stats)
+        stats['kept'] = len(self._traces)
+        stats['in_progress'] = int(self._active is not None)
+        return stats
+
+    def _new_trace(self, trigger):
+        trace = _Trace(self._next_id, trigger)
+        self._next_id += 1
+        self._stats['traces'] += 1
+        return trace
+
+    def _finish(self, trace, outcome):
+        if trace is not self._active:
+            return
+        self._active = None
+        if self._timeout_call is not None and self._timeout_call.active():
+            self._timeout_call.cancel()
+        self._timeout_call = None
+        if self._poll is not None and self._poll.running:
+            self._poll.stop()
+        self._poll = None
+
+        if outcome == 'completed':
+            trace.ttfa = trace.offset('first_position')
+        elif outcome == 'started':
+            trace.ttfa = trace.offset('playback_started')
+        trace.outcome = outcome
+        self._stats[outcome] += 1
+        self._traces.append(trace)
+
+    def _timed_out(self, trace):
+        self._timeout_call = None
+        self._finish(trace, 'started' if trace.offset('playback_started') is not None else 'timeout')
+
+    def _start_polling(self, trace):
+        # The status lines have the position, and every poll delays the other queries of the player
+        if self._player is None or getattr(self._player, 'events', True):
+            return
+        self._poll = LoopingCall(self._poll_position, trace, self._player)
+        self._poll.start(self.poll_interval, now=False)
+
+    def _poll_position(self, trace, player):
+        if self._polling:
+            return
+        self._polling = True
+        d = threads.deferToThread(_time_pos, player)
+        d.addCallback(self._polled, trace)
+        d.addBoth(self._poll_done)
+
+    def _poll_done(self, result):
+        # A failed poll, e.g. of a player which died, is retried with the next one
+        self._polling = False
+
+    def _polled(self, answer, trace):
+        # Asked after the loadfile, so the position is the new track's
+        time_pos, at = answer
+        if trace is self._active and time_pos:
+            trace.mark('first_position', at)
+            self._finish(trace, 'completed')
+
+    def _on_playback_started(self, event):
+        # Called by the stdout reader
+        if self._active is not None:
+            reactor.callFromThread(self._playback_started, time.time())
+
+    def _on_status(self, event):
+        # Called by the stdout reader several times per second, so only
+        # positions of a track change in progress are passed on
+        if self._active is not None and event.time_pos > 0:
+            reactor.callFromThread(self._first_position, time.time())
+
+    def _playback_started(self, at):
+        # Lines read before the new track was handed to the player belong to the previous one
+        trace = self._active
+        if trace is None or trace.offset('playback_started') is not None:
+            return
+        resolved = trace.offset('stream_url_resolved')
+        if resolved is not None and at - trace.started >= resolved:
+            trace.mark('playback_started', at)
+
+    def _first_position(self, at):
+        # Positions until the new track started are those of the previous one
+        trace = self._active
+        if trace is not None and trace.offset('playback_started') is not None:
+            trace.mark('first_position', at)
+            self._finish(trace, 'completed')
+
+
+def _time_pos(player):
+    # Called in a thread, as the answer is waited for
+    return player.time_pos, time.time()
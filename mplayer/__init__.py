@@ -6,7 +6,9 @@ Classes:
 
 Player -- provides a clean, Pythonic interface to MPlayer
 CmdPrefix -- contains the prefixes that can be used with MPlayer commands
+EventType -- contains the types of events parsed from MPlayer's stdout
 Step -- use with property access to implement the 'step_property' command
+PlayerPool -- keeps pre-spawned, idle Player instances ready for use
 
 AsyncPlayer -- Player subclass with asyncore integration (POSIX only)
 GPlayer -- Player subclass with GTK/GObject integration
@@ -30,10 +32,13 @@ __all__ = [
     'STDOUT',
     'Player',
     'CmdPrefix',
-    'Step'
+    'EventType',
+    'Step',
+    'PlayerPool'
     ]
 
 # Import here for convenience.
 from subprocess import PIPE, STDOUT
 from mplayer.core import Player, Step
-from mplayer.misc import CmdPrefix
+from mplayer.misc import CmdPrefix, EventType
+from mplayer.pool import PlayerPool
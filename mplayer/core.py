@@ -17,12 +17,13 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with mplayer.py.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import shlex
 import atexit
 import weakref
 import subprocess
 from functools import partial
-from threading import Thread
+from threading import Thread, Lock
 try:
     import queue
 except ImportError:
@@ -78,14 +79,21 @@ class Player(object):
 
     Class attributes:
     cmd_prefix -- prefix for MPlayer commands (default: CmdPrefix.PAUSING_KEEP_FORCE)
+    events -- spawn MPlayer with the message levels needed by the events
+              parsed from its stdout, see EventType (default: False; also
+              done if such events have subscribers when spawning)
     exec_path -- path to the MPlayer executable (default: 'mplayer')
     version -- version of the introspected MPlayer executable (default: None)
 
     """
 
-    _base_args = ('-slave', '-idle', '-really-quiet', '-msglevel', 'global=4',
-                  '-input', 'nodefault-bindings', '-noconfig', 'all')
+    _base_args = ('-slave', '-idle', '-input', 'nodefault-bindings', '-noconfig', 'all')
+    # Only the answers to commands are printed
+    _quiet_args = ('-really-quiet', '-msglevel', 'global=4')
+    # The lines of the events are printed, too
+    _event_args = ('-msglevel', misc.EVENT_MSGLEVEL)
     cmd_prefix = misc.CmdPrefix.PAUSING_KEEP_FORCE
+    events = False
     exec_path = 'mplayer'
     version = None
 
@@ -103,6 +111,8 @@ class Player(object):
         self._stdout = _StdoutWrapper(handle=stdout)
         self._stderr = _StderrWrapper(handle=stderr)
         self._proc = None
+        # Only one thread at a time waits for an answer, they share a queue
+        self._answer_lock = Lock()
         # Terminate the MPlayer process when Python terminates
         atexit.register(_quit, weakref.proxy(self))
         if autospawn:
@@ -133,7 +143,7 @@ class Player(object):
     @property
     def args(self):
         """tuple of additional MPlayer arguments"""
-        return self._args[len(self._base_args):]
+        return self._args
 
     @args.setter
     def args(self, args):
@@ -143,7 +153,7 @@ class Player(object):
         except AttributeError:
             # Force all args to string
             args = map(str, args)
-        self._args = self._base_args + tuple(args)
+        self._args = tuple(args)
 
     def _propget(self, pname, ptype):
         res = self._run_command('get_property', pname)
@@ -175,13 +185,13 @@ class Player(object):
         return '\n'.join(doc)
 
     @classmethod
-    def _generate_properties(cls):
+    def _generate_properties(cls, proc=None):
         # Properties that don't have pmin == pmax == None but are actually read-only
         read_only = ['length', 'pause', 'stream_end', 'stream_length',
             'stream_start', 'stream_time_pos']
         rename = {'pause': 'paused'}
-        proc = subprocess.Popen([cls.exec_path, '-list-properties'],
-                                bufsize=-1, stdout=subprocess.PIPE)
+        if proc is None:
+            proc = cls._list('-list-properties')
         # Try to get the version of this executable
         try:
             cls.version = proc.stdout.readline().decode('utf-8', 'ignore').split()[1]
@@ -269,11 +279,11 @@ class Player(object):
         return local[name]
 
     @classmethod
-    def _generate_methods(cls):
+    def _generate_methods(cls, proc=None):
         # Commands which have truncated names in -input cmdlist
         truncated = {'osd_show_property_te': 'osd_show_property_text'}
-        proc = subprocess.Popen([cls.exec_path, '-msglevel', 'all=0', '-input', 'cmdlist'],
-                                bufsize=-1, stdout=subprocess.PIPE)
+        if proc is None:
+            proc = cls._list('-msglevel', 'all=0', '-input', 'cmdlist')
         for line in proc.stdout:
             args = line.decode('utf-8', 'ignore').split()
             if not args:
@@ -304,14 +314,26 @@ class Player(object):
 
         """
         if cls.version is None:
-            cls._generate_properties()
-            cls._generate_methods()
+            # Both listings run at the same time, most of the time goes into starting MPlayer
+            properties = cls._list('-list-properties')
+            methods = cls._list('-msglevel', 'all=0', '-input', 'cmdlist')
+            cls._generate_properties(properties)
+            cls._generate_methods(methods)
+
+    @classmethod
+    def _list(cls, *args):
+        return subprocess.Popen([cls.exec_path] + list(args), bufsize=-1, stdout=subprocess.PIPE)
 
     def spawn(self):
         """Spawn the underlying MPlayer process."""
         if self.is_alive():
             return
         args = [self.exec_path]
+        args.extend(self._base_args)
+        if self.events or self._stdout._needs_messages():
+            args.extend(self._event_args)
+        else:
+            args.extend(self._quiet_args)
         args.extend(self._args)
         # Start the MPlayer process (unbuffered)
         self._proc = subprocess.Popen(args, stdin=subprocess.PIPE,
@@ -362,17 +384,12 @@ class Player(object):
         if name in ['quit', 'pause', 'stop']:
             cmd.pop(0)
         cmd = ' '.join(cmd)
-        # In Py3k, TypeErrors will be raised because cmd is a string but stdin
-        # expects bytes. In Python 2.x on the other hand, UnicodeEncodeErrors
-        # will be raised if cmd is unicode. In both cases, encoding the string
-        # will fix the problem.
-        try:
-            self._proc.stdin.write(cmd)
-        except (TypeError, UnicodeEncodeError):
-            self._proc.stdin.write(cmd.encode('utf-8', 'ignore'))
-        self._proc.stdin.flush()
         # Expect a response for 'get_property' only
-        if name == 'get_property' and self._proc.stdout is not None:
+        if name != 'get_property' or self._proc.stdout is None:
+            self._write(cmd)
+            return
+        with self._answer_lock:
+            self._write(cmd)
             # The reponses for properties start with 'ANS_<property name>='
             key = 'ANS_{0}='.format(args[0])
             while True:
@@ -384,10 +401,21 @@ class Player(object):
                     break
                 if res.startswith('ANS_ERROR='):
                     return
-            ans = res.partition('=')[2].strip('\'"')
-            if ans == '(null)':
-                ans = None
-            return ans
+        ans = res.partition('=')[2].strip('\'"')
+        if ans == '(null)':
+            ans = None
+        return ans
+
+    def _write(self, cmd):
+        # In Py3k, TypeErrors will be raised because cmd is a string but stdin
+        # expects bytes. In Python 2.x on the other hand, UnicodeEncodeErrors
+        # will be raised if cmd is unicode. In both cases, encoding the string
+        # will fix the problem.
+        try:
+            self._proc.stdin.write(cmd)
+        except (TypeError, UnicodeEncodeError):
+            self._proc.stdin.write(cmd.encode('utf-8', 'ignore'))
+        self._proc.stdin.flush()
 
 
 class _StderrWrapper(misc._StderrWrapper):
@@ -404,7 +432,30 @@ class _StderrWrapper(misc._StderrWrapper):
 
 
 class _StdoutWrapper(_StderrWrapper, misc._StdoutWrapper):
-    pass
+
+    def _attach(self, source):
+        # Data after the last '\n' or '\r' read so far
+        self._partial = b''
+        super(_StdoutWrapper, self)._attach(source)
+
+    def _process_output(self, *args):
+        # Read whatever is there instead of a line, so a status line, which is
+        # terminated by '\r' only, is processed without waiting for the next '\n'
+        source = self._source
+        try:
+            data = os.read(source.fileno(), 65536) if source is not None else b''
+        except (OSError, ValueError):
+            data = b''
+        if not data:
+            return self._closed()
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._process_data(line)
+        if b'\r' in self._partial:
+            status, _, self._partial = self._partial.rpartition(b'\r')
+            self._process_data(status)
+        return True
 
 
 # Introspect on module load
@@ -67,9 +67,8 @@ class GtkPlayerView(gtk.Socket):
 
         """
         super(GtkPlayerView, self).__init__()
-        self._player = GPlayer(('-msglevel', 'global=6', '-fixed-vo', '-fs') + args,
-                               stderr=stderr, autospawn=False)
-        self._player.stdout.connect(self._handle_data)
+        self._player = GPlayer(('-fixed-vo', '-fs') + args, stderr=stderr, autospawn=False)
+        self._player.stdout.connect_event(misc.EventType.EOF, self._handle_eof)
         self.connect('destroy', self._on_destroy)
         self.connect('hierarchy-changed', self._on_hierarchy_changed)
 
@@ -88,10 +87,8 @@ class GtkPlayerView(gtk.Socket):
     def _on_destroy(self, *args):
         self._player.quit()
 
-    def _handle_data(self, data):
-        if data.startswith('EOF code:'):
-            code = data.partition(':')[2].strip()
-            self.emit('eof', int(code))
+    def _handle_eof(self, event):
+        self.emit('eof', event.code)
 
 
 class _StderrWrapper(misc._StderrWrapper):
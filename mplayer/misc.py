@@ -17,13 +17,14 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with mplayer.py.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import namedtuple
 try:
     import queue
 except ImportError:
     import Queue as queue
 
 
-__all__ = ['CmdPrefix']
+__all__ = ['CmdPrefix', 'EventType']
 
 
 class CmdPrefix(object):
@@ -35,6 +36,98 @@ class CmdPrefix(object):
     PAUSING_KEEP_FORCE = 'pausing_keep_force'
 
 
+class EventType(object):
+    """Types of the events parsed from MPlayer's stdout
+
+    Subscribers connected with connect_event() receive lightweight event
+    objects (named tuples) instead of raw lines. Except ANSWER and EXIT,
+    MPlayer prints the lines only with the message levels of EVENT_MSGLEVEL,
+    which Player.spawn() uses if Player.events is set or subscribers are
+    connected before spawning:
+
+    EOF -- EofEvent(code); 'EOF code: <n>'
+    ANSWER -- AnswerEvent(name, value); 'ANS_<name>=<value>'
+    STATUS -- StatusEvent(time_pos, length); the 'A: ...' status line
+    PLAYBACK_STARTED -- PlaybackStartedEvent(); 'Starting playback...'
+    CACHE_FILL -- CacheFillEvent(percent, nbytes); 'Cache fill: ...'
+    CACHE_EMPTY -- CacheEmptyEvent(); 'Cache empty, ...' or 'Cache not filling, ...',
+                   i.e. playback stalls because the stream can't keep up
+    EXIT -- ExitEvent(); emitted once when MPlayer's stdout reaches EOF
+            without the wrapper having been detached first (i.e. MPlayer died)
+
+    """
+
+    EOF = 'eof'
+    ANSWER = 'answer'
+    STATUS = 'status'
+    PLAYBACK_STARTED = 'playback_started'
+    CACHE_FILL = 'cache_fill'
+    CACHE_EMPTY = 'cache_empty'
+    EXIT = 'exit'
+
+
+# Message levels for the lines of the events: EOF is verbose (6), the status
+# line and cache fill are status messages (5), the rest is kept to warnings
+EVENT_MSGLEVEL = 'all=2:global=6:cplayer=5:statusline=5:cache=5'
+
+
+EofEvent = namedtuple('EofEvent', 'code')
+AnswerEvent = namedtuple('AnswerEvent', 'name value')
+StatusEvent = namedtuple('StatusEvent', 'time_pos length')
+PlaybackStartedEvent = namedtuple('PlaybackStartedEvent', '')
+CacheFillEvent = namedtuple('CacheFillEvent', 'percent nbytes')
+CacheEmptyEvent = namedtuple('CacheEmptyEvent', '')
+ExitEvent = namedtuple('ExitEvent', '')
+
+
+def _parse_eof(line):
+    return EofEvent(int(line.partition(':')[2].strip()))
+
+
+def _parse_answer(line):
+    name, _, value = line[4:].partition('=')
+    value = value.strip('\'"')
+    if value == '(null)':
+        value = None
+    return AnswerEvent(name, value)
+
+
+def _parse_status(line):
+    # e.g. 'A:   2.5 (02.4) of 247.0 (04:07.0)  0.3% 17%'
+    fields = line[2:].split()
+    length = None
+    if 'of' in fields:
+        length = float(fields[fields.index('of') + 1])
+    return StatusEvent(float(fields[0]), length)
+
+
+def _parse_playback_started(line):
+    return PlaybackStartedEvent()
+
+
+def _parse_cache_empty(line):
+    return CacheEmptyEvent()
+
+
+def _parse_cache_fill(line):
+    # e.g. 'Cache fill:  5.23% (171520 bytes)'
+    percent, _, nbytes = line.partition(':')[2].partition('%')
+    return CacheFillEvent(float(percent), int(nbytes.strip(' (').split()[0]))
+
+
+# Raw line prefix, event type and parser of every known event.
+# The prefixes are matched against the undecoded bytes read from stdout.
+_event_parsers = (
+    (b'EOF code:', EventType.EOF, _parse_eof),
+    (b'ANS_', EventType.ANSWER, _parse_answer),
+    (b'A:', EventType.STATUS, _parse_status),
+    (b'Starting playback', EventType.PLAYBACK_STARTED, _parse_playback_started),
+    (b'Cache fill:', EventType.CACHE_FILL, _parse_cache_fill),
+    (b'Cache empty', EventType.CACHE_EMPTY, _parse_cache_empty),
+    (b'Cache not filling', EventType.CACHE_EMPTY, _parse_cache_empty),
+)
+
+
 class _StderrWrapper(object):
 
     def __init__(self, **kwargs):
@@ -83,22 +176,114 @@ class _StdoutWrapper(_StderrWrapper):
     def __init__(self, **kwargs):
         super(_StdoutWrapper, self).__init__(**kwargs)
         self._answers = None
+        self._event_subscribers = {}
+        # Dispatch table: first byte of a line -> [(prefix, type, parser)]
+        # Only contains the event types which have subscribers.
+        self._dispatch_table = {}
 
     def _attach(self, source):
         super(_StdoutWrapper, self)._attach(source)
         self._answers = queue.Queue()
 
     def _process_output(self, *args):
-        line = self._source.readline().decode('utf-8', 'ignore')
-        if line:
-            line = line.rstrip()
-            if line.startswith('ANS_'):
-                self._answers.put_nowait(line)
-            elif line:
-                for subscriber in self._subscribers:
-                    subscriber(line)
+        data = self._source.readline()
+        if data:
+            self._process_data(data)
             return True
         else:
-            # Automatically detach when MPlayer dies unexpectedly
-            self._detach()
-            return False
+            return self._closed()
+
+    def _process_data(self, data):
+        data = data.rstrip()
+        if b'\r' in data:
+            # Status lines are terminated by '\r' and pile up until the
+            # next '\n'. Only the most recent one is of any interest.
+            self._process_segments(data.split(b'\r'))
+        elif data:
+            self._process_line(data)
+
+    def _closed(self):
+        # The source is still attached only if quit() wasn't called
+        died = self._source is not None
+        # Automatically detach when MPlayer dies unexpectedly
+        self._detach()
+        if died:
+            self._emit(EventType.EXIT, ExitEvent())
+        return False
+
+    def _process_segments(self, segments):
+        last_status = None
+        for data in segments:
+            data = data.strip()
+            if data.startswith(b'A:'):
+                last_status = data
+            elif data:
+                self._process_line(data)
+        if last_status is not None:
+            self._process_line(last_status)
+
+    def _process_line(self, data):
+        if data.startswith(b'ANS_'):
+            line = data.decode('utf-8', 'ignore')
+            self._answers.put_nowait(line)
+            if EventType.ANSWER in self._event_subscribers:
+                self._emit(EventType.ANSWER, _parse_answer(line))
+            return
+        line = None
+        for prefix, etype, parse in self._dispatch_table.get(data[:1], ()):
+            if data.startswith(prefix):
+                line = data.decode('utf-8', 'ignore')
+                try:
+                    event = parse(line)
+                except (ValueError, IndexError):
+                    # Malformed or truncated line
+                    break
+                self._emit(etype, event)
+                break
+        # Lines are decoded only if somebody is interested in them
+        if self._subscribers:
+            if line is None:
+                line = data.decode('utf-8', 'ignore')
+            for subscriber in self._subscribers:
+                subscriber(line)
+
+    def _emit(self, etype, event):
+        for subscriber in self._event_subscribers.get(etype, ()):
+            subscriber(event)
+
+    def _needs_messages(self):
+        # ANS_ lines are printed anyway and EXIT isn't parsed from a line
+        return any(etype not in (EventType.ANSWER, EventType.EXIT) for etype in self._event_subscribers)
+
+    def _rebuild_dispatch_table(self):
+        table = {}
+        for prefix, etype, parse in _event_parsers:
+            # ANS_ lines are always processed because of get_property()
+            if etype in self._event_subscribers and etype != EventType.ANSWER:
+                table.setdefault(prefix[:1], []).append((prefix, etype, parse))
+        self._dispatch_table = table
+
+    def connect_event(self, etype, subscriber):
+        """Connect a subscriber to the events of the given EventType"""
+        if not hasattr(subscriber, '__call__'):
+            # Raise TypeError
+            subscriber()
+        # Copy-on-write so that the reader never sees a half-updated list
+        subscribers = list(self._event_subscribers.get(etype, ()))
+        if subscriber not in subscribers:
+            subscribers.append(subscriber)
+        self._event_subscribers[etype] = subscribers
+        self._rebuild_dispatch_table()
+
+    def disconnect_event(self, etype, subscriber=None):
+        """Disconnect one or all subscribers from the events of the given EventType"""
+        subscribers = list(self._event_subscribers.get(etype, ()))
+        if subscriber is None:
+            subscribers = []
+        elif subscriber in subscribers:
+            subscribers.remove(subscriber)
+        if subscribers:
+            self._event_subscribers[etype] = subscribers
+        else:
+            self._event_subscribers.pop(etype, None)
+        self._rebuild_dispatch_table()
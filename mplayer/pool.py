@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import deque
+from threading import Thread, Condition
+
+from mplayer.core import Player
+
+
+__all__ = ['PlayerPool']
+
+
+class PlayerPool(object):
+    """A pool of pre-spawned, idle MPlayer processes.
+
+    Spawning MPlayer (fork/exec plus its own initialization) is slow enough to
+    be noticeable whenever a player is needed on short notice, e.g. when
+    replacing a crashed one. The pool keeps a number of '-idle -slave'
+    processes warm and hands them out as ready Player instances. A background
+    thread refills the pool and reaps processes which have been idle for too
+    long.
+
+    The pool uses threads, so it is meant to be used with Player or the
+    thread-safe integrations.
+
+    """
+
+    def __init__(self, size=1, args=(), player_class=Player, max_idle_time=900.0,
+                 retry_interval=5.0, **kwargs):
+        """Arguments:
+
+        size -- number of idle processes to keep around (default: 1)
+        args -- additional MPlayer arguments of the pooled players (default: ())
+        player_class -- Player (sub)class to instantiate (default: Player)
+        max_idle_time -- seconds after which an idle process is replaced
+                         (default: 900.0)
+        retry_interval -- seconds to wait before refilling the pool again
+                          after a process failed to spawn (default: 5.0)
+
+        All other keyword arguments are passed to player_class.
+
+        """
+        super(PlayerPool, self).__init__()
+        self.args = args
+        self.player_class = player_class
+        self.max_idle_time = max_idle_time
+        self.retry_interval = retry_interval
+        self._kwargs = kwargs
+        self._size = size
+        # Idle players along with the time they were spawned at
+        self._idle = deque()
+        self._cond = Condition()
+        self._running = True
+        self._stats = {
+            'warm': 0,              # Players handed out from the pool
+            'cold': 0,              # Players which had to be spawned on demand
+            'spawned': 0,           # Players spawned in the background
+            'reaped': 0,            # Idle players which were too old
+            'unhealthy': 0,         # Idle players which died while waiting
+            'spawn_errors': 0,      # Background spawns which failed
+            'loads': 0,             # acquire() calls which loaded a file
+            'last_latency': None,   # Seconds from acquire() to loadfile
+            'max_latency': None,
+            'total_latency': 0.0
+        }
+        t = Thread(target=self._thread_func)
+        t.daemon = True
+        t.start()
+
+    def __repr__(self):
+        return '<{0} with {1}/{2} idle>'.format(self.__class__.__name__,
+                                               len(self._idle), self._size)
+
+    @property
+    def size(self):
+        """number of idle processes kept around"""
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        with self._cond:
+            self._size = size
+            self._cond.notify()
+
+    def acquire(self, path=None):
+        """Take a running Player out of the pool.
+
+        A new process is spawned in the foreground if no healthy idle process
+        is available. If path is given, it is loaded right away and the time
+        it took to get there is recorded in stats().
+
+        """
+        start = time.time()
+        player = None
+        unhealthy = []
+        with self._cond:
+            while self._idle:
+                candidate = self._idle.popleft()[0]
+                if self._healthy(candidate):
+                    player = candidate
+                    break
+                unhealthy.append(candidate)
+            self._stats['unhealthy'] += len(unhealthy)
+            self._cond.notify()
+        for candidate in unhealthy:
+            self._discard(candidate)
+        if player is not None:
+            self._stats['warm'] += 1
+        else:
+            player = self._spawn()
+            self._stats['cold'] += 1
+        if path is not None:
+            player.loadfile(path)
+            self._record_latency(time.time() - start)
+        return player
+
+    def release(self, player):
+        """Return a Player which is still in the idle state to the pool."""
+        with self._cond:
+            if len(self._idle) < self._size and self._healthy(player):
+                self._idle.append((player, time.time()))
+                return
+        self._discard(player)
+
+    def close(self):
+        """Stop refilling the pool and terminate all idle processes."""
+        with self._cond:
+            self._running = False
+            idle = [player for player, spawned in self._idle]
+            self._idle.clear()
+            self._cond.notify()
+        for player in idle:
+            self._discard(player)
+
+    def stats(self):
+        """Return a dict of counters describing the pool's performance."""
+        stats = dict(self._stats)
+        stats['idle'] = len(self._idle)
+        if stats['loads']:
+            stats['avg_latency'] = stats['total_latency'] / stats['loads']
+        else:
+            stats['avg_latency'] = None
+        return stats
+
+    def _record_latency(self, latency):
+        self._stats['loads'] += 1
+        self._stats['last_latency'] = latency
+        self._stats['total_latency'] += latency
+        if self._stats['max_latency'] is None or latency > self._stats['max_latency']:
+            self._stats['max_latency'] = latency
+
+    def _spawn(self):
+        return self.player_class(self.args, **self._kwargs)
+
+    @staticmethod
+    def _healthy(player):
+        # Also check that the stdout reader hasn't seen EOF yet
+        if player._proc is not None and player._proc.stdout is not None:
+            if player.stdout._source is None:
+                return False
+        return player.is_alive()
+
+    @staticmethod
+    def _discard(player):
+        try:
+            player.quit()
+        except (IOError, OSError):
+            pass
+
+    def _reap(self):
+        # Called with self._cond held; returns the players to terminate
+        expired = []
+        now = time.time()
+        while len(self._idle) > self._size:
+            expired.append(self._idle.pop()[0])
+        for entry in list(self._idle):
+            if now - entry[1] > self.max_idle_time:
+                self._idle.remove(entry)
+                expired.append(entry[0])
+                self._stats['reaped'] += 1
+        return expired
+
+    def _thread_func(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                expired = self._reap()
+                missing = self._size - len(self._idle)
+                if not expired and missing <= 0:
+                    self._cond.wait(min(self.max_idle_time, 60.0))
+                    continue
+            # Terminate and spawn processes without holding the lock
+            for player in expired:
+                self._discard(player)
+            for i in range(missing):
+                try:
+                    player = self._spawn()
+                except Exception as e:
+                    # E.g. the executable is missing or didn't get ready in
+                    # time; acquire() will raise if it keeps failing
+                    print('spawning a pooled player failed: {0!r}'.format(e))
+                    with self._cond:
+                        self._stats['spawn_errors'] += 1
+                        self._cond.wait(self.retry_interval)
+                    break
+                with self._cond:
+                    if self._running:
+                        self._idle.append((player, time.time()))
+                        self._stats['spawned'] += 1
+                        continue
+                self._discard(player)
+                return
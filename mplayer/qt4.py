@@ -70,9 +70,11 @@ class QPlayerView(_Container):
 
         """
         super(QPlayerView, self).__init__(parent)
-        self._player = QtPlayer(('-msglevel', 'global=6', '-fixed-vo', '-fs',
-                                 '-wid', int(self.winId())) + args, stderr=stderr)
-        self._player.stdout.connect(self._handle_data)
+        self._player = QtPlayer(('-fixed-vo', '-fs', '-wid', int(self.winId())) + args,
+                                stderr=stderr, autospawn=False)
+        # Connected before spawning, so that MPlayer prints the EOF lines
+        self._player.stdout.connect_event(misc.EventType.EOF, self._handle_eof)
+        self._player.spawn()
         self.destroyed.connect(self._on_destroy)
 
     @property
@@ -83,10 +85,8 @@ class QPlayerView(_Container):
     def _on_destroy(self):
         self._player.quit()
 
-    def _handle_data(self, data):
-        if data.startswith('EOF code:'):
-            code = data.partition(':')[2].strip()
-            self.eof.emit(int(code))
+    def _handle_eof(self, event):
+        self.eof.emit(event.code)
 
 
 class _StderrWrapper(misc._StderrWrapper):
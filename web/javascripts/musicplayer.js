@@ -4,13 +4,26 @@ var session;
 // Id of current Track
 var currentTrackId;
 
+// Last known playback position and when it was received
+var playbackPosition = null;
+var positionReceivedAt = 0;
+var playbackPaused = false;
+
 var PLAYTYPE_LINEAR = 1;
 var PLAYTYPE_SHUFFLE = 2;
 
+// Results and events are JSON strings unless the server agreed to send them structured
+var PAYLOAD_LEGACY = "json";
+var PAYLOAD_STRUCTURED = "structured";
+var payloadMode = PAYLOAD_LEGACY;
+
 $(document).ready(function() {
 	// WAMP server
 	var wsuri = "ws://" + document.location.hostname +":9000";
 
+	// Advance the displayed position between two position events
+	setInterval(updatePosition, 1000);
+
 	// Click on play track in playlist table
 	$('#playlistTable').on('click', "a[class='play_track']", function() {
 		// Find the parent row of this link
@@ -56,7 +69,7 @@ $(document).ready(function() {
 		$('#loadingAnimation').removeClass("hidden");
 		
 		search(query, function(res){
-			var resultArray = $.parseJSON( res );
+			var resultArray = decodePayload(res);
 		
 			$('#searchResultTable > tbody').empty();
 
@@ -64,7 +77,7 @@ $(document).ready(function() {
 				var track = value.track;
 
 				$('#searchResultTable > tbody').append("<tr data-value='" + JSON.stringify(track) + "'>"
-				+ "<td style='vertical-align:middle'><img src='" + track.albumArtRef[0].url + "' style='width: 34px; height: 34px'/></td>"
+				+ "<td style='vertical-align:middle'><img src='" + albumArtUrl(track, 34) + "' style='width: 34px; height: 34px'/></td>"
 				+ "<td style='vertical-align:middle'>" + track.artist + "</td>"
 				+ "<td style='vertical-align:middle'>" + track.title + "</td>"
 				+ "<td style='vertical-align:middle'>" + track.album + "</td>"
@@ -85,42 +98,15 @@ $(document).ready(function() {
 		// WAMP session was established
 		function (s) {
 			session = s;
- 		
- 			// Subscribe to newtrack events that get fired when a new Track is added to the Playlist
- 			s.subscribe("musicplayer/playlist/events/track_added_to_playlist", function(topicUri, trackJson) {
- 				var track = $.parseJSON(trackJson);
-
- 				handleEvent_TrackAddedToPlaylist(track);
- 			});
-
- 			// Subscribe to track removed from playlist
- 			s.subscribe("musicplayer/playlist/events/track_removed_from_playlist", function(topicUri, trackId) {
-				handleEvent_TrackRemovedFromPlaylist(trackId);
- 			});
-
- 			// Subscribe to playtype changed events
- 			s.subscribe("musicplayer/playlist/events/playtype_changed", function(topicUri, playtype) {
- 				handleEvent_PlaytypeChanged(playtype);
- 			});
 
- 			// Subscribe to playingtrack events that get fired when a Track starts playing
- 			s.subscribe("musicplayer/events/playback", function(topicUri, trackJson) {
- 				var track = $.parseJSON(trackJson);
-
- 				handleEvent_TrackPlayback(track)
- 			});
-
- 			// Get Status from Server
- 			s.call("musicplayer/music#get_status").then(function(statusJson) {
- 				var status = $.parseJSON(statusJson);
-
- 				handleEvent_TrackPlayback(status.currentTrack);
- 				handleEvent_PlaytypeChanged(status.playtype);
+			// Ask for structured payloads, older servers only send JSON strings
+			s.call("musicplayer/music#set_payload_mode", PAYLOAD_STRUCTURED).then(function(mode) {
+				payloadMode = mode;
+				startSession(s);
+			}, function(err) {
+				startSession(s);
 			});
- 	
- 			// Initialy load Playlist from server	
- 			loadPlaylist();
- 		},
+		},
 
 		// WAMP session is gone
 		function (code, reason) {
@@ -129,6 +115,95 @@ $(document).ready(function() {
 	);
 });
 
+/**
+ *	Subscribe to the events of the server and load its state
+ *
+ *	@method startSession
+ *	@param {Object} The WAMP session
+ **/
+function startSession(s) {
+	// Subscribe to newtrack events that get fired when a new Track is added to the Playlist
+	s.subscribe("musicplayer/playlist/events/track_added_to_playlist", function(topicUri, trackJson) {
+		var track = decodePayload(trackJson);
+
+		handleEvent_TrackAddedToPlaylist(track);
+	});
+
+	// Several tracks added within a short time arrive as one list
+	s.subscribe("musicplayer/playlist/events/track_added_to_playlist/batch", function(topicUri, tracksJson) {
+		$.each(decodePayload(tracksJson), function(index, track) {
+			handleEvent_TrackAddedToPlaylist(track);
+		});
+	});
+
+	// Subscribe to track removed from playlist
+	s.subscribe("musicplayer/playlist/events/track_removed_from_playlist", function(topicUri, trackId) {
+		handleEvent_TrackRemovedFromPlaylist(trackId);
+	});
+
+	s.subscribe("musicplayer/playlist/events/track_removed_from_playlist/batch", function(topicUri, trackIds) {
+		$.each(trackIds, function(index, trackId) {
+			handleEvent_TrackRemovedFromPlaylist(trackId);
+		});
+	});
+
+	// Subscribe to playtype changed events
+	s.subscribe("musicplayer/playlist/events/playtype_changed", function(topicUri, playtype) {
+		handleEvent_PlaytypeChanged(playtype);
+	});
+
+	// Another playlist is played from now on, it comes with all its tracks
+	s.subscribe("musicplayer/playlist/events/switched", function(topicUri, playlist) {
+		$('#playlistTable > tbody').empty();
+
+		$.each(playlist.tracks, function(index, track) {
+			handleEvent_TrackAddedToPlaylist(track);
+		});
+		handleEvent_PlaytypeChanged(playlist.playtype);
+	});
+
+	// Subscribe to playingtrack events that get fired when a Track starts playing
+	s.subscribe("musicplayer/events/playback", function(topicUri, trackJson) {
+		var track = decodePayload(trackJson);
+
+		handleEvent_TrackPlayback(track)
+	});
+
+	// Subscribe to the position updates of the current track
+	s.subscribe("musicplayer/events/position", function(topicUri, positionJson) {
+		handleEvent_Position(decodePayload(positionJson));
+	});
+
+	// The server dropped events because this client fell behind, reload everything
+	s.subscribe("musicplayer/events/resync", function(topicUri, event) {
+		$('#playlistTable > tbody').empty();
+
+		loadStatus();
+		loadPlaylist();
+	});
+
+	// Get Status from Server
+	loadStatus();
+
+	// Initialy load Playlist from server
+	loadPlaylist();
+}
+
+/**
+ *	Load the playback status from server
+ *
+ *	@method loadStatus
+ **/
+function loadStatus() {
+	session.call("musicplayer/music#get_status").then(function(statusJson) {
+		var status = decodePayload(statusJson);
+
+		handleEvent_TrackPlayback(status.currentTrack);
+		handleEvent_PlaytypeChanged(status.playtype);
+		handleEvent_Position(status);
+	});
+}
+
 /**
  *	Removes the table row that displays the track from the playlistTable
  *
@@ -152,7 +227,7 @@ function handleEvent_TrackRemovedFromPlaylist(trackId) {
 function handleEvent_TrackAddedToPlaylist(track) {
 	try {
 		$('#playlistTable > tbody').append("<tr data-id='" + track.id + "'>"
-			+ "<td style='vertical-align:middle'><a href='#'><img class='albumArt' src='" + track.albumArtRef[0].url + "'/></a></td>"
+			+ "<td style='vertical-align:middle'><a href='#'><img class='albumArt' src='" + albumArtUrl(track, 34) + "'/></a></td>"
 			+ "<td style='vertical-align:middle'>" + track.artist + "</td>"
 			+ "<td style='vertical-align:middle'>" + track.title + "</td>"
 			+ "<td style='vertical-align:middle'>" + track.album + "</td>"
@@ -202,12 +277,85 @@ function handleEvent_TrackPlayback(track) {
 		$('#currentTrack #album').text(track.album);
 		$('#currentTrack #genre').text(track.genre);
 		$('#currentTrack #duration').text( minutes + ":" + seconds);
-		$('#currentTrack #albumArt').attr("src", track.albumArtRef[0].url);
+		$('#currentTrack #albumArt').attr("src", albumArtUrl(track, 120));
 	} catch (exception) {
 		console.log(exception);
 	}
 }
 
+/**
+ *	Remember the playback position of the current track
+ *
+ *	@method handleEvent_Position
+ *	@param {Object} Position, duration and state of the playback
+ **/
+function handleEvent_Position(position) {
+	playbackPosition = position.playing ? position.position : null;
+	playbackPaused = position.paused;
+	positionReceivedAt = new Date().getTime();
+
+	updatePosition();
+}
+
+/**
+ *	Display the current position, extrapolated from the last position received
+ *
+ *	@method updatePosition
+ **/
+function updatePosition() {
+	if(playbackPosition === null) {
+		$('#currentTrack #position').text("0:00");
+		return;
+	}
+
+	var position = playbackPosition;
+
+	if(!playbackPaused) {
+		position += (new Date().getTime() - positionReceivedAt) / 1000;
+	}
+
+	var minutes = Math.floor(position / 60);
+	var seconds = Math.floor(position - (minutes * 60));
+
+	if(seconds < 10) { seconds = "0" + seconds; }
+
+	$('#currentTrack #position').text(minutes + ":" + seconds);
+}
+
+/**
+ *	Decode a result or event which legacy servers send as JSON string
+ *
+ *	@method decodePayload
+ *	@param {Object} The payload as received
+ **/
+function decodePayload(payload) {
+	if(payloadMode == PAYLOAD_STRUCTURED) {
+		return payload;
+	}
+
+	return $.parseJSON(payload);
+}
+
+/**
+ *	Url of the album art of a track, resized by the server
+ *
+ *	@method albumArtUrl
+ *	@param {Object} The track
+ *	@param {Integer} Size of the image in css pixels
+ **/
+function albumArtUrl(track, size) {
+	if(!track.albumArtRef || track.albumArtRef.length == 0) {
+		return "";
+	}
+
+	// Twice the size for high resolution displays
+	if(window.devicePixelRatio > 1) {
+		size *= 2;
+	}
+
+	return "/art/" + size + "?u=" + encodeURIComponent(track.albumArtRef[0].url);
+}
+
 /**
  *	Load playlist from server and add tracks to playlistTable.
  *
@@ -217,7 +365,7 @@ function loadPlaylist() {
 
 	// When the call succeds, add all tracks to playlistTable
 	function success(playlistJson) {
-		var resultArray = $.parseJSON( playlistJson );
+		var resultArray = decodePayload(playlistJson);
  					console.log(resultArray);
 
 		$.each(resultArray, function(index, track) {
@@ -288,7 +436,7 @@ function addToPlaylist(track) {
 		Alert("Error");
 	}
 
-	session.call("musicplayer/music#add_to_playlist", JSON.stringify(track)).then(success, error);
+	session.call("musicplayer/music#add_to_playlist", payloadMode == PAYLOAD_STRUCTURED ? track : JSON.stringify(track)).then(success, error);
 }
 
 /**